@@ -1,9 +1,12 @@
 from flask_admin.contrib.sqla import ModelView
 from flask_admin import Admin, BaseView, expose, AdminIndexView
+from wtforms.validators import NumberRange, Optional
+from datetime import date, datetime, timedelta
 from flask import redirect, url_for, request
 from flask_login import current_user
-from models import User, Doctor, MedicalCenter, Department, Shift, UserRole, Ticket, TicketStatus
-from DatLichKhamOnline import app, db
+from sqlalchemy.orm import joinedload
+from models import User, Doctor, MedicalCenter, Department, Shift, UserRole, Ticket, TicketStatus, DoctorShift
+from DatLichKhamOnline import app, db, stats_rollup, analytics
 
 
 # Lớp tùy chỉnh cho trang chủ admin để hiển thị thống kê
@@ -14,15 +17,14 @@ class MyAdminIndexView(AdminIndexView):
         if not current_user.is_authenticated or current_user.role != UserRole.ADMIN:
             return redirect(url_for('user_login'))
 
-        # Truy vấn các số liệu thống kê
-        stats = {
-            'user_count': db.session.query(User).count(),
-            'doctor_count': db.session.query(User).filter_by(role=UserRole.DOCTOR).count(),
-            'ticket_count': db.session.query(Ticket).count(),
-            'pending_tickets': db.session.query(Ticket).filter_by(status=TicketStatus.PENDING).count()
-        }
+        # Các số liệu được đọc từ bảng thống kê cộng dồn (stats_rollup), không quét bảng tickets
+        days = request.args.get('days', 30, type=int)
+        days = max(7, min(days, 365))
+        stats = stats_rollup.totals()
+        series = stats_rollup.daily_series(days)
 
-        return self.render('admin/index.html', stats=stats)
+        return self.render('admin/index.html', stats=stats, series=series, days=days,
+                           top_centers=stats_rollup.top_centers(days), top_departments=stats_rollup.top_departments(days))
 
 
 # Lớp tùy chỉnh để bảo mật các trang admin khác
@@ -47,8 +49,11 @@ class MedicalCenterAdminView(SecureModelView):
     column_list = ('name', 'address', 'phone')
     column_searchable_list = ('name', 'address')
     column_labels = dict(name='Tên trung tâm', address='Địa chỉ', phone='Số điện thoại', description='Mô tả',
-                         image='Ảnh bìa')
-    form_columns = ('name', 'address', 'phone', 'description', 'image')
+                         image='Ảnh bìa', latitude='Vĩ độ', longitude='Kinh độ')
+    form_columns = ('name', 'address', 'phone', 'description', 'image', 'latitude', 'longitude')
+    # Tọa độ nhập tay (độ thập phân) cho tìm bệnh viện gần nhất – không tra tọa độ trực tuyến
+    form_args = dict(latitude=dict(validators=[Optional(), NumberRange(-90, 90)]),
+                     longitude=dict(validators=[Optional(), NumberRange(-180, 180)]))
 
 
 class DoctorAdminView(SecureModelView):
@@ -90,6 +95,37 @@ class TicketAdminView(SecureModelView):
         'status': 'Trạng Thái'
     }
 
+    def get_query(self):
+        # Nạp bệnh nhân, ca, giờ khám và tên bác sĩ cùng câu truy vấn danh sách thay vì nạp lười theo từng vé
+        return super().get_query().options(
+            joinedload(Ticket.client),
+            joinedload(Ticket.doctor_shift).joinedload(DoctorShift.shift),
+            joinedload(Ticket.doctor_shift).joinedload(DoctorShift.doctor).joinedload(Doctor.user))
+
+
+# Trang phân tích cung/cầu (analytics.py): mức sử dụng khung giờ, tỉ lệ hủy, thời gian đặt trước
+class AnalyticsView(BaseView):
+    def is_accessible(self):
+        return current_user.is_authenticated and current_user.role == UserRole.ADMIN
+
+    def inaccessible_callback(self, name, **kwargs):
+        return redirect(url_for('user_login', next=request.url))
+
+    @expose('/')
+    def index(self):
+        def parse_date(name, default):
+            try:
+                return datetime.strptime(request.args.get(name, ''), '%Y-%m-%d').date()
+            except ValueError:
+                return default
+
+        start_date = parse_date('start_date', date.today() - timedelta(days=30))
+        end_date = parse_date('end_date', date.today() + timedelta(days=30))
+        if end_date < start_date:
+            start_date, end_date = end_date, start_date
+        report = analytics.demand_report(start_date, end_date)
+        return self.render('admin/analytics.html', report=report)
+
 
 # Khởi tạo đối tượng Admin với trang chủ tùy chỉnh
 admin = Admin(app, name='QUẢN TRỊ WEBSITE', template_mode='bootstrap4', index_view=MyAdminIndexView())
@@ -100,4 +136,5 @@ admin.add_view(DoctorAdminView(Doctor, db.session, name='Hồ sơ Bác sĩ'))
 admin.add_view(MedicalCenterAdminView(MedicalCenter, db.session, name='Trung tâm y tế'))
 admin.add_view(DepartmentAdminView(Department, db.session, name='Chuyên khoa'))
 admin.add_view(SecureModelView(Shift, db.session, name='Ca làm việc'))
-admin.add_view(TicketAdminView(Ticket, db.session, name='Phiếu khám'))  # SỬ DỤNG TICKETADMINVIEW MỚI
\ No newline at end of file
+admin.add_view(TicketAdminView(Ticket, db.session, name='Phiếu khám'))  # SỬ DỤNG TICKETADMINVIEW MỚI
+admin.add_view(AnalyticsView(name='Phân tích nhu cầu', endpoint='analytics'))
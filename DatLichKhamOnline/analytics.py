@@ -0,0 +1,251 @@
+# DatLichKhamOnline/analytics.py
+# Phân tích cung/cầu khám bệnh bằng NumPy: mỗi DoctorShift là một khung giờ (cung), vé đặt là cầu.
+# Dữ liệu doctor_shifts/tickets được đọc theo từng khối (chunk), chuyển thành các mảng cột và
+# cộng dồn bằng np.bincount, nên bộ nhớ không phụ thuộc vào số dòng.
+#
+# Các chỉ số: mức sử dụng (vé chưa hủy / số khung giờ), tỉ lệ hủy, thời gian đặt trước
+# (Ticket.created_at -> giờ bắt đầu ca) và bản đồ nhiệt theo thứ trong tuần x giờ trong ngày,
+# tính theo bác sĩ, chuyên khoa và bệnh viện.
+#
+#   python analytics.py [YYYY-MM-DD YYYY-MM-DD]   # báo cáo từ CSDL
+#   python analytics.py --synthetic 10000000      # đo tốc độ phần tính toán với dữ liệu ngẫu nhiên
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+from sqlalchemy import select
+
+from DatLichKhamOnline import app, db, reference_data, archive
+from models import Doctor, DoctorDepartment, DoctorShift, Ticket, Shift, TicketStatus, User, DoctorShiftArchive, \
+    TicketArchive
+
+doctor_shift_table = DoctorShift.__table__
+ticket_table = Ticket.__table__
+shift_table = Shift.__table__
+shift_archive_table = DoctorShiftArchive.__table__
+ticket_archive_table = TicketArchive.__table__
+
+CHUNK_SIZE = 200_000
+# Mã trạng thái vé trong mảng cột; NO_TICKET là khung giờ chưa có vé
+NO_TICKET = -1
+STATUS_CODES = {status: code for code, status in enumerate(TicketStatus)}
+CANCELLED = STATUS_CODES[TicketStatus.CANCELLED]
+# Thời gian đặt trước được gom theo giờ, tối đa 90 ngày (giá trị lớn hơn dồn vào ô cuối)
+LEAD_TIME_BUCKETS = 90 * 24 + 1
+# Ngưỡng để coi một bác sĩ là quá tải / ít được đặt
+OVERBOOKED_RATIO = 0.9
+UNDERBOOKED_RATIO = 0.2
+
+
+def _grow(array, size):
+    if size <= array.shape[0]:
+        return array
+    grown = np.zeros((size,) + array.shape[1:], dtype=array.dtype)
+    grown[:array.shape[0]] = array
+    return grown
+
+
+class DemandAccumulator:
+    """Cộng dồn các khối dữ liệu dạng cột; mọi phép tính trong add_chunk đều là phép toán vector."""
+
+    def __init__(self):
+        self.rows = 0
+        # Theo bác sĩ (chỉ số mảng = doctor_id)
+        self.slots = np.zeros(0, dtype=np.int64)
+        self.booked = np.zeros(0, dtype=np.int64)
+        self.tickets = np.zeros(0, dtype=np.int64)
+        self.cancelled = np.zeros(0, dtype=np.int64)
+        # Thứ trong tuần (0 = Thứ 2) x giờ trong ngày
+        self.heatmap_slots = np.zeros(7 * 24, dtype=np.int64)
+        self.heatmap_booked = np.zeros(7 * 24, dtype=np.int64)
+        self.lead_time_hours = np.zeros(LEAD_TIME_BUCKETS, dtype=np.int64)
+
+    def add_chunk(self, doctor_ids, work_days, start_minutes, status_codes, created_seconds):
+        """Thêm một khối dữ liệu.
+
+        doctor_ids: int; work_days: số ngày kể từ 1970-01-01; start_minutes: phút bắt đầu ca trong ngày;
+        status_codes: mã trạng thái vé hoặc NO_TICKET; created_seconds: Ticket.created_at (giây epoch,
+        bỏ qua khi không có vé).
+        """
+        if not len(doctor_ids):
+            return
+        self.rows += len(doctor_ids)
+        size = int(doctor_ids.max()) + 1
+        for name in ('slots', 'booked', 'tickets', 'cancelled'):
+            setattr(self, name, _grow(getattr(self, name), size))
+
+        has_ticket = status_codes != NO_TICKET
+        is_cancelled = status_codes == CANCELLED
+        is_booked = has_ticket & ~is_cancelled
+
+        self.slots[:size] += np.bincount(doctor_ids, minlength=size)
+        self.booked[:size] += np.bincount(doctor_ids, weights=is_booked, minlength=size).astype(np.int64)
+        self.tickets[:size] += np.bincount(doctor_ids, weights=has_ticket, minlength=size).astype(np.int64)
+        self.cancelled[:size] += np.bincount(doctor_ids, weights=is_cancelled, minlength=size).astype(np.int64)
+
+        # 1970-01-01 là Thứ 5 (weekday 3)
+        cells = ((work_days + 3) % 7) * 24 + start_minutes // 60
+        self.heatmap_slots += np.bincount(cells, minlength=7 * 24)
+        self.heatmap_booked += np.bincount(cells, weights=is_booked, minlength=7 * 24).astype(np.int64)
+
+        slot_start = work_days[has_ticket].astype(np.int64) * 86400 + start_minutes[has_ticket].astype(np.int64) * 60
+        lead_hours = np.clip((slot_start - created_seconds[has_ticket]) // 3600, 0, LEAD_TIME_BUCKETS - 1)
+        self.lead_time_hours += np.bincount(lead_hours, minlength=LEAD_TIME_BUCKETS)
+
+    def lead_time_percentiles(self, percentiles=(50, 90, 99)):
+        """Phân vị thời gian đặt trước (giờ), tính từ histogram theo giờ."""
+        total = self.lead_time_hours.sum()
+        if not total:
+            return {p: None for p in percentiles}
+        cumulative = np.cumsum(self.lead_time_hours)
+        return {p: int(np.searchsorted(cumulative, total * p / 100)) for p in percentiles}
+
+
+def _ratio(numerator, denominator):
+    return np.divide(numerator, denominator, out=np.zeros(len(numerator)), where=denominator > 0)
+
+
+def _group(member_ids, group_ids, values, size):
+    """Cộng các giá trị theo bác sĩ vào nhóm (chuyên khoa/bệnh viện) qua danh sách cặp (doctor_id, group_id)."""
+    return np.bincount(group_ids, weights=values[member_ids], minlength=size).astype(np.int64)
+
+
+def stream_slots(start_date, end_date, chunk_size=CHUNK_SIZE):
+    """Đọc doctor_shifts LEFT JOIN tickets (và kho lưu trữ) trong khoảng ngày theo từng khối, trả về các mảng cột."""
+    connection = db.session.connection()
+    shift_minutes = {row.id: row.start_time.hour * 60 + row.start_time.minute
+                     for row in connection.execute(select(shift_table.c.id, shift_table.c.start_time))}
+    minutes_lookup = np.zeros(max(shift_minutes, default=0) + 1, dtype=np.int32)
+    minutes_lookup[list(shift_minutes)] = list(shift_minutes.values())
+
+    sources = [(doctor_shift_table, ticket_table)]
+    if archive.reaches_archive(start_date):
+        # Khoảng ngày chạm tới phần đã lưu trữ: đọc thêm doctor_shifts_archive/tickets_archive
+        sources.append((shift_archive_table, ticket_archive_table))
+
+    for shifts, tickets in sources:
+        query = select(
+            shifts.c.doctor_id, shifts.c.work_date, shifts.c.shift_id, tickets.c.status, tickets.c.created_at
+        ).select_from(
+            shifts.outerjoin(tickets, tickets.c.doctor_shift_id == shifts.c.id)
+        ).where(shifts.c.work_date.between(start_date, end_date))
+
+        result = connection.execution_options(stream_results=True, yield_per=chunk_size).execute(query)
+        for rows in result.partitions():
+            doctor_ids, work_dates, shift_ids, statuses, created = zip(*rows)
+            yield (
+                np.fromiter(doctor_ids, dtype=np.int64, count=len(rows)),
+                np.array(work_dates, dtype='datetime64[D]').astype(np.int64),
+                minutes_lookup[np.fromiter(shift_ids, dtype=np.int64, count=len(rows))],
+                np.fromiter((NO_TICKET if status is None else STATUS_CODES[status] for status in statuses),
+                            dtype=np.int8, count=len(rows)),
+                np.array(created, dtype='datetime64[s]').astype(np.int64),
+            )
+
+
+def demand_report(start_date, end_date, limit=10):
+    """Báo cáo cung/cầu cho khoảng ngày khám [start_date, end_date]."""
+    started = time.perf_counter()
+    accumulator = DemandAccumulator()
+    for chunk in stream_slots(start_date, end_date):
+        accumulator.add_chunk(*chunk)
+
+    size = accumulator.slots.shape[0]
+    slots, booked = accumulator.slots, accumulator.booked
+    tickets, cancelled = accumulator.tickets, accumulator.cancelled
+
+    # Gom theo chuyên khoa và bệnh viện (bảng nhỏ, nạp một lần)
+    pairs = np.array(db.session.query(DoctorDepartment.doctor_id, DoctorDepartment.department_id).all(),
+                     dtype=np.int64).reshape(-1, 2)
+    pairs = pairs[pairs[:, 0] < size]
+    centers = np.array([row for row in db.session.query(Doctor.id, Doctor.medical_center_id).all()
+                        if row[1] is not None and row[0] < size], dtype=np.int64).reshape(-1, 2)
+
+    def grouped(group_pairs, names):
+        group_size = int(group_pairs[:, 1].max()) + 1 if len(group_pairs) else 0
+        group_slots = _group(group_pairs[:, 0], group_pairs[:, 1], slots, group_size)
+        group_booked = _group(group_pairs[:, 0], group_pairs[:, 1], booked, group_size)
+        group_tickets = _group(group_pairs[:, 0], group_pairs[:, 1], tickets, group_size)
+        group_cancelled = _group(group_pairs[:, 0], group_pairs[:, 1], cancelled, group_size)
+        utilization = _ratio(group_booked, group_slots)
+        cancellation = _ratio(group_cancelled, group_tickets)
+        ids = np.flatnonzero(group_slots)
+        ids = ids[np.argsort(-utilization[ids], kind='stable')]
+        return [{'id': int(i), 'name': names.get(int(i), str(i)), 'slots': int(group_slots[i]),
+                 'booked': int(group_booked[i]), 'utilization': float(utilization[i]),
+                 'cancellation_rate': float(cancellation[i])} for i in ids]
+
+    snapshot = reference_data.get()
+    departments = grouped(pairs, snapshot.department_names())
+    medical_centers = grouped(centers, {center.id: center.name for center in snapshot.medical_centers})
+
+    utilization = _ratio(booked, slots)
+    cancellation = _ratio(cancelled, tickets)
+    doctor_ids = np.flatnonzero(slots)
+    order = doctor_ids[np.argsort(-utilization[doctor_ids], kind='stable')]
+    overbooked = order[utilization[order] >= OVERBOOKED_RATIO][:limit]
+    underbooked = order[::-1][utilization[order[::-1]] <= UNDERBOOKED_RATIO][:limit]
+
+    names = {user_id: f"{first_name} {last_name}" for user_id, first_name, last_name in db.session.query(
+        User.id, User.first_name, User.last_name
+    ).filter(User.id.in_([int(i) for i in np.concatenate([overbooked, underbooked])]))}
+
+    def doctor_rows(ids):
+        return [{'id': int(i), 'name': names.get(int(i), str(i)), 'slots': int(slots[i]), 'booked': int(booked[i]),
+                 'utilization': float(utilization[i]), 'cancellation_rate': float(cancellation[i])} for i in ids]
+
+    total_slots, total_booked = int(slots.sum()), int(booked.sum())
+    total_tickets, total_cancelled = int(tickets.sum()), int(cancelled.sum())
+    return {
+        'start_date': start_date,
+        'end_date': end_date,
+        'rows': accumulator.rows,
+        'seconds': round(time.perf_counter() - started, 3),
+        'slots': total_slots,
+        'booked': total_booked,
+        'utilization': total_booked / total_slots if total_slots else 0,
+        'cancellation_rate': total_cancelled / total_tickets if total_tickets else 0,
+        'lead_time_hours': accumulator.lead_time_percentiles(),
+        'heatmap': _ratio(accumulator.heatmap_booked, accumulator.heatmap_slots).reshape(7, 24).round(3).tolist(),
+        'heatmap_slots': accumulator.heatmap_slots.reshape(7, 24).tolist(),
+        'active_hours': np.flatnonzero(accumulator.heatmap_slots.reshape(7, 24).sum(axis=0)).tolist(),
+        'overbooked_doctors': doctor_rows(overbooked),
+        'underbooked_doctors': doctor_rows(underbooked),
+        'departments': departments,
+        'medical_centers': medical_centers,
+    }
+
+
+def _synthetic_benchmark(rows, chunk_size=CHUNK_SIZE):
+    """Đo tốc độ phần tính toán (không gồm đọc CSDL) với `rows` dòng ngẫu nhiên."""
+    rng = np.random.default_rng(0)
+    accumulator = DemandAccumulator()
+    today = np.datetime64(date.today(), 'D').astype(np.int64)
+    started = time.perf_counter()
+    for offset in range(0, rows, chunk_size):
+        n = min(chunk_size, rows - offset)
+        work_days = today + rng.integers(-30, 30, n)
+        statuses = rng.integers(NO_TICKET, len(STATUS_CODES), n).astype(np.int8)
+        created = work_days * 86400 - rng.integers(0, 30 * 86400, n)
+        accumulator.add_chunk(rng.zipf(1.5, n) % 50_000, work_days, rng.integers(7 * 60, 17 * 60, n),
+                              statuses, created)
+    elapsed = time.perf_counter() - started
+    print(f"{rows} dòng trong {elapsed:.2f}s ({rows / elapsed:,.0f} dòng/s); "
+          f"thời gian đặt trước p50/p90/p99 (giờ): {accumulator.lead_time_percentiles()}")
+
+
+if __name__ == '__main__':
+    if '--synthetic' in sys.argv:
+        _synthetic_benchmark(int(sys.argv[sys.argv.index('--synthetic') + 1]))
+    else:
+        args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+        start = datetime.strptime(args[0], '%Y-%m-%d').date() if args else date.today() - timedelta(days=30)
+        end = datetime.strptime(args[1], '%Y-%m-%d').date() if len(args) > 1 else date.today() + timedelta(days=30)
+        with app.app_context():
+            report = demand_report(start, end)
+            print(f"{report['rows']} khung giờ trong {report['seconds']}s; mức sử dụng {report['utilization']:.1%}, "
+                  f"tỉ lệ hủy {report['cancellation_rate']:.1%}, đặt trước p50/p90/p99 (giờ): "
+                  f"{report['lead_time_hours']}")
+            for row in report['departments']:
+                print(f"  - {row['name']}: {row['booked']}/{row['slots']} ({row['utilization']:.1%})")
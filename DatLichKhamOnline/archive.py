@@ -0,0 +1,225 @@
+# DatLichKhamOnline/archive.py
+# Lưu trữ dữ liệu cũ: ca làm việc (doctor_shifts) có ngày khám trước archive_cutoff() cùng vé của chúng được
+# chuyển sang doctor_shifts_archive/tickets_archive (giữ nguyên id và các cột; MySQL nén trang). Chạy đều đặn thì
+# các bảng nóng chỉ còn khoảng ARCHIVE_AFTER_DAYS ngày quá khứ cộng lịch tương lai – kích thước gần như không đổi.
+#
+# Việc chuyển chạy theo lô nhỏ, mỗi lô một giao dịch ngắn: chọn tối đa ARCHIVE_BATCH_SIZE ca cũ nhất theo chỉ mục
+# (work_date, doctor_id) – trọn từng (bác sĩ, ngày) –, INSERT ... SELECT sang bảng lưu trữ, xóa khỏi bảng nóng và
+# xóa các dòng doctor_availability của những ngày đó. Chỉ các dòng cũ bị khóa; giữa hai lô nghỉ ARCHIVE_PAUSE giây
+# để không chiếm CSDL.
+#
+# Thống kê cộng dồn (stat_counters, ticket_daily_stats, slot_daily_stats) là lịch sử nên không bị trừ khi lưu trữ;
+# stats_rollup.backfill và availability.rebuild_availability tính cả phần đã lưu trữ. Lịch sử đặt khám (index.py)
+# và analytics.stream_slots đọc thêm kho lưu trữ khi khoảng được hỏi chạm tới trước archive_cutoff().
+#
+# Cấu hình qua app.config:
+#   ARCHIVE_AFTER_DAYS  = số ngày (tính từ hôm nay) một ca còn ở bảng nóng. Không nên tăng sau khi đã lưu trữ:
+#                         các nơi đọc dựa vào việc mọi dòng đã lưu trữ đều trước archive_cutoff()
+#   ARCHIVE_WORKER      = 'off' (mặc định; chạy riêng theo lịch: python archive.py --once) | 'thread' (luồng nền
+#                         trong tiến trình web). Bật có chủ đích: trang quản trị Phiếu khám (Flask-Admin), trang
+#                         lịch hẹn của bác sĩ và luồng hủy/thanh toán vé chỉ đọc bảng nóng, vé đã lưu trữ không còn
+#                         hiện ở đó
+#   ARCHIVE_INTERVAL    = số giây giữa hai lần chạy
+#   ARCHIVE_BATCH_SIZE  = số ca tối đa mỗi lô
+#   ARCHIVE_PAUSE       = số giây nghỉ giữa hai lô
+import argparse
+import logging
+import threading
+import time
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import select, insert, delete, func, literal, tuple_
+
+from DatLichKhamOnline import app, db, sql_profiler
+from models import DoctorShift, Ticket, DoctorAvailability, DoctorShiftArchive, TicketArchive
+
+app.config.setdefault('ARCHIVE_AFTER_DAYS', 180)
+app.config.setdefault('ARCHIVE_WORKER', 'off')
+app.config.setdefault('ARCHIVE_INTERVAL', 24 * 60 * 60)
+app.config.setdefault('ARCHIVE_BATCH_SIZE', 5000)
+app.config.setdefault('ARCHIVE_PAUSE', 0.2)
+
+logger = logging.getLogger(__name__)
+
+doctor_shift_table = DoctorShift.__table__
+ticket_table = Ticket.__table__
+availability_table = DoctorAvailability.__table__
+shift_archive_table = DoctorShiftArchive.__table__
+ticket_archive_table = TicketArchive.__table__
+
+# Số id tối đa trong một điều kiện IN
+IN_CHUNK = 1000
+
+ArchiveRun = namedtuple('ArchiveRun', 'finished_at cutoff shifts tickets batches seconds')
+
+
+def archive_cutoff(today=None):
+    """Ngày khám nhỏ nhất còn ở bảng nóng: mọi ca trước ngày này (sẽ) nằm trong kho lưu trữ."""
+    return (today or date.today()) - timedelta(days=app.config['ARCHIVE_AFTER_DAYS'])
+
+
+def reaches_archive(start_date):
+    """Khoảng ngày bắt đầu từ start_date có thể có dữ liệu đã lưu trữ hay không."""
+    return start_date is None or start_date < archive_cutoff()
+
+
+def _chunks(ids):
+    for start in range(0, len(ids), IN_CHUNK):
+        yield ids[start:start + IN_CHUNK]
+
+
+def _select_batch(connection, cutoff, limit):
+    """Các ca cũ nhất trước `cutoff`: list (id, doctor_id, work_date), trọn từng (bác sĩ, ngày)."""
+    rows = connection.execute(
+        select(doctor_shift_table.c.id, doctor_shift_table.c.doctor_id, doctor_shift_table.c.work_date)
+        .where(doctor_shift_table.c.work_date < cutoff)
+        .order_by(doctor_shift_table.c.work_date, doctor_shift_table.c.doctor_id, doctor_shift_table.c.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    ).all()
+    if len(rows) == limit:
+        # (bác sĩ, ngày) cuối có thể bị cắt ngang – để dành cho lô sau, trừ khi cả lô chỉ có nó
+        last = (rows[-1].doctor_id, rows[-1].work_date)
+        whole = [row for row in rows if (row.doctor_id, row.work_date) != last]
+        rows = whole or rows
+    return rows
+
+
+def _move_batch(connection, rows):
+    """Chuyển các ca `rows` cùng vé của chúng sang kho lưu trữ. Trả về số vé đã chuyển."""
+    ids = [row.id for row in rows]
+    now = datetime.now()
+    shift_columns = [column.name for column in doctor_shift_table.columns]
+    ticket_columns = [column.name for column in ticket_table.columns]
+    moved_tickets = 0
+    for chunk in _chunks(ids):
+        connection.execute(insert(shift_archive_table).from_select(
+            shift_columns + ['archived_at'],
+            select(*doctor_shift_table.columns, literal(now)).where(doctor_shift_table.c.id.in_(chunk))))
+        connection.execute(insert(ticket_archive_table).from_select(
+            ticket_columns + ['archived_at'],
+            select(*ticket_table.columns, literal(now)).where(ticket_table.c.doctor_shift_id.in_(chunk))))
+        moved_tickets += connection.execute(
+            delete(ticket_table).where(ticket_table.c.doctor_shift_id.in_(chunk))).rowcount
+        connection.execute(delete(doctor_shift_table).where(doctor_shift_table.c.id.in_(chunk)))
+
+    # Chỉ mục ca trống của các ngày đã qua không còn dùng; slot_daily_stats giữ nguyên làm lịch sử
+    keys = {(row.doctor_id, row.work_date) for row in rows}
+    connection.execute(delete(availability_table).where(
+        availability_table.c.work_date.in_({work_date for _, work_date in keys}),
+        availability_table.c.doctor_id.in_({doctor_id for doctor_id, _ in keys}),
+        tuple_(availability_table.c.doctor_id, availability_table.c.work_date).in_(list(keys))))
+    return moved_tickets
+
+
+def archive_old(cutoff=None):
+    """Chuyển mọi ca trước `cutoff` sang kho lưu trữ, mỗi lô một giao dịch. Trả về ArchiveRun. Cần app context.
+
+    `cutoff` không được muộn hơn archive_cutoff() (giá trị mặc định) – các nơi đọc dựa vào điều đó."""
+    started = time.perf_counter()
+    cutoff = min(cutoff or archive_cutoff(), archive_cutoff())
+    limit = app.config['ARCHIVE_BATCH_SIZE']
+    shifts = tickets = batches = 0
+    while True:
+        connection = db.session.connection()
+        rows = _select_batch(connection, cutoff, limit)
+        if rows:
+            tickets += _move_batch(connection, rows)
+        db.session.commit()
+        if not rows:
+            break
+        shifts += len(rows)
+        batches += 1
+        time.sleep(app.config['ARCHIVE_PAUSE'])
+    run = ArchiveRun(datetime.now(), cutoff, shifts, tickets, batches, time.perf_counter() - started)
+    metrics.observe(run)
+    if shifts:
+        logger.info('Đã lưu trữ %d ca, %d vé trước %s (%d lô, %.2f s)', shifts, tickets, cutoff, batches, run.seconds)
+    return run
+
+
+def slot_day_totals(connection):
+    """{work_date: (số khung giờ, số khung giờ trống)} của các ngày đã lưu trữ – cho slot_daily_stats."""
+    booked = func.count(ticket_archive_table.c.id)
+    return {row.work_date: (row.slots, row.slots - row.booked)
+            for row in connection.execute(
+                select(shift_archive_table.c.work_date, func.count().label('slots'), booked.label('booked'))
+                .select_from(shift_archive_table.outerjoin(
+                    ticket_archive_table, ticket_archive_table.c.doctor_shift_id == shift_archive_table.c.id))
+                .group_by(shift_archive_table.c.work_date))}
+
+
+class ArchiveMetrics:
+    """Kết quả lần lưu trữ gần nhất (trong bộ nhớ tiến trình), xuất ra /metrics."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.shifts = 0
+        self.tickets = 0
+        self.last_run = None
+
+    def observe(self, run):
+        with self._lock:
+            self.shifts += run.shifts
+            self.tickets += run.tickets
+            self.last_run = run
+
+    def collect(self, family):
+        with self._lock:
+            family('mas_archive_moved_total', 'counter', 'Số dòng đã chuyển sang kho lưu trữ.',
+                   [f'mas_archive_moved_total{{table="doctor_shifts"}} {self.shifts}',
+                    f'mas_archive_moved_total{{table="tickets"}} {self.tickets}'])
+            if self.last_run:
+                family('mas_archive_last_run_seconds', 'gauge', 'Thời gian của lần lưu trữ gần nhất (giây).',
+                       [f'mas_archive_last_run_seconds {self.last_run.seconds:.6f}'])
+                family('mas_archive_last_run_timestamp_seconds', 'gauge', 'Thời điểm kết thúc lần lưu trữ gần nhất.',
+                       [f'mas_archive_last_run_timestamp_seconds {self.last_run.finished_at.timestamp():.0f}'])
+
+
+metrics = ArchiveMetrics()
+sql_profiler.metrics.register(metrics.collect)
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def _run_worker():
+    while True:
+        try:
+            with app.app_context():
+                archive_old()
+        except Exception:
+            logger.exception('Lưu trữ ca/vé cũ thất bại')
+        time.sleep(app.config['ARCHIVE_INTERVAL'])
+
+
+@app.before_request
+def _start_worker():
+    """Khởi động luồng lưu trữ ở request đầu tiên (không chạy khi TESTING)."""
+    global _worker
+    if _worker is not None or app.config['ARCHIVE_WORKER'] != 'thread' or app.testing:
+        return
+    with _worker_lock:
+        if _worker is None:
+            _worker = threading.Thread(target=_run_worker, name='archive', daemon=True)
+            _worker.start()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Chuyển ca/vé cũ sang kho lưu trữ')
+    parser.add_argument('--once', action='store_true', help='Chạy một lần rồi thoát')
+    parser.add_argument('--before', type=date.fromisoformat,
+                        help='Chỉ lưu trữ các ca trước ngày này (YYYY-MM-DD, không muộn hơn mốc ARCHIVE_AFTER_DAYS)')
+    args = parser.parse_args()
+    with app.app_context():
+        # Bảng lưu trữ và chỉ mục doctor_shifts(work_date, doctor_id) được thêm qua migration
+        from DatLichKhamOnline import migrations
+        migrations.upgrade()
+        while True:
+            run = archive_old(args.before)
+            print(f"{run.finished_at:%H:%M:%S} lưu trữ {run.shifts} ca, {run.tickets} vé trước {run.cutoff} "
+                  f"({run.batches} lô, {run.seconds:.2f} s)")
+            if args.once:
+                break
+            time.sleep(app.config['ARCHIVE_INTERVAL'])
@@ -0,0 +1,248 @@
+# DatLichKhamOnline/autocomplete.py
+# Gợi ý tìm kiếm trả lời hoàn toàn từ bộ nhớ cho /api/suggestions.
+# Tên bác sĩ, bệnh viện, chuyên khoa được nạp một lần vào các mảng khóa đã sắp xếp (đã bỏ dấu);
+# tra cứu tiền tố bằng bisect nên chỉ tốn O(log n + k). Mỗi tên được lập khóa tại mọi vị trí đầu từ
+# để "van" khớp "Nguyễn Văn A"; khớp ở đầu tên được xếp trước khớp ở giữa tên.
+# Các thay đổi qua session được áp dụng dần vào chỉ mục sau khi commit.
+#
+# Các tiến trình worker khác được báo qua file phiên bản AUTOCOMPLETE_VERSION_PATH (giống reference_data): tiến
+# trình commit thay đổi ghi lại file, các tiến trình còn lại so sánh mtime của file (tối đa mỗi
+# AUTOCOMPLETE_CHECK_INTERVAL giây) và nạp lại toàn bộ khi file đổi hoặc snapshot reference_data đổi (bệnh viện,
+# chuyên khoa). Thao tác hàng loạt không qua ORM (bulk_import) phải gọi invalidate().
+import os
+import tempfile
+import threading
+import time
+import uuid
+from bisect import bisect_left, insort
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+
+from DatLichKhamOnline import app, db, reference_data
+from DatLichKhamOnline.utils import tokenize
+from models import User, UserRole, MedicalCenter, Department
+
+app.config.setdefault('AUTOCOMPLETE_VERSION_PATH', os.path.join(tempfile.gettempdir(), 'mas_autocomplete.version'))
+app.config.setdefault('AUTOCOMPLETE_CHECK_INTERVAL', 1.0)
+
+DOCTOR = 'doctor'
+CENTER = 'center'
+DEPARTMENT = 'department'
+
+# Số gợi ý tối đa và hậu tố hiển thị cho từng loại, giữ nguyên như phiên bản truy vấn trực tiếp
+LIMITS = {DOCTOR: 5, CENTER: 3, DEPARTMENT: 3}
+LABEL_SUFFIXES = {DOCTOR: 'Bác sĩ', CENTER: 'Bệnh viện', DEPARTMENT: 'Chuyên khoa'}
+
+
+class SuggestionIndex:
+    def __init__(self):
+        # kind -> (khóa bắt đầu từ từ đầu tiên, khóa bắt đầu từ các từ sau); mỗi phần tử là (khóa, entity_id)
+        self._keys = {kind: ([], []) for kind in LIMITS}
+        self._labels = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._labels)
+
+    @staticmethod
+    def _keys_for(text):
+        words = tokenize(text)
+        return [' '.join(words[i:]) for i in range(len(words))]
+
+    def load(self, items):
+        """Nạp toàn bộ từ danh sách (kind, entity_id, text) rồi sắp xếp một lần."""
+        keys = {kind: ([], []) for kind in LIMITS}
+        labels = {}
+        for kind, entity_id, text in items:
+            labels[(kind, entity_id)] = text
+            for position, key in enumerate(self._keys_for(text)):
+                keys[kind][min(position, 1)].append((key, entity_id))
+        for first_word_keys, later_word_keys in keys.values():
+            first_word_keys.sort()
+            later_word_keys.sort()
+        with self._lock:
+            self._keys, self._labels = keys, labels
+
+    def _remove_locked(self, kind, entity_id):
+        text = self._labels.pop((kind, entity_id), None)
+        if text is None:
+            return
+        for position, key in enumerate(self._keys_for(text)):
+            array = self._keys[kind][min(position, 1)]
+            i = bisect_left(array, (key, entity_id))
+            if i < len(array) and array[i] == (key, entity_id):
+                del array[i]
+
+    def upsert(self, kind, entity_id, text):
+        with self._lock:
+            self._remove_locked(kind, entity_id)
+            self._labels[(kind, entity_id)] = text
+            for position, key in enumerate(self._keys_for(text)):
+                insort(self._keys[kind][min(position, 1)], (key, entity_id))
+
+    def remove(self, kind, entity_id):
+        with self._lock:
+            self._remove_locked(kind, entity_id)
+
+    def lookup(self, query, kind, limit):
+        """Tối đa `limit` tên thuộc loại `kind` có một từ bắt đầu bằng query (đã bỏ dấu)."""
+        prefix = ' '.join(tokenize(query))
+        if not prefix:
+            return []
+        found = []
+        seen = set()
+        with self._lock:
+            for array in self._keys[kind]:
+                i = bisect_left(array, (prefix,))
+                while i < len(array) and len(found) < limit:
+                    key, entity_id = array[i]
+                    if not key.startswith(prefix):
+                        break
+                    if entity_id not in seen:
+                        seen.add(entity_id)
+                        found.append(self._labels[(kind, entity_id)])
+                    i += 1
+        return found
+
+    def suggest(self, query):
+        suggestions = []
+        for kind, limit in LIMITS.items():
+            suggestions.extend(f"{label} - {LABEL_SUFFIXES[kind]}" for label in self.lookup(query, kind, limit))
+        return suggestions
+
+
+_index = SuggestionIndex()
+_loaded = False
+_stale = True
+_version_mtime = None
+_snapshot = None
+_checked_at = 0.0
+_load_lock = threading.Lock()
+
+
+def _doctor_name(first_name, last_name):
+    return f"{first_name} {last_name}"
+
+
+def _version_file_mtime():
+    try:
+        return os.stat(app.config['AUTOCOMPLETE_VERSION_PATH']).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _touch_version_file():
+    """Ghi nội dung mới vào file phiên bản; trả về mtime mới."""
+    path = app.config['AUTOCOMPLETE_VERSION_PATH']
+    temporary = f'{path}.{uuid.uuid4().hex}'
+    with open(temporary, 'w') as file:
+        file.write(uuid.uuid4().hex)
+    os.replace(temporary, path)
+    return _version_file_mtime()
+
+
+def load_index():
+    """Nạp (lại) toàn bộ chỉ mục từ CSDL."""
+    global _loaded, _stale, _version_mtime, _snapshot
+    # Đọc mtime trước khi truy vấn: nếu file đổi trong lúc nạp, lần kiểm tra sau sẽ nạp lại
+    version_mtime = _version_file_mtime()
+    items = [(DOCTOR, user_id, _doctor_name(first_name, last_name))
+             for user_id, first_name, last_name in db.session.query(User.id, User.first_name, User.last_name)
+             .filter(User.role == UserRole.DOCTOR)]
+    snapshot = reference_data.get()
+    items += [(CENTER, center.id, center.name) for center in snapshot.medical_centers]
+    items += [(DEPARTMENT, department.id, department.name) for department in snapshot.departments]
+    _index.load(items)
+    _version_mtime, _snapshot = version_mtime, snapshot
+    _loaded, _stale = True, False
+    return _index
+
+
+def get_index():
+    """Chỉ mục hiện tại; tự nạp lại khi bị đánh dấu cũ hoặc tiến trình khác báo thay đổi."""
+    global _stale, _checked_at
+    now = time.monotonic()
+    if not _stale and now - _checked_at >= app.config['AUTOCOMPLETE_CHECK_INTERVAL']:
+        _checked_at = now
+        if _version_file_mtime() != _version_mtime or reference_data.get() is not _snapshot:
+            _stale = True
+    if _stale:
+        with _load_lock:
+            if _stale:
+                load_index()
+    return _index
+
+
+def invalidate(notify=True):
+    """Đánh dấu chỉ mục cũ; `notify` ghi file phiên bản để các tiến trình khác cũng nạp lại."""
+    global _stale
+    _stale = True
+    if notify:
+        _touch_version_file()
+
+
+def suggest(query):
+    return get_index().suggest(query)
+
+
+def _is_doctor_role(role):
+    return role in (UserRole.DOCTOR, UserRole.DOCTOR.value)
+
+
+def _is_doctor(user):
+    return _is_doctor_role(user.role)
+
+
+def _touches_doctors(user):
+    """User hiện là bác sĩ hoặc vừa thôi là bác sĩ. Chỉ những user này có trong chỉ mục – đăng ký bệnh nhân hay sửa hồ
+    sơ bệnh nhân không được ghi file phiên bản, nếu không mọi tiến trình khác phải nạp lại toàn bộ sau mỗi lần đó."""
+    return _is_doctor(user) or any(_is_doctor_role(role) for role in get_history(user, 'role').deleted)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changes(session, flush_context):
+    """Ghi nhận thay đổi trong session.info; chỉ áp dụng vào chỉ mục khi giao dịch được commit."""
+    if not _loaded:
+        return
+    changes = session.info.setdefault('autocomplete_changes', [])
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            if _touches_doctors(obj):
+                changes.append((DOCTOR, obj.id, None))
+        elif isinstance(obj, MedicalCenter):
+            changes.append((CENTER, obj.id, None))
+        elif isinstance(obj, Department):
+            changes.append((DEPARTMENT, obj.id, None))
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, User):
+            if not _touches_doctors(obj):
+                continue
+            if obj in session.new or any(get_history(obj, attr).has_changes()
+                                         for attr in ('first_name', 'last_name', 'role')):
+                name = _doctor_name(obj.first_name, obj.last_name) if _is_doctor(obj) else None
+                changes.append((DOCTOR, obj.id, name))
+        elif isinstance(obj, MedicalCenter) and (obj in session.new or get_history(obj, 'name').has_changes()):
+            changes.append((CENTER, obj.id, obj.name))
+        elif isinstance(obj, Department) and (obj in session.new or get_history(obj, 'name').has_changes()):
+            changes.append((DEPARTMENT, obj.id, obj.name))
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_changes(session):
+    global _version_mtime
+    changes = session.info.pop('autocomplete_changes', [])
+    for kind, entity_id, text in changes:
+        if text is None:
+            _index.remove(kind, entity_id)
+        else:
+            _index.upsert(kind, entity_id, text)
+    if changes:
+        # Tiến trình này đã cập nhật dần; chỉ các tiến trình khác cần nạp lại
+        _version_mtime = _touch_version_file()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_changes(session, previous_transaction):
+    session.info.pop('autocomplete_changes', None)
@@ -0,0 +1,327 @@
+# DatLichKhamOnline/availability.py
+# Chỉ mục khung giờ còn trống: mỗi (doctor_id, work_date) là một dòng trong bảng doctor_availability,
+# với free_mask là bitmap các ca còn trống trong ngày. Trang đặt lịch đọc bảng này thay vì
+# chạy phép DoctorShift JOIN Shift OUTER JOIN Ticket mỗi lần tải trang.
+# slot_count (tổng số ca trong ngày) cùng free_count cũng nuôi bảng thống kê slot_daily_stats.
+# Bit của mỗi ca là Shift.bit – gán một lần khi tạo ca và không đổi khi sửa giờ – nên thêm/sửa ca
+# không làm sai lệch các bitmap đã có (không phải dựng lại cả bảng trong giao dịch của admin).
+import base64
+import sys
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import event, select, delete, insert, and_, exists
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+
+from DatLichKhamOnline import app, db, stats_rollup, archive
+from models import DoctorAvailability, DoctorShift, Shift, Ticket, Doctor, DoctorDepartment, User
+
+availability_table = DoctorAvailability.__table__
+doctor_shift_table = DoctorShift.__table__
+ticket_table = Ticket.__table__
+shift_table = Shift.__table__
+
+
+def shift_bits(connection):
+    """Trả về dict shift_id -> vị trí bit của ca trong free_mask, theo thứ tự giờ bắt đầu."""
+    rows = connection.execute(
+        select(shift_table.c.id, shift_table.c.bit).where(shift_table.c.bit.isnot(None))
+        .order_by(shift_table.c.start_time, shift_table.c.id)
+    ).all()
+    return {row.id: row.bit for row in rows}
+
+
+def free_shift_bits(connection):
+    """Các vị trí bit chưa ca nào dùng, từ nhỏ tới lớn (bit của ca đã xóa được dùng lại: ca đó không còn trong
+    doctor_shifts nên không bitmap nào còn bật bit này)."""
+    used = set(connection.execute(select(shift_table.c.bit).where(shift_table.c.bit.isnot(None))).scalars())
+    bit = 0
+    while True:
+        if bit not in used:
+            yield bit
+        bit += 1
+
+
+def mask_to_shift_ids(mask, bits):
+    """Chuyển bitmap thành danh sách shift_id, theo thứ tự của `bits` (reference_data: giờ bắt đầu)."""
+    return [shift_id for shift_id, bit in bits.items() if mask >> bit & 1]
+
+
+def to_time_order(mask, bits):
+    """Bitmap theo Shift.bit -> bitmap mà bit i ứng với ca thứ i theo giờ bắt đầu (dạng trả về của API)."""
+    if all(bit == ordinal for ordinal, bit in enumerate(bits.values())):
+        return mask
+    return sum(1 << ordinal for ordinal, bit in enumerate(bits.values()) if mask >> bit & 1)
+
+
+def pack_masks(masks, width):
+    """Ghép các bitmap thành chuỗi base64url (mỗi bitmap `width` byte, little-endian) – dạng gọn cho JSON."""
+    raw = b''.join(mask.to_bytes(width, 'little') for mask in masks)
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def count_bits(mask):
+    return bin(mask).count('1')
+
+
+def lock_days(connection, doctor_id, dates):
+    """Khóa các ca của bác sĩ trong các ngày `dates` (SELECT ... FOR UPDATE, theo thứ tự id) cho tới hết giao dịch.
+
+    Hai giao dịch cùng sửa một (bác sĩ, ngày) – ví dụ hai lượt đặt hai ca khác nhau – được xếp hàng tại đây, nên
+    giao dịch sau tính bitmap sau khi giao dịch trước đã commit thay vì ghi đè bằng bitmap cũ."""
+    connection.execute(
+        select(doctor_shift_table.c.id)
+        .where(doctor_shift_table.c.doctor_id == doctor_id, doctor_shift_table.c.work_date.in_(dates))
+        .order_by(doctor_shift_table.c.id)
+        .with_for_update())
+
+
+def _compute_masks(connection, doctor_id, dates, bits):
+    """Tính lại (bitmap, số ca) cho các ngày của một bác sĩ trực tiếp từ doctor_shifts/tickets."""
+    query = (
+        select(doctor_shift_table.c.work_date, doctor_shift_table.c.shift_id, ticket_table.c.id.label('ticket_id'))
+        .select_from(doctor_shift_table.outerjoin(ticket_table,
+                                                  ticket_table.c.doctor_shift_id == doctor_shift_table.c.id))
+        .where(doctor_shift_table.c.doctor_id == doctor_id, doctor_shift_table.c.work_date.in_(dates))
+    )
+    if connection.dialect.name == 'mysql':
+        # InnoDB REPEATABLE READ: SELECT thường đọc snapshot đầu giao dịch; đọc có khóa mới thấy vé vừa commit
+        query = query.with_for_update(read=True)
+    rows = connection.execute(query).all()
+    masks = {}
+    for row in rows:
+        mask, slots = masks.get(row.work_date, (0, 0))
+        if row.ticket_id is None and row.shift_id in bits:
+            mask |= 1 << bits[row.shift_id]
+        masks[row.work_date] = (mask, slots + 1)
+    return masks
+
+
+def refresh_availability(connection, keys):
+    """Tính lại chỉ mục cho các cặp (doctor_id, work_date) bị ảnh hưởng.
+
+    Dùng cho các thao tác đi vòng qua session ORM (bulk insert/delete) – các thay đổi qua
+    session đã được cập nhật tự động trong sự kiện after_flush bên dưới.
+    """
+    dates_by_doctor = defaultdict(set)
+    for doctor_id, work_date in keys:
+        dates_by_doctor[doctor_id].add(work_date)
+    if not dates_by_doctor:
+        return
+
+    bits = shift_bits(connection)
+    now = datetime.now()
+    slot_deltas = defaultdict(lambda: [0, 0])
+    # Khóa theo thứ tự bác sĩ để hai giao dịch chạm cùng nhiều bác sĩ không khóa chéo nhau
+    for doctor_id, dates in sorted(dates_by_doctor.items()):
+        lock_days(connection, doctor_id, dates)
+        masks = _compute_masks(connection, doctor_id, dates, bits)
+        where = (availability_table.c.doctor_id == doctor_id, availability_table.c.work_date.in_(dates))
+        for row in connection.execute(select(availability_table.c.work_date, availability_table.c.slot_count,
+                                             availability_table.c.free_count).where(*where).with_for_update()):
+            slot_deltas[row.work_date][0] -= row.slot_count
+            slot_deltas[row.work_date][1] -= row.free_count
+        connection.execute(delete(availability_table).where(*where))
+        if masks:
+            rows = [{'doctor_id': doctor_id, 'work_date': work_date, 'free_mask': mask,
+                     'free_count': count_bits(mask), 'slot_count': slots, 'updated_at': now}
+                    for work_date, (mask, slots) in masks.items()]
+            connection.execute(insert(availability_table), rows)
+            for row in rows:
+                slot_deltas[row['work_date']][0] += row['slot_count']
+                slot_deltas[row['work_date']][1] += row['free_count']
+    stats_rollup.add_slot_stats(connection, slot_deltas)
+
+
+def _expected_index(connection, since=None):
+    """Dựng lại toàn bộ chỉ mục (hoặc từ ngày `since`) từ doctor_shifts/tickets: {(doctor_id, work_date): (mask, số ca)}."""
+    bits = shift_bits(connection)
+    query = select(
+        doctor_shift_table.c.doctor_id, doctor_shift_table.c.work_date,
+        doctor_shift_table.c.shift_id, ticket_table.c.id.label('ticket_id')
+    ).select_from(doctor_shift_table.outerjoin(ticket_table,
+                                               ticket_table.c.doctor_shift_id == doctor_shift_table.c.id))
+    if since:
+        query = query.where(doctor_shift_table.c.work_date >= since)
+
+    expected = {}
+    for row in connection.execution_options(yield_per=5000).execute(query):
+        key = (row.doctor_id, row.work_date)
+        mask, slots = expected.get(key, (0, 0))
+        if row.ticket_id is None and row.shift_id in bits:
+            mask |= 1 << bits[row.shift_id]
+        expected[key] = (mask, slots + 1)
+    return expected
+
+
+def check_availability(since=None, repair=False):
+    """So sánh chỉ mục với dữ liệu gốc và trả về danh sách sai lệch.
+
+    Mỗi phần tử là (doctor_id, work_date, mask_mong_đợi, mask_hiện_tại); None nghĩa là thiếu dòng.
+    Nếu repair=True, các dòng sai lệch được ghi lại theo dữ liệu gốc.
+    """
+    connection = db.session.connection()
+    expected = _expected_index(connection, since)
+
+    query = select(availability_table.c.doctor_id, availability_table.c.work_date,
+                   availability_table.c.free_mask, availability_table.c.slot_count)
+    if since:
+        query = query.where(availability_table.c.work_date >= since)
+    actual = {(row.doctor_id, row.work_date): (row.free_mask, row.slot_count) for row in connection.execute(query)}
+
+    drift = []
+    for key in expected.keys() | actual.keys():
+        if expected.get(key) != actual.get(key):
+            drift.append((key[0], key[1], (expected.get(key) or (None,))[0], (actual.get(key) or (None,))[0]))
+    drift.sort(key=lambda item: (item[0], item[1]))
+
+    if repair and drift:
+        refresh_availability(connection, [(doctor_id, work_date) for doctor_id, work_date, _, _ in drift])
+        db.session.commit()
+    return drift
+
+
+def _write_index(connection, expected):
+    connection.execute(delete(availability_table))
+    now = datetime.now()
+    rows = [{'doctor_id': doctor_id, 'work_date': work_date, 'free_mask': mask,
+             'free_count': count_bits(mask), 'slot_count': slots, 'updated_at': now}
+            for (doctor_id, work_date), (mask, slots) in expected.items()]
+    day_totals = defaultdict(lambda: (0, 0))
+    for start in range(0, len(rows), 5000):
+        connection.execute(insert(availability_table), rows[start:start + 5000])
+    for row in rows:
+        slots, free = day_totals[row['work_date']]
+        day_totals[row['work_date']] = (slots + row['slot_count'], free + row['free_count'])
+    # Các ngày đã lưu trữ không còn trong chỉ mục nhưng vẫn thuộc lịch sử slot_daily_stats
+    for work_date, (archived_slots, archived_free) in archive.slot_day_totals(connection).items():
+        slots, free = day_totals[work_date]
+        day_totals[work_date] = (slots + archived_slots, free + archived_free)
+    stats_rollup.rebuild_slot_stats(connection, day_totals)
+    return len(rows)
+
+
+def rebuild_index(connection):
+    """Xóa và dựng lại toàn bộ chỉ mục trong giao dịch của `connection`; trả về số dòng."""
+    return _write_index(connection, _expected_index(connection))
+
+
+def rebuild_availability():
+    """Xóa và dựng lại toàn bộ chỉ mục."""
+    count = rebuild_index(db.session.connection())
+    db.session.commit()
+    return count
+
+
+def available_days(doctor_id, start_date, end_date):
+    """Các ngày còn khung trống của bác sĩ trong khoảng [start_date, end_date]: list (work_date, free_mask)."""
+    rows = db.session.query(DoctorAvailability.work_date, DoctorAvailability.free_mask).filter(
+        DoctorAvailability.doctor_id == doctor_id,
+        DoctorAvailability.work_date >= start_date,
+        DoctorAvailability.work_date <= end_date,
+        DoctorAvailability.free_count > 0
+    ).order_by(DoctorAvailability.work_date).all()
+    return [(row.work_date, row.free_mask) for row in rows]
+
+
+def availability_matrix(start_date, days, department_id=None, medical_center_id=None, after_doctor_id=None,
+                        limit=50):
+    """Ca trống của nhiều bác sĩ trong `days` ngày kể từ start_date, bằng một câu SQL.
+
+    Bác sĩ được lọc theo chuyên khoa/bệnh viện và lấy theo id tăng dần (tối đa `limit`, sau after_doctor_id).
+    Trả về (list (doctor_id, first_name, last_name, medical_center_id, [free_mask của từng ngày]), còn trang sau).
+    """
+    end_date = start_date + timedelta(days=days - 1)
+    # Bảng dẫn xuất thay vì IN (... LIMIT) – MySQL không hỗ trợ LIMIT trong truy vấn con IN
+    doctors = select(Doctor.id).order_by(Doctor.id).limit(limit + 1)
+    if medical_center_id:
+        doctors = doctors.where(Doctor.medical_center_id == medical_center_id)
+    if department_id:
+        doctors = doctors.where(exists().where(DoctorDepartment.doctor_id == Doctor.id,
+                                               DoctorDepartment.department_id == department_id))
+    if after_doctor_id:
+        doctors = doctors.where(Doctor.id > after_doctor_id)
+    doctors = doctors.subquery()
+
+    rows = db.session.query(
+        User.id, User.first_name, User.last_name, Doctor.medical_center_id,
+        DoctorAvailability.work_date, DoctorAvailability.free_mask
+    ).select_from(doctors).join(User, User.id == doctors.c.id).join(Doctor, Doctor.id == doctors.c.id).outerjoin(
+        DoctorAvailability, and_(DoctorAvailability.doctor_id == doctors.c.id,
+                                 DoctorAvailability.work_date >= start_date,
+                                 DoctorAvailability.work_date <= end_date,
+                                 DoctorAvailability.free_count > 0)
+    ).order_by(User.id).all()
+
+    matrix = {}
+    for row in rows:
+        if row.id not in matrix:
+            matrix[row.id] = (row.id, row.first_name, row.last_name, row.medical_center_id, [0] * days)
+        if row.work_date is not None:
+            matrix[row.id][4][(row.work_date - start_date).days] = row.free_mask
+    result = list(matrix.values())
+    return result[:limit], len(result) > limit
+
+
+@event.listens_for(Session, 'before_flush')
+def _assign_shift_bits(session, flush_context, instances):
+    """Gán Shift.bit cho các ca mới (theo giờ bắt đầu) bằng các vị trí bit còn trống."""
+    new_shifts = sorted((obj for obj in session.new if isinstance(obj, Shift) and obj.bit is None),
+                        key=lambda shift: shift.start_time)
+    if new_shifts:
+        for shift, bit in zip(new_shifts, free_shift_bits(session.connection())):
+            shift.bit = bit
+
+
+@event.listens_for(Session, 'after_flush')
+def _sync_availability(session, flush_context):
+    """Cập nhật chỉ mục cho những ngày có DoctorShift/Ticket vừa thay đổi trong lần flush này.
+
+    Thêm/sửa Shift không cần làm gì: bit của ca cố định. Xóa ca kéo theo xóa/sửa DoctorShift của nó – phần đó
+    được cập nhật như mọi thay đổi DoctorShift khác.
+    """
+    changed = list(session.new) + list(session.dirty) + list(session.deleted)
+    if not any(isinstance(obj, (DoctorShift, Ticket)) for obj in changed):
+        return
+
+    connection = session.connection()
+
+    keys = set()
+    doctor_shift_ids = set()
+    for obj in changed:
+        if isinstance(obj, DoctorShift):
+            keys.add((obj.doctor_id, obj.work_date))
+            doctor_ids = get_history(obj, 'doctor_id').deleted or [obj.doctor_id]
+            work_dates = get_history(obj, 'work_date').deleted or [obj.work_date]
+            keys.update((doctor_id, work_date) for doctor_id in doctor_ids for work_date in work_dates)
+        elif isinstance(obj, Ticket):
+            history = get_history(obj, 'doctor_shift_id')
+            # Đổi trạng thái vé không làm thay đổi tình trạng trống của ca
+            if obj in session.dirty and not history.has_changes():
+                continue
+            doctor_shift_ids.add(obj.doctor_shift_id)
+            doctor_shift_ids.update(history.deleted)
+
+    doctor_shift_ids.discard(None)
+    if doctor_shift_ids:
+        keys.update(connection.execute(
+            select(doctor_shift_table.c.doctor_id, doctor_shift_table.c.work_date)
+            .where(doctor_shift_table.c.id.in_(doctor_shift_ids))
+        ).tuples())
+    refresh_availability(connection, {key for key in keys if None not in key})
+
+
+if __name__ == '__main__':
+    # python availability.py [--repair | --rebuild] [YYYY-MM-DD]
+    with app.app_context():
+        db.create_all()  # Chỉ tạo các bảng còn thiếu
+        if '--rebuild' in sys.argv:
+            print(f"Đã dựng lại {rebuild_availability()} dòng chỉ mục.")
+        else:
+            args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+            since = datetime.strptime(args[0], '%Y-%m-%d').date() if args else date.today()
+            drift = check_availability(since=since, repair='--repair' in sys.argv)
+            for doctor_id, work_date, expected_mask, actual_mask in drift:
+                print(f"  - Bác sĩ {doctor_id}, ngày {work_date}: mong đợi {expected_mask}, hiện tại {actual_mask}")
+            print(f"Phát hiện {len(drift)} dòng sai lệch" + (" (đã sửa)." if '--repair' in sys.argv else "."))
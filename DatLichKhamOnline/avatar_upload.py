@@ -0,0 +1,261 @@
+# DatLichKhamOnline/avatar_upload.py
+# Tải ảnh đại diện ở chế độ nền: request chỉ lưu file vào thư mục tạm (staging, ngoài static – file gốc chưa được
+# mã hóa lại nên không bao giờ được phục vụ công khai), ghi tên job vào User.avatar_pending rồi trả về; User.avatar
+# giữ ảnh cũ cho tới khi có ảnh mới. Một nhóm luồng (worker pool) tạo ảnh thu nhỏ ở các kích thước mà giao diện dùng,
+# tải tất cả lên backend lưu trữ rồi thay User.avatar bằng URL cuối cùng và xóa avatar_pending.
+#
+# Trạng thái "đang xử lý" nằm trong CSDL nên mọi tiến trình web đều thấy như nhau. Job của một tiến trình đã chết
+# (avatar_pending còn đó quá AVATAR_STALE_AFTER giây) được recover() chạy lại từ file tạm, hoặc bỏ (giữ ảnh cũ) nếu
+# file tạm không còn. Với nhiều máy chủ, AVATAR_STAGING_DIR phải là thư mục dùng chung.
+#
+# Cấu hình qua app.config:
+#   AVATAR_BACKEND      = 'cloudinary' | 'local' (lưu vào static/uploads/avatars, dùng khi thử nghiệm)
+#   AVATAR_WORKERS      = số luồng xử lý; 0 = xử lý ngay trong request (đồng bộ)
+#   AVATAR_MAX_BYTES    = dung lượng tối đa của file tải lên; MAX_CONTENT_LENGTH mặc định theo giá trị này để
+#                         Werkzeug từ chối (413) request quá lớn trước khi đọc hết vào đĩa
+#   AVATAR_STAGING_DIR  = thư mục tạm (mặc định instance/avatar_staging)
+#   AVATAR_STALE_AFTER  = số giây sau đó một job còn treo được coi là của tiến trình đã chết
+import logging
+import os
+import re
+import shutil
+import threading
+import uuid
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+from flask import flash, redirect, request
+from werkzeug.exceptions import RequestEntityTooLarge
+from cloudinary import uploader, CloudinaryImage
+
+from DatLichKhamOnline import app, db
+from models import User
+
+app.config.setdefault('AVATAR_BACKEND', 'cloudinary')
+app.config.setdefault('AVATAR_WORKERS', 2)
+app.config.setdefault('AVATAR_MAX_BYTES', 5 * 1024 * 1024)
+app.config.setdefault('AVATAR_STAGING_DIR', os.path.join(app.instance_path, 'avatar_staging'))
+app.config.setdefault('AVATAR_STALE_AFTER', 15 * 60)
+# Flask luôn có khóa MAX_CONTENT_LENGTH (mặc định None = không giới hạn). Chừa 64 KB cho các trường khác của form
+if app.config.get('MAX_CONTENT_LENGTH') is None:
+    app.config['MAX_CONTENT_LENGTH'] = app.config['AVATAR_MAX_BYTES'] + 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+LOCAL_DIR = os.path.join(app.static_folder, 'uploads', 'avatars')
+# Kích thước hiển thị (px) trong các template: header 32, book_appointment/medical_center_details 120,
+# doctor_list/trang hồ sơ 150, doctor_details 180. Ảnh được tạo gấp đôi cho màn hình mật độ cao.
+THUMBNAIL_SIZES = (32, 120, 150, 180)
+ORIGINAL_SIZE = 512
+# Tên file do pipeline tạo ra: av-<32 ký tự hex>.jpg; ảnh thu nhỏ: av-<hex>_<kích thước>.jpg
+AVATAR_NAME = re.compile(r'(av-[0-9a-f]{32})\.jpg$')
+
+
+class LocalBackend:
+    """Lưu ảnh vào static/uploads/avatars – thay thế Cloudinary khi chạy thử nghiệm."""
+
+    def __init__(self, directory=LOCAL_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def upload(self, path, name):
+        shutil.copyfile(path, os.path.join(self.directory, f'{name}.jpg'))
+        return f"{app.static_url_path}/uploads/avatars/{name}.jpg"
+
+
+class CloudinaryBackend:
+    def upload(self, path, name):
+        uploader.upload(path, public_id=f'avatars/{name}', overwrite=True, format='jpg')
+        # URL không kèm version để ảnh thu nhỏ có thể suy ra từ URL ảnh gốc
+        return CloudinaryImage(f'avatars/{name}').build_url(secure=True, format='jpg')
+
+
+BACKENDS = {'local': LocalBackend, 'cloudinary': CloudinaryBackend}
+_backend = None
+_executor = None
+_lock = threading.Lock()
+_recovered = False
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = BACKENDS[app.config['AVATAR_BACKEND']]()
+    return _backend
+
+
+def set_backend(backend):
+    """Thay backend lưu trữ (ví dụ LocalBackend khi thử nghiệm)."""
+    global _backend
+    _backend = backend
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=app.config['AVATAR_WORKERS'],
+                                           thread_name_prefix='avatar-upload')
+        return _executor
+
+
+def thumbnail_url(url, size):
+    """URL ảnh thu nhỏ kích thước `size` của một avatar; ảnh không do pipeline tạo thì giữ nguyên URL."""
+    if not url or size not in THUMBNAIL_SIZES:
+        return url
+    return AVATAR_NAME.sub(rf'\1_{size}.jpg', url)
+
+
+@app.template_filter('avatar_thumb')
+def avatar_thumb_filter(url, size):
+    return thumbnail_url(url, size)
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def _upload_too_large(error):
+    flash('Lỗi khi tải lên: dữ liệu vượt quá dung lượng cho phép.', 'danger')
+    return redirect(request.path)
+
+
+def _staging_dir():
+    return app.config['AVATAR_STAGING_DIR']
+
+
+def _staged_path(name):
+    return os.path.join(_staging_dir(), f'{name}.upload')
+
+
+class AvatarJob:
+    __slots__ = ('user_id', 'name', 'staged_path')
+
+    def __init__(self, user_id, name, staged_path):
+        self.user_id = user_id
+        self.name = name
+        self.staged_path = staged_path
+
+
+def stage_avatar(user, file):
+    """Lưu file tải lên vào thư mục tạm và đánh dấu user đang chờ ảnh mới (User.avatar giữ nguyên ảnh cũ).
+
+    Trả về AvatarJob cần được đưa vào hàng đợi bằng submit() SAU KHI commit.
+    Ném ValueError nếu file quá lớn hoặc không phải ảnh.
+    """
+    os.makedirs(_staging_dir(), exist_ok=True)
+    name = f'av-{uuid.uuid4().hex}'
+    staged_path = _staged_path(name)
+    file.save(staged_path)
+    try:
+        if os.path.getsize(staged_path) > app.config['AVATAR_MAX_BYTES']:
+            raise ValueError('Ảnh vượt quá dung lượng cho phép.')
+        with Image.open(staged_path) as image:
+            image.verify()
+    except ValueError:
+        os.remove(staged_path)
+        raise
+    except Exception:
+        os.remove(staged_path)
+        raise ValueError('File tải lên không phải là ảnh hợp lệ.')
+
+    user.avatar_pending = name
+    return AvatarJob(user.id, name, staged_path)
+
+
+def submit(job):
+    """Đưa job vào nhóm luồng xử lý (hoặc chạy ngay nếu AVATAR_WORKERS = 0)."""
+    if app.config['AVATAR_WORKERS'] <= 0:
+        process(job)
+    else:
+        _get_executor().submit(process, job)
+
+
+def discard(job):
+    """Bỏ job khi request không commit được."""
+    if os.path.exists(job.staged_path):
+        os.remove(job.staged_path)
+
+
+def is_pending(user):
+    return user.avatar_pending is not None
+
+
+def _render(source, size):
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image).convert('RGB')
+        return ImageOps.fit(image, (size, size), Image.LANCZOS)
+
+
+def process(job):
+    """Tạo ảnh thu nhỏ, tải lên backend rồi thay URL tạm bằng URL cuối cùng."""
+    backend = get_backend()
+    work_dir = os.path.join(_staging_dir(), job.name)
+    try:
+        os.makedirs(work_dir, exist_ok=True)
+        original = os.path.join(work_dir, 'original.jpg')
+        _render(job.staged_path, ORIGINAL_SIZE).save(original, 'JPEG', quality=88)
+        for size in THUMBNAIL_SIZES:
+            path = os.path.join(work_dir, f'{size}.jpg')
+            _render(job.staged_path, size * 2).save(path, 'JPEG', quality=85)
+            backend.upload(path, f'{job.name}_{size}')
+        final_url = backend.upload(original, job.name)
+        _swap_avatar(job, final_url)
+    except Exception:
+        logger.exception('Tải ảnh đại diện của người dùng %s thất bại', job.user_id)
+        _swap_avatar(job, None)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if os.path.exists(job.staged_path):
+            os.remove(job.staged_path)
+
+
+def _swap_avatar(job, url):
+    # Chỉ thay nếu người dùng vẫn đang chờ đúng job này (không ghi đè một lần tải lên mới hơn); url None = giữ ảnh cũ.
+    # Cập nhật qua ORM để các chỉ mục/cache lắng nghe thay đổi của User được cập nhật theo.
+    with app.app_context():
+        user = db.session.get(User, job.user_id)
+        if user is not None and user.avatar_pending == job.name:
+            if url is not None:
+                user.avatar = url
+            user.avatar_pending = None
+            db.session.commit()
+
+
+def recover():
+    """Chạy lại (hoặc bỏ, nếu file tạm đã mất) các job treo quá AVATAR_STALE_AFTER giây – tiến trình tạo ra chúng
+    đã chết trước khi xử lý xong. updated_at của user không cũ hơn lúc đặt avatar_pending nên ngưỡng này an toàn."""
+    stale_before = datetime.now() - timedelta(seconds=app.config['AVATAR_STALE_AFTER'])
+    users = db.session.query(User.id, User.avatar_pending).filter(User.avatar_pending.isnot(None),
+                                                                 User.updated_at < stale_before).all()
+    for user_id, name in users:
+        job = AvatarJob(user_id, name, _staged_path(name))
+        if os.path.exists(job.staged_path):
+            logger.info('Chạy lại job ảnh đại diện %s của người dùng %s', name, user_id)
+            submit(job)
+        else:
+            logger.warning('Bỏ job ảnh đại diện %s của người dùng %s: không còn file tạm', name, user_id)
+            _swap_avatar(job, None)
+    return len(users)
+
+
+def _recover_in_background():
+    try:
+        with app.app_context():
+            recover()
+    except Exception:
+        logger.exception('Khôi phục các job ảnh đại diện treo thất bại')
+
+
+@app.before_request
+def _start_recovery():
+    """Ở request đầu tiên của mỗi tiến trình, khôi phục các job treo trong nhóm luồng (không chạy khi TESTING)."""
+    global _recovered
+    if _recovered or app.testing:
+        return
+    with _lock:
+        if _recovered:
+            return
+        _recovered = True
+    if app.config['AVATAR_WORKERS'] <= 0:
+        threading.Thread(target=_recover_in_background, name='avatar-recover', daemon=True).start()
+    else:
+        _get_executor().submit(_recover_in_background)
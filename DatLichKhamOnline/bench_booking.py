@@ -0,0 +1,143 @@
+# DatLichKhamOnline/bench_booking.py
+# Benchmark tranh chấp đặt lịch: nhiều luồng cùng đặt khung giờ của một bác sĩ "hot".
+#
+#   python bench_booking.py                                   # SQLite file tạm
+#   python bench_booking.py --db-uri mysql+pymysql://u:p@localhost/mas_bench --clients 500 --threads 64
+#
+# Chỉ dùng với CSDL thử nghiệm: script tạo bảng (create_all) và thêm dữ liệu bench vào đó.
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time as timer
+import uuid
+from datetime import date, time, timedelta
+
+parser = argparse.ArgumentParser(description='Benchmark đặt lịch đồng thời')
+parser.add_argument('--db-uri', help='Mặc định: SQLite file trong thư mục tạm')
+parser.add_argument('--clients', type=int, default=300, help='Số bệnh nhân tranh đặt')
+parser.add_argument('--threads', type=int, default=32)
+parser.add_argument('--days', type=int, default=3, help='Số ngày có lịch của bác sĩ')
+parser.add_argument('--hot-slots', type=int, default=8, help='Số khung giờ sớm nhất mà phần lớn bệnh nhân nhắm tới')
+parser.add_argument('--retries', type=int, default=3, help='Số lần thử lại với khung giờ gợi ý khi bị chiếm')
+args = parser.parse_args()
+
+os.environ['DATABASE_URL'] = args.db_uri or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench_booking.db')
+
+from DatLichKhamOnline import app, db
+from DatLichKhamOnline import booking
+from models import User, UserRole, Doctor, Shift, DoctorShift
+
+
+def seed():
+    """Tạo một bác sĩ với lịch làm việc trong args.days ngày và args.clients bệnh nhân."""
+    token = uuid.uuid4().hex[:8]
+    db.create_all()
+    if not db.session.query(Shift).first():
+        for hour in range(7, 23):
+            db.session.add(Shift(start_time=time(hour, 0), end_time=time(hour, 30)))
+            db.session.add(Shift(start_time=time(hour, 30), end_time=time(hour + 1, 0)))
+        db.session.commit()
+
+    doctor_user = User(username=f'bench_doctor_{token}', email=f'bench_doctor_{token}@example.com',
+                       password=User.hash_password('123'), role=UserRole.DOCTOR,
+                       first_name='Bench', last_name='Doctor')
+    db.session.add(doctor_user)
+    db.session.flush()
+    db.session.add(Doctor(id=doctor_user.id))
+
+    shifts = db.session.query(Shift).order_by(Shift.start_time).all()
+    for day in range(args.days):
+        for shift in shifts:
+            db.session.add(DoctorShift(doctor_id=doctor_user.id, shift_id=shift.id,
+                                       work_date=date.today() + timedelta(days=day + 1)))
+
+    clients = [User(username=f'bench_client_{token}_{i}', email=f'bench_client_{token}_{i}@example.com',
+                    password=User.hash_password('123'), role=UserRole.USER,
+                    first_name='Bench', last_name=f'Client {i}') for i in range(args.clients)]
+    db.session.add_all(clients)
+    db.session.commit()
+
+    slot_ids = [ds_id for ds_id, in db.session.query(DoctorShift.id).join(Shift).filter(
+        DoctorShift.doctor_id == doctor_user.id
+    ).order_by(DoctorShift.work_date, Shift.start_time)]
+    return doctor_user.id, slot_ids, [client.id for client in clients]
+
+
+def run(doctor_id, slot_ids, client_ids):
+    latencies = []
+    outcomes = {booking.BOOKED: 0, booking.SLOT_TAKEN: 0, booking.ALREADY_BOOKED: 0,
+                booking.INVALID_SLOT: 0, 'error': 0}
+    lock = threading.Lock()
+    pending = list(client_ids)
+
+    def worker():
+        rng = random.Random()
+        with app.app_context():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    client_id = pending.pop()
+                # 80% nhắm vào các khung giờ sớm nhất, còn lại chọn ngẫu nhiên
+                if rng.random() < 0.8:
+                    target = rng.choice(slot_ids[:args.hot_slots])
+                else:
+                    target = rng.choice(slot_ids)
+                for _ in range(args.retries + 1):
+                    started = timer.perf_counter()
+                    try:
+                        result = booking.book_slot(doctor_id, target, client_id, 'Bench', 'Client',
+                                                   date(1990, 1, 1), 'Other')
+                        status = result.status
+                    except Exception as e:
+                        db.session.rollback()
+                        result, status = None, 'error'
+                        print(f"  ! {type(e).__name__}: {e}", file=sys.stderr)
+                    elapsed = timer.perf_counter() - started
+                    with lock:
+                        latencies.append(elapsed)
+                        outcomes[status] += 1
+                    if status != booking.SLOT_TAKEN or not result.alternatives:
+                        break
+                    target = result.alternatives[0].id
+            db.session.remove()
+
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    started = timer.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return timer.perf_counter() - started, latencies, outcomes
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        doctor_id, slot_ids, client_ids = seed()
+
+    print(f"CSDL: {app.config['SQLALCHEMY_DATABASE_URI']}")
+    print(f"{len(client_ids)} bệnh nhân, {args.threads} luồng, {len(slot_ids)} khung giờ "
+          f"({args.hot_slots} khung giờ 'hot')")
+    elapsed, latencies, outcomes = run(doctor_id, slot_ids, client_ids)
+
+    attempts = len(latencies)
+    print(f"Thời gian chạy:        {elapsed:.2f}s ({attempts} lượt đặt)")
+    print(f"Đặt thành công:        {outcomes[booking.BOOKED]} ({outcomes[booking.BOOKED] / elapsed:.1f} lượt/s)")
+    print(f"Tỉ lệ xung đột:        {outcomes[booking.SLOT_TAKEN] / attempts:.1%}")
+    print(f"Lỗi:                   {outcomes['error']}")
+    print(f"Độ trễ p50 / p99:      {percentile(latencies, 50) * 1000:.1f}ms / {percentile(latencies, 99) * 1000:.1f}ms")
+
+    with app.app_context():
+        # Mỗi khung giờ chỉ được có tối đa một vé
+        booked = db.session.query(DoctorShift.id).filter(
+            DoctorShift.doctor_id == doctor_id, DoctorShift.ticket.has()
+        ).count()
+        print(f"Khung giờ đã có vé:    {booked} (phải bằng số lượt đặt thành công)")
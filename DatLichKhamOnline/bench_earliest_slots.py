@@ -0,0 +1,137 @@
+# DatLichKhamOnline/bench_earliest_slots.py
+# Benchmark tìm khung giờ trống sớm nhất (booking.earliest_free_keys) trên chỉ mục doctor_availability tương
+# đương ~10 triệu dòng doctor_shifts trong tương lai (mặc định 2000 bác sĩ x 365 ngày x ~14 ca/ngày), so với
+# cách quét toàn bộ các ngày tương lai rồi sắp xếp.
+# Chỉ dựng bảng doctor_availability (không dựng doctor_shifts): bước tra DoctorShift của `limit` kết quả trong
+# booking.earliest_free_slots là tra theo chỉ mục, không phụ thuộc kích thước dữ liệu.
+#
+#   python bench_earliest_slots.py
+#   python bench_earliest_slots.py --doctors 500 --days 120 --db-uri mysql+pymysql://u:p@localhost/mas_bench
+#
+# Chỉ dùng với CSDL thử nghiệm: script tạo lại toàn bộ bảng.
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time as timer
+from datetime import date, time, timedelta
+
+parser = argparse.ArgumentParser(description='Benchmark tìm khung giờ trống sớm nhất')
+parser.add_argument('--db-uri', help='Mặc định: SQLite file trong thư mục tạm')
+parser.add_argument('--doctors', type=int, default=2000)
+parser.add_argument('--days', type=int, default=365)
+parser.add_argument('--shifts-per-day', type=int, default=14, help='Số ca làm việc trung bình mỗi ngày')
+parser.add_argument('--runs', type=int, default=20)
+args = parser.parse_args()
+
+os.environ['DATABASE_URL'] = args.db_uri or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench_earliest.db')
+
+from sqlalchemy import insert
+
+from DatLichKhamOnline import app, db, booking, reference_data
+from models import User, UserRole, Doctor, DoctorDepartment, Department, MedicalCenter, Shift, DoctorAvailability
+
+DEPARTMENTS = ['Tim mạch', 'Nhi khoa', 'Da liễu', 'Thần kinh', 'Nội tiết', 'Tai mũi họng', 'Mắt', 'Răng hàm mặt',
+               'Sản phụ khoa', 'Hiếm gặp']
+CENTERS = 20
+# Bác sĩ của chuyên khoa cuối ("Hiếm gặp") kín lịch BOOKED_OUT_DAYS ngày đầu – buộc phải quét xa
+BOOKED_OUT_DAYS = 60
+
+
+def build(rng):
+    db.drop_all()
+    db.create_all()
+    db.session.add_all([Shift(start_time=time(hour, minute), end_time=time(hour + (minute + 30) // 60,
+                                                                            (minute + 30) % 60))
+                        for hour in range(7, 23) for minute in (0, 30)])
+    db.session.add_all([Department(name=name) for name in DEPARTMENTS])
+    db.session.add_all([MedicalCenter(name=f'Bệnh viện {number}', address='Hà Nội') for number in range(CENTERS)])
+    db.session.commit()
+    shift_count = db.session.query(Shift).count()
+
+    connection = db.session.connection()
+    password = User.hash_password('123')
+    connection.execute(insert(User.__table__), [
+        {'id': number, 'username': f'doctor{number}', 'password': password, 'email': f'doctor{number}@example.com',
+         'role': UserRole.DOCTOR, 'first_name': 'Nguyễn Văn', 'last_name': f'Bình {number}'}
+        for number in range(1, args.doctors + 1)])
+    connection.execute(insert(Doctor.__table__), [
+        {'id': number, 'medical_center_id': number % CENTERS + 1, 'start_year': 2010}
+        for number in range(1, args.doctors + 1)])
+    connection.execute(insert(DoctorDepartment.__table__), [
+        {'doctor_id': number, 'department_id': number % len(DEPARTMENTS) + 1}
+        for number in range(1, args.doctors + 1)])
+
+    today = date.today()
+    rows, slots = [], 0
+    for doctor_id in range(1, args.doctors + 1):
+        booked_out = doctor_id % len(DEPARTMENTS) + 1 == len(DEPARTMENTS)
+        for day in range(args.days):
+            scheduled = rng.sample(range(shift_count),
+                                   min(shift_count, max(1, int(rng.gauss(args.shifts_per_day, 3)))))
+            free = [] if booked_out and day < BOOKED_OUT_DAYS else [o for o in scheduled if rng.random() < 0.4]
+            mask = 0
+            for ordinal in free:
+                mask |= 1 << ordinal
+            rows.append({'doctor_id': doctor_id, 'work_date': today + timedelta(days=day), 'free_mask': mask,
+                         'free_count': len(free), 'slot_count': len(scheduled)})
+            slots += len(scheduled)
+        if len(rows) >= 20000:
+            connection.execute(insert(DoctorAvailability.__table__), rows)
+            rows = []
+    if rows:
+        connection.execute(insert(DoctorAvailability.__table__), rows)
+    db.session.commit()
+    reference_data.invalidate(notify=False)
+    return slots
+
+
+def full_scan(limit, department_id=None, start_time=None, end_time=None):
+    """Cách làm ngây thơ: đọc mọi ngày tương lai của các bác sĩ khớp bộ lọc rồi sắp xếp."""
+    snapshot = reference_data.get()
+    shift_ids = snapshot.shift_ids_between(start_time, end_time) if start_time else list(snapshot.shift_bits)
+    window = {snapshot.shift_bits[shift_id]: snapshot.shift_ordinals[shift_id] for shift_id in shift_ids}
+    query = db.session.query(DoctorAvailability.work_date, DoctorAvailability.doctor_id,
+                             DoctorAvailability.free_mask).filter(DoctorAvailability.work_date >= date.today())
+    if department_id:
+        query = query.join(DoctorDepartment, DoctorDepartment.doctor_id == DoctorAvailability.doctor_id).filter(
+            DoctorDepartment.department_id == department_id)
+    slots = [(work_date, ordinal, doctor_id) for work_date, doctor_id, mask in query
+             for bit, ordinal in window.items() if mask >> bit & 1]
+    return sorted(slots)[:limit]
+
+
+def measure(function, *function_args, **kwargs):
+    latencies = []
+    for _ in range(args.runs):
+        started = timer.perf_counter()
+        result = function(*function_args, **kwargs)
+        latencies.append((timer.perf_counter() - started) * 1000)
+        db.session.rollback()
+    return statistics.median(latencies), result
+
+
+if __name__ == '__main__':
+    rng = random.Random(7)
+    with app.app_context():
+        started = timer.perf_counter()
+        slots = build(rng)
+        print(f'{args.doctors} bác sĩ x {args.days} ngày: {slots:,} khung giờ '
+              f'(dựng trong {timer.perf_counter() - started:.1f} s)')
+
+        scenarios = [
+            ('bất kỳ, 10 khung', {}),
+            ('chuyên khoa Tim mạch', {'department_id': 1}),
+            ('bệnh viện 3', {'medical_center_id': 3}),
+            ('Tim mạch, 19:00-22:00', {'department_id': 1, 'start_time': time(19), 'end_time': time(22)}),
+            (f'kín lịch {BOOKED_OUT_DAYS} ngày đầu', {'department_id': len(DEPARTMENTS)}),
+        ]
+        print(f"{'kịch bản':<28}{'heap (ms)':>12}{'quét hết (ms)':>16}  khung sớm nhất")
+        for name, filters in scenarios:
+            heap_ms, keys = measure(booking.earliest_free_keys, 10, **filters)
+            scan_filters = {key: value for key, value in filters.items() if key != 'medical_center_id'}
+            scan_ms, _ = measure(full_scan, 10, **scan_filters) if 'medical_center_id' not in filters \
+                else (float('nan'), None)
+            first = f'{keys[0][0]} ca {keys[0][1]} BS {keys[0][2]}' if keys else '-'
+            print(f'{name:<28}{heap_ms:>12.2f}{scan_ms:>16.1f}  {first}')
@@ -0,0 +1,227 @@
+# DatLichKhamOnline/bench_routes.py
+# Benchmark các route qua Flask test client trên dữ liệu do generate_data.py sinh ra:
+# đo độ trễ (p50/p90/p99), số câu SQL mỗi request và bộ nhớ đỉnh (tracemalloc), lưu kết quả ra JSON
+# để so sánh giữa các lần chạy.
+#
+#   python generate_data.py && python bench_routes.py
+#   python bench_routes.py --iterations 50 --output results/after.json --compare results/before.json
+#   python bench_routes.py --only search_doctor,api_suggestions
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import tempfile
+import time as timer
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+DEFAULT_DB_PATH = os.path.join(tempfile.gettempdir(), 'mas_bench.sqlite3')
+
+parser = argparse.ArgumentParser(description='Benchmark các route qua Flask test client')
+parser.add_argument('--db-uri', help=f'Mặc định: sqlite:///{DEFAULT_DB_PATH} (CSDL của generate_data.py)')
+parser.add_argument('--iterations', type=int, default=20, help='Số request đo cho mỗi route')
+parser.add_argument('--only', help='Chỉ chạy các route có tên trong danh sách (cách nhau bởi dấu phẩy)')
+parser.add_argument('--output', help='Ghi kết quả ra file JSON')
+parser.add_argument('--compare', help='So sánh với file JSON của lần chạy trước')
+args = parser.parse_args()
+
+os.environ['DATABASE_URL'] = args.db_uri or 'sqlite:///' + DEFAULT_DB_PATH
+
+from sqlalchemy import event, func
+
+from DatLichKhamOnline import app, db, index  # index đăng ký toàn bộ route
+from models import User, UserRole, Doctor, DoctorShift, Ticket, MedicalCenter, Department, DoctorDepartment
+
+PASSWORD = '123'
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+
+
+def pick_fixtures():
+    """Chọn các thực thể "nặng" nhất để đo: bác sĩ nhiều ca nhất, bệnh viện nhiều bác sĩ nhất, bệnh nhân nhiều vé nhất."""
+    password = User.hash_password(PASSWORD)
+    shift_count = func.count(DoctorShift.id)
+    doctor_id, = db.session.query(DoctorShift.doctor_id).join(User, User.id == DoctorShift.doctor_id).filter(
+        User.password == password).group_by(DoctorShift.doctor_id).order_by(shift_count.desc()).first()
+    ticket_count = func.count(Ticket.id)
+    client_id, = db.session.query(Ticket.client_id).join(User, User.id == Ticket.client_id).filter(
+        User.password == password, User.role == UserRole.USER).group_by(Ticket.client_id).order_by(
+        ticket_count.desc()).first()
+    center_id, = db.session.query(Doctor.medical_center_id).filter(Doctor.medical_center_id.isnot(None)).group_by(
+        Doctor.medical_center_id).order_by(func.count(Doctor.id).desc()).first()
+    department, = db.session.query(Department.name).join(DoctorDepartment).group_by(Department.id).order_by(
+        func.count(DoctorDepartment.id).desc()).first()
+    admin = db.session.query(User.id, User.username).filter(User.role == UserRole.ADMIN,
+                                                           User.password == password).first()
+    busiest_day = db.session.query(DoctorShift.work_date).filter(DoctorShift.doctor_id == doctor_id).group_by(
+        DoctorShift.work_date).order_by(func.count().desc()).first()[0]
+    # Chỉ trả về giá trị thuần (id, username) để dùng được sau khi đóng app context
+    return {
+        'doctor': db.session.query(User.id, User.username).filter(User.id == doctor_id).one(),
+        'client': db.session.query(User.id, User.username).filter(User.id == client_id).one(),
+        'admin': admin,
+        'center_id': center_id,
+        'department': department,
+        'doctor_day': busiest_day,
+    }
+
+
+def routes(fixtures):
+    """(tên, người dùng đăng nhập hoặc None, URL) cho mọi route cần đo."""
+    doctor, client, admin = fixtures['doctor'], fixtures['client'], fixtures['admin']
+    future_day = (date.today() + timedelta(days=1)).isoformat()
+    items = [
+        ('home', None, '/'),
+        ('search_doctor_name', None, '/search_doctor?q=Nguyễn'),
+        ('search_doctor_department', None, f"/search_doctor?q={fixtures['department']}"),
+        ('search_doctor_all', None, '/search_doctor'),
+        ('search_medical_center', None, '/search_medical_center?q=Bệnh viện'),
+        ('medical_center_details', None, f"/medical_center_details/{fixtures['center_id']}"),
+        ('doctor_details', None, f'/doctor_details/{doctor.id}'),
+        ('api_suggestions', None, '/api/suggestions?q=nguy'),
+        ('api_featured_doctors', None, '/api/featured-doctors'),
+        ('api_medical_centers', None, '/api/medical-centers'),
+        ('api_doctors', None, '/api/doctors?q=Nguyễn'),
+        ('book_appointment', client, f'/book_appointment/{doctor.id}?appointment_date={future_day}'),
+        ('appointment_history', client, '/appointment_history'),
+        ('api_appointment_history', client, '/api/appointment-history'),
+        ('doctor_dashboard', doctor, '/doctor/dashboard'),
+        ('doctor_appointments', doctor, f"/doctor/appointments?date={fixtures['doctor_day'].isoformat()}"),
+        ('api_doctor_appointments', doctor, f"/api/doctor/appointments?date={fixtures['doctor_day'].isoformat()}"),
+        ('doctor_edit_shift', doctor, f"/doctor/edit_shift/{fixtures['doctor_day'].isoformat()}"),
+    ]
+    if admin:
+        items += [
+            ('admin_index', admin, '/admin/'),
+            ('admin_analytics', admin, '/admin/analytics/'),
+            ('admin_tickets', admin, '/admin/ticket/'),
+            ('admin_users', admin, '/admin/user/'),
+            ('admin_doctors', admin, '/admin/doctor/'),
+        ]
+    return items
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def measure(client, url, iterations, counter):
+    """Đo một route: request đầu (cold), `iterations` request tiếp theo, và một request dưới tracemalloc."""
+    counter.count = 0
+    started = timer.perf_counter()
+    response = client.get(url)
+    cold_ms = (timer.perf_counter() - started) * 1000
+    cold_queries = counter.count
+
+    latencies, queries = [], []
+    for _ in range(iterations):
+        counter.count = 0
+        started = timer.perf_counter()
+        client.get(url)
+        latencies.append((timer.perf_counter() - started) * 1000)
+        queries.append(counter.count)
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    client.get(url)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'url': url,
+        'status': response.status_code,
+        'bytes': len(response.get_data()),
+        'cold_ms': round(cold_ms, 2),
+        'cold_queries': cold_queries,
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p90_ms': round(percentile(latencies, 90), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'mean_ms': round(statistics.fmean(latencies), 2),
+        'queries': max(queries),
+        'peak_kib': round(peak / 1024, 1),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, previous_path):
+    with open(previous_path, encoding='utf-8') as file:
+        previous = json.load(file)['routes']
+    print(f"\nSo với {previous_path}:")
+    for name, result in results.items():
+        old = previous.get(name)
+        if not old:
+            continue
+        change = (result['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100 if old['p50_ms'] else 0
+        print(f"  {name:28} p50 {old['p50_ms']:>9.2f} -> {result['p50_ms']:>9.2f} ms ({change:+.0f}%)   "
+              f"queries {old['queries']:>4} -> {result['queries']:>4}")
+
+
+def dataset_size():
+    return {
+        'users': db.session.query(func.count(User.id)).scalar(),
+        'doctors': db.session.query(func.count(Doctor.id)).scalar(),
+        'medical_centers': db.session.query(func.count(MedicalCenter.id)).scalar(),
+        'doctor_shifts': db.session.query(func.count(DoctorShift.id)).scalar(),
+        'tickets': db.session.query(func.count(Ticket.id)).scalar(),
+    }
+
+
+if __name__ == '__main__':
+    app.config['TESTING'] = True
+    only = set(args.only.split(',')) if args.only else None
+    with app.app_context():
+        fixtures = pick_fixtures()
+        dataset = dataset_size()
+        engine = db.engine
+        database = engine.url.render_as_string(hide_password=True)
+
+    # Các request chạy ngoài app context ở trên: mỗi request có app context (và g, current_user) riêng
+    counter = QueryCounter()
+    event.listen(engine, 'before_cursor_execute', counter)
+    clients = {}
+    results = {}
+    print(f"{'route':28} {'status':>6} {'cold':>9} {'p50':>9} {'p90':>9} {'p99':>9} {'queries':>8} {'peak KiB':>9}")
+    for name, user, url in routes(fixtures):
+        if only and name not in only:
+            continue
+        key = user.id if user else None
+        if key not in clients:
+            clients[key] = app.test_client()
+            if user:
+                clients[key].post('/user_login', data={'username': user.username, 'password': PASSWORD})
+        result = measure(clients[key], url, args.iterations, counter)
+        results[name] = result
+        print(f"{name:28} {result['status']:>6} {result['cold_ms']:>9.2f} {result['p50_ms']:>9.2f} "
+              f"{result['p90_ms']:>9.2f} {result['p99_ms']:>9.2f} {result['queries']:>8} {result['peak_kib']:>9}")
+    event.remove(engine, 'before_cursor_execute', counter)
+
+    report = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'database': database,
+        'iterations': args.iterations,
+        'dataset': dataset,
+        'routes': results,
+    }
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+        print(f"\nĐã ghi kết quả vào {args.output}")
+    if args.compare:
+        compare(results, args.compare)
@@ -0,0 +1,79 @@
+# DatLichKhamOnline/bench_suggestions.py
+# So sánh /api/suggestions: chỉ mục trong bộ nhớ (autocomplete.py) và ba truy vấn ILIKE trước đây.
+#
+#   python bench_suggestions.py                     # 10k và 100k tên, SQLite file tạm
+#   python bench_suggestions.py --sizes 10000 --db-uri mysql+pymysql://u:p@localhost/mas_bench
+#
+# Chỉ dùng với CSDL thử nghiệm: script tạo bảng và thêm dữ liệu giả vào đó.
+import argparse
+import os
+import random
+import tempfile
+import time as timer
+
+parser = argparse.ArgumentParser(description='Benchmark gợi ý tìm kiếm')
+parser.add_argument('--db-uri', help='Mặc định: SQLite file trong thư mục tạm (mỗi kích thước một file)')
+parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000], help='Số tên bác sĩ')
+parser.add_argument('--queries', type=int, default=200)
+args = parser.parse_args()
+
+os.environ['DATABASE_URL'] = args.db_uri or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench_suggestions.db')
+
+from DatLichKhamOnline import app, db
+from DatLichKhamOnline import autocomplete
+from models import User, UserRole, MedicalCenter, Department
+
+FAMILY_NAMES = ['Nguyễn', 'Trần', 'Lê', 'Phạm', 'Hoàng', 'Huỳnh', 'Phan', 'Vũ', 'Võ', 'Đặng', 'Bùi', 'Đỗ']
+MIDDLE_NAMES = ['Văn', 'Thị', 'Minh', 'Ngọc', 'Thanh', 'Quốc', 'Hữu', 'Đức', 'Gia', 'Anh']
+GIVEN_NAMES = ['An', 'Bình', 'Châu', 'Dũng', 'Giang', 'Hà', 'Hải', 'Hùng', 'Khánh', 'Lan', 'Long', 'Mai',
+               'Nam', 'Phúc', 'Quân', 'Sơn', 'Tâm', 'Thảo', 'Trung', 'Tú', 'Vy', 'Yến']
+
+
+def three_query_suggestions(query):
+    """Bản sao của api_suggestions trước khi có chỉ mục trong bộ nhớ."""
+    doctors = db.session.query(User).filter(
+        User.role == UserRole.DOCTOR,
+        (User.first_name + " " + User.last_name).ilike(f'%{query}%')
+    ).limit(5).all()
+    centers = db.session.query(MedicalCenter).filter(MedicalCenter.name.ilike(f'%{query}%')).limit(3).all()
+    departments = db.session.query(Department).filter(Department.name.ilike(f'%{query}%')).limit(3).all()
+    return ([f"{d.first_name} {d.last_name} - Bác sĩ" for d in doctors] +
+            [f"{c.name} - Bệnh viện" for c in centers] +
+            [f"{d.name} - Chuyên khoa" for d in departments])
+
+
+def seed(size, rng):
+    db.drop_all()
+    db.create_all()
+    db.session.add_all([MedicalCenter(name=f'Bệnh viện {name} {i}') for i, name in enumerate(GIVEN_NAMES)])
+    db.session.add_all([Department(name=name) for name in ['Tim mạch', 'Nhi khoa', 'Nhãn khoa', 'Da liễu']])
+    db.session.execute(User.__table__.insert(), [{
+        'username': f'doctor{i}', 'email': f'doctor{i}@example.com', 'password': 'x', 'role': UserRole.DOCTOR,
+        'first_name': f'{rng.choice(FAMILY_NAMES)} {rng.choice(MIDDLE_NAMES)}', 'last_name': rng.choice(GIVEN_NAMES)
+    } for i in range(size)])
+    db.session.commit()
+
+
+def measure(function, queries):
+    started = timer.perf_counter()
+    for query in queries:
+        function(query)
+    return (timer.perf_counter() - started) / len(queries)
+
+
+if __name__ == '__main__':
+    rng = random.Random(42)
+    with app.app_context():
+        for size in args.sizes:
+            seed(size, rng)
+            words = FAMILY_NAMES + MIDDLE_NAMES + GIVEN_NAMES
+            queries = [rng.choice(words).lower()[:rng.randint(2, 4)] for _ in range(args.queries)]
+
+            started = timer.perf_counter()
+            autocomplete.load_index()
+            load_time = timer.perf_counter() - started
+
+            db_latency = measure(three_query_suggestions, queries)
+            index_latency = measure(autocomplete.suggest, queries)
+            print(f"{size:>7} tên | nạp chỉ mục {load_time:.2f}s | 3 truy vấn: {db_latency * 1000:8.3f}ms | "
+                  f"bộ nhớ: {index_latency * 1e6:8.1f}µs | nhanh hơn {db_latency / index_latency:,.0f} lần")
@@ -0,0 +1,206 @@
+# DatLichKhamOnline/booking.py
+# Đặt lịch an toàn khi nhiều người cùng tranh một khung giờ.
+# Khung giờ được "chiếm" nguyên tử: khóa các dòng doctor_shifts của (bác sĩ, ngày) – cùng khóa và cùng thứ tự mà
+# availability.refresh_availability lấy khi cập nhật chỉ mục, nên hai lượt đặt cùng ngày xếp hàng thay vì khóa chéo
+# nhau (SELECT ... FOR UPDATE trên MySQL) – sau đó chèn Ticket; ràng buộc UNIQUE trên tickets.doctor_shift_id là chốt
+# chặn cuối cùng (SQLite bỏ qua FOR UPDATE nên chỉ dựa vào ràng buộc này). Giao dịch bị CSDL hủy vì deadlock/hết
+# thời gian chờ khóa được thử lại vài lần. Người thua cuộc nhận kết quả SLOT_TAKEN kèm các khung giờ trống gần
+# nhất thay vì lỗi 500.
+import heapq
+import uuid
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, tuple_
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import contains_eager, joinedload
+
+from DatLichKhamOnline import db, availability, reference_data
+from models import DoctorShift, Shift, Ticket, TicketStatus, DoctorAvailability, Doctor, DoctorDepartment
+
+BOOKED = 'booked'
+SLOT_TAKEN = 'slot_taken'
+ALREADY_BOOKED = 'already_booked'
+INVALID_SLOT = 'invalid_slot'
+
+BookingResult = namedtuple('BookingResult', ['status', 'ticket', 'doctor_shift', 'alternatives'])
+
+# Số lần chạy lại giao dịch đặt chỗ khi CSDL hủy nó vì deadlock hoặc hết thời gian chờ khóa
+BOOKING_ATTEMPTS = 3
+
+# Số ngày tìm khung giờ thay thế kể từ ngày của khung giờ đã bị chiếm
+ALTERNATIVE_WINDOW_DAYS = 7
+# Tìm khung giờ sớm nhất: số ngày tối đa xét tới, và số ngày của khoảng quét đầu tiên (nhân đôi sau mỗi lần)
+EARLIEST_SLOT_HORIZON_DAYS = 90
+EARLIEST_SLOT_FIRST_SPAN = 1
+
+
+def next_free_slots(doctor_id, from_date, limit=5):
+    """Các khung giờ còn trống sớm nhất của bác sĩ kể từ from_date, đọc từ chỉ mục doctor_availability."""
+    free_days = availability.available_days(doctor_id, from_date, from_date + timedelta(days=ALTERNATIVE_WINDOW_DAYS))
+    if not free_days:
+        return []
+
+    bits = reference_data.get().shift_bits
+    free_keys = set()
+    for work_date, free_mask in free_days:
+        free_keys.update((work_date, shift_id) for shift_id in availability.mask_to_shift_ids(free_mask, bits))
+        if len(free_keys) >= limit:
+            break
+
+    candidates = db.session.query(DoctorShift).join(Shift).options(contains_eager(DoctorShift.shift)).filter(
+        DoctorShift.doctor_id == doctor_id,
+        DoctorShift.work_date.in_({work_date for work_date, _ in free_keys}),
+        DoctorShift.shift_id.in_({shift_id for _, shift_id in free_keys})
+    ).order_by(DoctorShift.work_date, Shift.start_time).all()
+    return [ds for ds in candidates if (ds.work_date, ds.shift_id) in free_keys][:limit]
+
+
+def earliest_free_keys(limit, department_id=None, medical_center_id=None, start_time=None, end_time=None,
+                       now=None):
+    """Các khung giờ trống sớm nhất của mọi bác sĩ khớp bộ lọc: list (work_date, shift_id, doctor_id).
+
+    Quét chỉ mục doctor_availability theo từng khoảng ngày tăng dần (1, 2, 4... ngày) và dừng ngay khi đã đủ
+    `limit` khung giờ – các khoảng sau chỉ chứa ngày muộn hơn. Trong mỗi khoảng, khung giờ được tách từ
+    free_mask và `limit` khung sớm nhất được chọn bằng heap. Khung giờ trong ngày hôm nay đã bắt đầu bị bỏ qua.
+    """
+    snapshot = reference_data.get()
+    bits = snapshot.shift_bits
+    shift_ids = snapshot.shift_ids_between(start_time, end_time) if start_time and end_time else list(bits)
+    window_mask = 0
+    for shift_id in shift_ids:
+        if shift_id in bits:
+            window_mask |= 1 << bits[shift_id]
+    if not window_mask or limit <= 0:
+        return []
+
+    now = now or datetime.now()
+    today = now.date()
+    today_mask = window_mask
+    for shift in snapshot.shifts:
+        if shift.start_time <= now.time() and shift.id in bits:
+            today_mask &= ~(1 << bits[shift.id])
+    # Heap so theo giờ bắt đầu (thứ tự ca), không theo vị trí bit
+    ordinal_by_bit = {bit: snapshot.shift_ordinals[shift_id] for shift_id, bit in bits.items()}
+    shift_by_ordinal = {ordinal: shift_id for shift_id, ordinal in snapshot.shift_ordinals.items()}
+
+    query = db.session.query(
+        DoctorAvailability.work_date, DoctorAvailability.doctor_id, DoctorAvailability.free_mask
+    ).filter(DoctorAvailability.free_count > 0, DoctorAvailability.free_mask.op('&')(window_mask) != 0)
+    # Lọc theo tập bác sĩ (IN truy vấn con) để CSDL có thể đi theo khóa chính (doctor_id, work_date) của từng
+    # bác sĩ khi tập nhỏ, hoặc theo chỉ mục work_date khi không lọc
+    if medical_center_id:
+        query = query.filter(DoctorAvailability.doctor_id.in_(
+            select(Doctor.id).where(Doctor.medical_center_id == medical_center_id)))
+    if department_id:
+        query = query.filter(DoctorAvailability.doctor_id.in_(
+            select(DoctorDepartment.doctor_id).where(DoctorDepartment.department_id == department_id)))
+
+    found = []
+    start, span = today, EARLIEST_SLOT_FIRST_SPAN
+    horizon = today + timedelta(days=EARLIEST_SLOT_HORIZON_DAYS)
+    while len(found) < limit and start < horizon:
+        end = min(start + timedelta(days=span), horizon)
+        rows = query.filter(DoctorAvailability.work_date >= start, DoctorAvailability.work_date < end).all()
+
+        def candidates():
+            for work_date, doctor_id, free_mask in rows:
+                mask = free_mask & (today_mask if work_date == today else window_mask)
+                while mask:
+                    bit = mask & -mask
+                    yield work_date, ordinal_by_bit[bit.bit_length() - 1], doctor_id
+                    mask ^= bit
+
+        found.extend(heapq.nsmallest(limit - len(found), candidates()))
+        start, span = end, span * 2
+    return [(work_date, shift_by_ordinal[ordinal], doctor_id) for work_date, ordinal, doctor_id in found]
+
+
+def earliest_free_slots(limit=10, department_id=None, medical_center_id=None, start_time=None, end_time=None):
+    """Như earliest_free_keys nhưng trả về các DoctorShift (kèm ca, bác sĩ, bệnh viện), theo thứ tự thời gian."""
+    keys = earliest_free_keys(limit, department_id, medical_center_id, start_time, end_time)
+    if not keys:
+        return []
+    position = {(doctor_id, work_date, shift_id): i for i, (work_date, shift_id, doctor_id) in enumerate(keys)}
+    doctor_shifts = db.session.query(DoctorShift).join(Shift).options(
+        contains_eager(DoctorShift.shift),
+        joinedload(DoctorShift.doctor).joinedload(Doctor.user),
+        joinedload(DoctorShift.doctor).joinedload(Doctor.medical_center),
+    ).filter(
+        # Điều kiện theo từng cột để CSDL tra chỉ mục (doctor_id, work_date, shift_id) – SQLite không dùng chỉ mục
+        # cho riêng điều kiện IN trên bộ giá trị
+        DoctorShift.doctor_id.in_({doctor_id for doctor_id, _, _ in position}),
+        DoctorShift.work_date.in_({work_date for _, work_date, _ in position}),
+        tuple_(DoctorShift.doctor_id, DoctorShift.work_date, DoctorShift.shift_id).in_(list(position)),
+    ).all()
+    return sorted(doctor_shifts, key=lambda ds: position[(ds.doctor_id, ds.work_date, ds.shift_id)])
+
+
+def _taken(doctor_shift):
+    db.session.rollback()
+    return BookingResult(SLOT_TAKEN, None, doctor_shift,
+                         next_free_slots(doctor_shift.doctor_id, doctor_shift.work_date))
+
+
+def _is_lock_conflict(error):
+    original = error.orig
+    code = getattr(original, 'pgcode', None) or (original.args[0] if getattr(original, 'args', None) else None)
+    # MySQL 1213: deadlock, 1205: lock wait timeout; PostgreSQL 40P01: deadlock_detected, 55P03: lock_not_available
+    return code in (1213, 1205, '40P01', '55P03') or 'database is locked' in str(original)
+
+
+def book_slot(doctor_id, doctor_shift_id, client_id, first_name, last_name, birth_of_day, gender):
+    """Đặt khung giờ doctor_shift_id cho client_id và trả về BookingResult.
+
+    Giao dịch luôn được commit hoặc rollback trước khi hàm trả về, để khóa dòng được giữ ngắn nhất.
+    """
+    for _ in range(BOOKING_ATTEMPTS):
+        try:
+            return _book_once(doctor_id, doctor_shift_id, client_id, first_name, last_name, birth_of_day, gender)
+        except OperationalError as error:
+            db.session.rollback()
+            if not _is_lock_conflict(error):
+                raise
+    # Vẫn tranh chấp sau BOOKING_ATTEMPTS lần: báo khung giờ đã bị chiếm kèm các khung giờ trống gần nhất
+    doctor_shift = db.session.get(DoctorShift, doctor_shift_id)
+    return _taken(doctor_shift)
+
+
+def _book_once(doctor_id, doctor_shift_id, client_id, first_name, last_name, birth_of_day, gender):
+    doctor_shift = db.session.get(DoctorShift, doctor_shift_id)
+    if not doctor_shift or doctor_shift.doctor_id != doctor_id:
+        db.session.rollback()
+        return BookingResult(INVALID_SLOT, None, None, [])
+    # Khóa cả ngày của bác sĩ trước khi ghi; after_flush (availability) lấy lại đúng các khóa này
+    availability.lock_days(db.session.connection(), doctor_id, {doctor_shift.work_date})
+
+    if db.session.query(Ticket.id).filter(Ticket.doctor_shift_id == doctor_shift.id).first():
+        return _taken(doctor_shift)
+
+    existing_ticket = db.session.query(Ticket.id).join(DoctorShift).filter(
+        Ticket.client_id == client_id,
+        DoctorShift.doctor_id == doctor_id,
+        DoctorShift.work_date == doctor_shift.work_date,
+        Ticket.status.in_([TicketStatus.PENDING, TicketStatus.CONFIRMED])
+    ).first()
+    if existing_ticket:
+        db.session.rollback()
+        return BookingResult(ALREADY_BOOKED, None, doctor_shift, [])
+
+    new_ticket = Ticket(
+        uuid=str(uuid.uuid4()),
+        doctor_shift_id=doctor_shift.id,
+        client_id=client_id,
+        status=TicketStatus.PENDING,
+        first_name=first_name,
+        last_name=last_name,
+        birth_of_day=birth_of_day,
+        gender=gender
+    )
+    db.session.add(new_ticket)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Một giao dịch khác đã chèn vé cho khung giờ này trước (vi phạm UNIQUE doctor_shift_id)
+        return _taken(doctor_shift)
+    return BookingResult(BOOKED, new_ticket, doctor_shift, [])
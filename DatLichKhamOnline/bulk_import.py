@@ -0,0 +1,434 @@
+# DatLichKhamOnline/bulk_import.py
+# Nhập hàng loạt bệnh viện, bác sĩ và lịch làm việc từ file CSV/JSONL vào CSDL đang chạy.
+# File được đọc dạng luồng và xử lý theo từng lô: tên bệnh viện/chuyên khoa được tra trong bảng
+# nạp sẵn, các dòng mới được INSERT nhiều dòng một lần, các dòng đã có được UPDATE (upsert).
+# Dòng lỗi được ghi lại kèm số dòng và không làm hỏng cả lô.
+#
+#   python bulk_import.py centers   data/centers.csv
+#   python bulk_import.py doctors   data/DoctorInfo.csv [--batch-size 1000] [--errors errors.csv]
+#   python bulk_import.py schedules data/schedules.jsonl
+#
+# Cột của từng loại:
+#   centers:   name, address, phone, description, image, latitude, longitude (độ thập phân, nhập sẵn – không
+#              tra tọa độ trực tuyến)
+#   doctors:   username, email, password, first_name, last_name, avatar, description, start_year,
+#              medical_center_name, department_name (nhiều chuyên khoa cách nhau bởi ';')
+#   schedules: doctor_username, work_date hoặc start_date + end_date (+ weekdays, ví dụ "0;2;4"),
+#              start_time, end_time (HH:MM) – mọi ca nằm trọn trong khung giờ được tạo
+import argparse
+import csv
+import json
+import sys
+import time as clock
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, insert, update, bindparam, or_
+from sqlalchemy.exc import SQLAlchemyError
+
+from DatLichKhamOnline import app, db, autocomplete, doctor_search, geo_index, reference_data, response_cache, \
+    schedules, stats_rollup
+from models import User, UserRole, Doctor, DoctorDepartment, Department, MedicalCenter, Shift
+
+user_table = User.__table__
+doctor_table = Doctor.__table__
+doctor_department_table = DoctorDepartment.__table__
+center_table = MedicalCenter.__table__
+
+DEFAULT_BATCH_SIZE = 1000
+CENTER_FIELDS = ('address', 'phone', 'description', 'image')
+COORDINATE_FIELDS = ('latitude', 'longitude')
+
+
+class BatchResult:
+    __slots__ = ('inserted', 'updated', 'errors')
+
+    def __init__(self):
+        self.inserted = 0
+        self.updated = 0
+        self.errors = []  # (số dòng, thông báo)
+
+
+class ImportReport:
+    def __init__(self):
+        self.rows = 0
+        self.inserted = 0
+        self.updated = 0
+        self.errors = []
+        self.started = clock.perf_counter()
+
+    def add(self, result):
+        self.inserted += result.inserted
+        self.updated += result.updated
+        self.errors.extend(result.errors)
+
+    @property
+    def rows_per_second(self):
+        elapsed = clock.perf_counter() - self.started
+        return self.rows / elapsed if elapsed else 0.0
+
+
+def _key(name):
+    return (name or '').strip().lower()
+
+
+def read_rows(path):
+    """Đọc file theo dòng: trả về (số dòng, dict hoặc None, thông báo lỗi)."""
+    if path.endswith(('.jsonl', '.ndjson')):
+        with open(path, encoding='utf-8') as file:
+            for line_no, line in enumerate(file, 1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError as e:
+                    yield line_no, None, f'JSON không hợp lệ: {e}'
+                    continue
+                if not isinstance(row, dict):
+                    yield line_no, None, 'Mỗi dòng JSONL phải là một object'
+                else:
+                    yield line_no, row, None
+    else:
+        with open(path, encoding='utf-8-sig', newline='') as file:
+            reader = csv.DictReader(file)
+            for row in reader:
+                yield reader.line_num, row, None
+
+
+def _text(row, field):
+    value = row.get(field)
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def _int(row, field):
+    value = _text(row, field)
+    return int(value) if value is not None else None
+
+
+def _float(row, field):
+    value = _text(row, field)
+    return float(value.replace(',', '.')) if value is not None else None
+
+
+def _date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def _time(value):
+    return datetime.strptime(value, '%H:%M').time()
+
+
+# ---------------------------------------------------------------- bệnh viện
+
+def import_centers(batch, lookups):
+    result = BatchResult()
+    connection = db.session.connection()
+    centers = lookups['centers']
+    new_rows, changed_rows, seen = [], [], set()
+    for line_no, row in batch:
+        name = _text(row, 'name')
+        if not name:
+            result.errors.append((line_no, 'Thiếu tên bệnh viện'))
+            continue
+        if _key(name) in seen:
+            result.errors.append((line_no, f"Bệnh viện '{name}' bị lặp trong cùng lô"))
+            continue
+        try:
+            latitude, longitude = _float(row, 'latitude'), _float(row, 'longitude')
+        except ValueError:
+            result.errors.append((line_no, 'Tọa độ không phải là số'))
+            continue
+        if (latitude is not None or longitude is not None) and not geo_index.valid_coordinates(latitude, longitude):
+            result.errors.append((line_no, 'Tọa độ không hợp lệ (cần cả latitude trong [-90, 90] và '
+                                           'longitude trong [-180, 180])'))
+            continue
+        seen.add(_key(name))
+        values = {field: _text(row, field) for field in CENTER_FIELDS if field in row}
+        values.update(latitude=latitude, longitude=longitude)
+        if _key(name) in centers:
+            changed_rows.append({'_id': centers[_key(name)], 'updated_at': datetime.now(),
+                                 **{field: values.get(field) for field in CENTER_FIELDS + COORDINATE_FIELDS}})
+        else:
+            new_rows.append({'name': name, 'created_at': datetime.now(), 'updated_at': datetime.now(),
+                             **{field: values.get(field) for field in CENTER_FIELDS + COORDINATE_FIELDS}})
+
+    if changed_rows:
+        connection.execute(update(center_table).where(center_table.c.id == bindparam('_id')).values(
+            {field: bindparam(field) for field in CENTER_FIELDS + COORDINATE_FIELDS + ('updated_at',)}),
+            changed_rows)
+    if new_rows:
+        connection.execute(insert(center_table), new_rows)
+        names = [row['name'] for row in new_rows]
+        centers.update({_key(name): center_id for center_id, name in connection.execute(
+            select(center_table.c.id, center_table.c.name).where(center_table.c.name.in_(names)))})
+    result.inserted, result.updated = len(new_rows), len(changed_rows)
+    return result
+
+
+# ---------------------------------------------------------------- bác sĩ
+
+def import_doctors(batch, lookups):
+    result = BatchResult()
+    connection = db.session.connection()
+    now = datetime.now()
+
+    usernames = {_text(row, 'username') for _, row in batch} - {None}
+    emails = {_text(row, 'email') for _, row in batch} - {None}
+    existing = {}
+    email_owner = {}
+    for row in connection.execute(select(user_table.c.id, user_table.c.username, user_table.c.email,
+                                         user_table.c.role).where(
+            or_(user_table.c.username.in_(usernames), user_table.c.email.in_(emails)))):
+        existing[row.username] = row
+        email_owner[row.email] = row.username
+
+    valid = []  # (username, user_values, doctor_values, department_ids)
+    seen_usernames, seen_emails = set(), set()
+    for line_no, row in batch:
+        username, email = _text(row, 'username'), _text(row, 'email')
+        missing = [field for field in ('username', 'email', 'first_name', 'last_name') if not _text(row, field)]
+        if username not in existing and not _text(row, 'password'):
+            missing.append('password')
+        if missing:
+            result.errors.append((line_no, f"Thiếu cột: {', '.join(missing)}"))
+            continue
+        if username in seen_usernames or email in seen_emails:
+            result.errors.append((line_no, f"Tên đăng nhập hoặc email bị lặp trong cùng lô: {username}"))
+            continue
+        if email_owner.get(email, username) != username:
+            result.errors.append((line_no, f"Email {email} đã thuộc về người dùng {email_owner[email]}"))
+            continue
+        if username in existing and existing[username].role not in (UserRole.DOCTOR, UserRole.DOCTOR.value):
+            result.errors.append((line_no, f"Người dùng {username} đã tồn tại và không phải bác sĩ"))
+            continue
+
+        center_name = _text(row, 'medical_center_name')
+        center_id = lookups['centers'].get(_key(center_name)) if center_name else None
+        if center_name and center_id is None:
+            result.errors.append((line_no, f"Không tìm thấy bệnh viện '{center_name}'"))
+            continue
+        department_names = [name for name in (_text(row, 'department_name') or '').split(';') if name.strip()]
+        department_ids = [lookups['departments'].get(_key(name)) for name in department_names]
+        if None in department_ids:
+            unknown = department_names[department_ids.index(None)]
+            result.errors.append((line_no, f"Không tìm thấy chuyên khoa '{unknown.strip()}'"))
+            continue
+        try:
+            start_year = _int(row, 'start_year')
+        except ValueError:
+            result.errors.append((line_no, f"Năm bắt đầu không hợp lệ: {row.get('start_year')}"))
+            continue
+
+        seen_usernames.add(username)
+        seen_emails.add(email)
+        user_values = {'email': email, 'first_name': _text(row, 'first_name'), 'last_name': _text(row, 'last_name'),
+                       'avatar': _text(row, 'avatar'), 'updated_at': now}
+        if _text(row, 'password'):
+            user_values['password'] = User.hash_password(_text(row, 'password'))
+        doctor_values = {'description': _text(row, 'description'), 'start_year': start_year,
+                         'medical_center_id': center_id, 'updated_at': now}
+        valid.append((username, user_values, doctor_values, department_ids))
+
+    new = [item for item in valid if item[0] not in existing]
+    changed = [item for item in valid if item[0] in existing]
+
+    if new:
+        connection.execute(insert(user_table), [
+            {'username': username, 'role': UserRole.DOCTOR, 'created_at': now, **user_values}
+            for username, user_values, _, _ in new
+        ])
+        new_ids = dict(connection.execute(select(user_table.c.username, user_table.c.id).where(
+            user_table.c.username.in_([username for username, _, _, _ in new]))).tuples().all())
+        connection.execute(insert(doctor_table), [
+            {'id': new_ids[username], 'created_at': now, **doctor_values} for username, _, doctor_values, _ in new
+        ])
+        stats_rollup.add_counters(connection, {'users': len(new), 'doctors': len(new)})
+    else:
+        new_ids = {}
+
+    if changed:
+        # Cập nhật theo nhóm cột giống nhau để dùng được executemany
+        by_columns = defaultdict(list)
+        for username, user_values, _, _ in changed:
+            by_columns[tuple(sorted(user_values))].append({'_id': existing[username].id, **user_values})
+        for columns, rows in by_columns.items():
+            connection.execute(update(user_table).where(user_table.c.id == bindparam('_id')).values(
+                {column: bindparam(column) for column in columns}), rows)
+        changed_ids = [existing[username].id for username, _, _, _ in changed]
+        with_profile = set(connection.execute(
+            select(doctor_table.c.id).where(doctor_table.c.id.in_(changed_ids))).scalars())
+        doctor_rows = [{'_id': existing[username].id, **doctor_values} for username, _, doctor_values, _ in changed]
+        if with_profile:
+            connection.execute(update(doctor_table).where(doctor_table.c.id == bindparam('_id')).values(
+                {column: bindparam(column) for column in ('description', 'start_year', 'medical_center_id',
+                                                          'updated_at')}),
+                [row for row in doctor_rows if row['_id'] in with_profile])
+        missing_profile = [row for row in doctor_rows if row['_id'] not in with_profile]
+        if missing_profile:
+            connection.execute(insert(doctor_table), [
+                {'id': row.pop('_id'), 'created_at': now, **row} for row in missing_profile])
+
+    # Chuyên khoa: chỉ thêm các liên kết còn thiếu
+    ids = {**new_ids, **{username: existing[username].id for username, _, _, _ in changed}}
+    wanted = {(ids[username], department_id) for username, _, _, department_ids in valid
+              for department_id in department_ids}
+    if wanted:
+        present = set(connection.execute(select(doctor_department_table.c.doctor_id,
+                                                doctor_department_table.c.department_id).where(
+            doctor_department_table.c.doctor_id.in_({doctor_id for doctor_id, _ in wanted}))).tuples().all())
+        links = sorted(wanted - present)
+        if links:
+            connection.execute(insert(doctor_department_table), [
+                {'doctor_id': doctor_id, 'department_id': department_id, 'created_at': now, 'updated_at': now}
+                for doctor_id, department_id in links])
+
+    # Lệnh Core không đi qua after_flush: cập nhật chỉ mục tìm kiếm trực tiếp
+    if ids:
+        doctor_search.refresh_search_documents(connection, list(ids.values()))
+    result.inserted, result.updated = len(new), len(changed)
+    return result
+
+
+# ---------------------------------------------------------------- lịch làm việc
+
+def import_schedules(batch, lookups):
+    result = BatchResult()
+    connection = db.session.connection()
+    usernames = {_text(row, 'doctor_username') for _, row in batch} - {None}
+    doctors = dict(connection.execute(select(user_table.c.username, user_table.c.id).where(
+        user_table.c.username.in_(usernames), user_table.c.role == UserRole.DOCTOR)).tuples().all())
+
+    slots_by_doctor = defaultdict(set)
+    for line_no, row in batch:
+        username = _text(row, 'doctor_username')
+        if username not in doctors:
+            result.errors.append((line_no, f"Không tìm thấy bác sĩ '{username}'"))
+            continue
+        try:
+            if _text(row, 'work_date'):
+                start_date = end_date = _date(_text(row, 'work_date'))
+            else:
+                start_date, end_date = _date(_text(row, 'start_date')), _date(_text(row, 'end_date'))
+            start_time = _time(_text(row, 'start_time'))
+            end_time = _time(_text(row, 'end_time')) if _text(row, 'end_time') else None
+            weekdays = {int(day) for day in (_text(row, 'weekdays') or '0;1;2;3;4;5;6').split(';') if day.strip()}
+        except (TypeError, ValueError):
+            result.errors.append((line_no, 'Ngày/giờ không hợp lệ (YYYY-MM-DD, HH:MM)'))
+            continue
+        if end_date < start_date or (end_date - start_date).days > schedules.MAX_TEMPLATE_DAYS:
+            result.errors.append((line_no, 'Khoảng ngày không hợp lệ'))
+            continue
+        if end_time is None:
+            shift_ids = [shift_id for shift_id, shift_start, _ in lookups['shifts'] if shift_start == start_time]
+        else:
+            shift_ids = [shift_id for shift_id, shift_start, shift_end in lookups['shifts']
+                         if shift_start >= start_time and shift_end <= end_time]
+        if not shift_ids:
+            result.errors.append((line_no, 'Không có ca làm việc nào trong khung giờ này'))
+            continue
+        day = start_date
+        while day <= end_date:
+            if day.weekday() in weekdays:
+                slots_by_doctor[doctors[username]].update((day, shift_id) for shift_id in shift_ids)
+            day += timedelta(days=1)
+
+    for doctor_id, slots in slots_by_doctor.items():
+        # materialize_shifts bỏ qua các ca đã có và tự cập nhật chỉ mục doctor_availability
+        result.inserted += schedules.materialize_shifts(doctor_id, slots)
+    return result
+
+
+IMPORTERS = {
+    'centers': (import_centers, ('medical_centers', 'doctors', 'doctor_cards', 'pages')),
+    'doctors': (import_doctors, ('doctors', 'doctor_cards', 'pages')),
+    'schedules': (import_schedules, ()),
+}
+
+
+def load_lookups():
+    return {
+        'centers': {_key(name): center_id for center_id, name in
+                    db.session.query(MedicalCenter.id, MedicalCenter.name)},
+        'departments': {_key(name): department_id for department_id, name in
+                        db.session.query(Department.id, Department.name)},
+        'shifts': db.session.query(Shift.id, Shift.start_time, Shift.end_time).order_by(Shift.start_time).all(),
+    }
+
+
+def _run_batch(importer, batch, lookups, report):
+    try:
+        result = importer(batch, lookups)
+        db.session.commit()
+        report.add(result)
+    except SQLAlchemyError:
+        # Lỗi từ CSDL (ví dụ trùng khóa do tiến trình khác ghi xen vào): làm lại từng dòng để cô lập dòng lỗi
+        db.session.rollback()
+        lookups.update(load_lookups())
+        for item in batch:
+            try:
+                result = importer([item], lookups)
+                db.session.commit()
+                report.add(result)
+            except SQLAlchemyError as e:
+                db.session.rollback()
+                report.errors.append((item[0], str(getattr(e, 'orig', e))))
+
+
+def run_import(kind, path, batch_size=DEFAULT_BATCH_SIZE, progress=True):
+    """Nhập file `path` cho loại `kind`; trả về ImportReport."""
+    importer, cache_tags = IMPORTERS[kind]
+    lookups = load_lookups()
+    report = ImportReport()
+    batch = []
+    for line_no, row, error in read_rows(path):
+        report.rows += 1
+        if error:
+            report.errors.append((line_no, error))
+            continue
+        batch.append((line_no, row))
+        if len(batch) >= batch_size:
+            _run_batch(importer, batch, lookups, report)
+            batch = []
+            if progress:
+                print(f"  ... {report.rows} dòng ({report.rows_per_second:,.0f} dòng/s)")
+    if batch:
+        _run_batch(importer, batch, lookups, report)
+    if cache_tags:
+        response_cache.backend.invalidate_tags(cache_tags)
+    if kind == 'centers':
+        # Ghi bằng Core nên không qua sự kiện ORM: báo cho mọi tiến trình nạp lại dữ liệu tham chiếu
+        reference_data.invalidate()
+    if kind in ('centers', 'doctors'):
+        # Tên bác sĩ/bệnh viện mới cho /api/suggestions
+        autocomplete.invalidate()
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Nhập hàng loạt bệnh viện, bác sĩ và lịch làm việc.')
+    parser.add_argument('kind', choices=sorted(IMPORTERS))
+    parser.add_argument('path', help='File .csv hoặc .jsonl')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--errors', help='Ghi các dòng lỗi ra file CSV này')
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.create_all()  # Chỉ tạo các bảng còn thiếu
+        report = run_import(args.kind, args.path, args.batch_size)
+
+    report.errors.sort(key=lambda error: error[0])
+    for line_no, message in report.errors[:20]:
+        print(f"  - Dòng {line_no}: {message}")
+    if len(report.errors) > 20:
+        print(f"  ... và {len(report.errors) - 20} lỗi khác")
+    if args.errors and report.errors:
+        with open(args.errors, 'w', encoding='utf-8', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['line', 'error'])
+            writer.writerows(report.errors)
+    print(f"Đã đọc {report.rows} dòng: thêm {report.inserted}, cập nhật {report.updated}, lỗi {len(report.errors)} "
+          f"({report.rows_per_second:,.0f} dòng/s).")
+    sys.exit(1 if report.errors else 0)
@@ -0,0 +1,191 @@
+# DatLichKhamOnline/doctor_search.py
+# Tìm kiếm bác sĩ qua chỉ mục đảo doctor_search_terms thay vì ILIKE '%q%' trên nhiều bảng: khớp tiền tố từ
+# (quét khoảng term >= 'q' trên khóa chính), không dùng FULLTEXT/trigram của CSDL để chạy như nhau trên
+# MySQL và SQLite. Các từ được giao nhau đầy đủ rồi mới xếp hạng và cắt theo trang.
+# Mỗi bác sĩ có một tài liệu tìm kiếm (tên, chuyên khoa, nơi công tác, mô tả) đã bỏ dấu tiếng Việt;
+# các từ của tài liệu được lưu kèm trọng số theo trường để xếp hạng kết quả.
+# Chỉ mục được cập nhật trong sự kiện after_flush khi User/Doctor/DoctorDepartment/Department/MedicalCenter thay đổi.
+from collections import defaultdict
+
+from sqlalchemy import event, select, delete, insert, union_all, func
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+
+from DatLichKhamOnline import app, db
+from DatLichKhamOnline.pagination import keyset_filter, keyset_order
+from DatLichKhamOnline.utils import fold_text, tokenize
+from models import User, Doctor, DoctorDepartment, Department, MedicalCenter, DoctorSearchDocument, DoctorSearchTerm
+
+document_table = DoctorSearchDocument.__table__
+term_table = DoctorSearchTerm.__table__
+
+# Trọng số theo trường: khớp tên bác sĩ quan trọng hơn khớp mô tả
+WEIGHT_NAME = 8
+WEIGHT_DEPARTMENT = 4
+WEIGHT_CENTER = 2
+WEIGHT_DESCRIPTION = 1
+
+MAX_QUERY_TOKENS = 8
+# Từ ngắn hơn MIN_PREFIX_LENGTH chỉ khớp nguyên từ: tiền tố "b", "ng" khớp gần như mọi bác sĩ
+MIN_PREFIX_LENGTH = 3
+BATCH_SIZE = 500
+
+
+def _build_documents(connection, doctor_ids):
+    """Đọc dữ liệu gốc và dựng (content, {term: weight}) cho từng bác sĩ."""
+    users = User.__table__
+    doctors = Doctor.__table__
+    centers = MedicalCenter.__table__
+    rows = connection.execute(
+        select(doctors.c.id, users.c.first_name, users.c.last_name, doctors.c.description,
+               centers.c.name.label('center_name'))
+        .select_from(doctors.join(users, users.c.id == doctors.c.id)
+                     .outerjoin(centers, centers.c.id == doctors.c.medical_center_id))
+        .where(doctors.c.id.in_(doctor_ids))
+    ).all()
+
+    department_names = defaultdict(list)
+    for doctor_id, name in connection.execute(
+        select(DoctorDepartment.__table__.c.doctor_id, Department.__table__.c.name)
+        .select_from(DoctorDepartment.__table__.join(
+            Department.__table__, Department.__table__.c.id == DoctorDepartment.__table__.c.department_id))
+        .where(DoctorDepartment.__table__.c.doctor_id.in_(doctor_ids))
+    ):
+        department_names[doctor_id].append(name)
+
+    documents = {}
+    for row in rows:
+        fields = [
+            (f"{row.first_name or ''} {row.last_name or ''}", WEIGHT_NAME),
+            (' '.join(department_names[row.id]), WEIGHT_DEPARTMENT),
+            (row.center_name, WEIGHT_CENTER),
+            (row.description, WEIGHT_DESCRIPTION),
+        ]
+        terms = {}
+        for text, weight in fields:
+            for term in tokenize(text):
+                term = term[:64]
+                if terms.get(term, 0) < weight:
+                    terms[term] = weight
+        content = ' | '.join(fold_text(text) for text, _ in fields if text)
+        documents[row.id] = (content, terms)
+    return documents
+
+
+def refresh_search_documents(connection, doctor_ids):
+    """Dựng lại tài liệu và các từ chỉ mục cho danh sách bác sĩ."""
+    doctor_ids = sorted({doctor_id for doctor_id in doctor_ids if doctor_id is not None})
+    for start in range(0, len(doctor_ids), BATCH_SIZE):
+        batch = doctor_ids[start:start + BATCH_SIZE]
+        documents = _build_documents(connection, batch)
+        connection.execute(delete(term_table).where(term_table.c.doctor_id.in_(batch)))
+        connection.execute(delete(document_table).where(document_table.c.doctor_id.in_(batch)))
+        if not documents:
+            continue
+        connection.execute(insert(document_table), [
+            {'doctor_id': doctor_id, 'content': content} for doctor_id, (content, _) in documents.items()
+        ])
+        term_rows = [{'term': term, 'doctor_id': doctor_id, 'weight': weight}
+                     for doctor_id, (_, terms) in documents.items() for term, weight in terms.items()]
+        if term_rows:
+            connection.execute(insert(term_table), term_rows)
+
+
+def rebuild_search_index():
+    """Dựng lại chỉ mục tìm kiếm cho toàn bộ bác sĩ."""
+    connection = db.session.connection()
+    doctor_ids = [doctor_id for doctor_id, in connection.execute(select(Doctor.__table__.c.id))]
+    connection.execute(delete(term_table))
+    connection.execute(delete(document_table))
+    refresh_search_documents(connection, doctor_ids)
+    db.session.commit()
+    return len(doctor_ids)
+
+
+def rank_doctors(query, limit=None, after=None):
+    """Tìm các bác sĩ khớp với mọi từ trong query (khớp tiền tố), xếp theo độ liên quan.
+
+    Trả về list (doctor_id, score). `after` là (score, doctor_id) của dòng cuối trang trước.
+    """
+    tokens = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TOKENS]
+    if not tokens:
+        return []
+
+    def matches(token):
+        """(doctor_id, trọng số lớn nhất) của một từ qua chỉ mục (term, doctor_id)."""
+        if len(token) >= MIN_PREFIX_LENGTH:
+            # Khoảng [token, token kế tiếp) thay cho LIKE 'token%' (SQLite không dùng chỉ mục cho LIKE)
+            condition = (term_table.c.term >= token) & (term_table.c.term < token[:-1] + chr(ord(token[-1]) + 1))
+        else:
+            condition = term_table.c.term == token
+        # Không cắt số dòng của từng từ: cắt trước khi giao nhau sẽ làm mất các bác sĩ khớp đủ mọi từ
+        return select(term_table.c.doctor_id, func.max(term_table.c.weight).label('weight')).where(
+            condition).group_by(term_table.c.doctor_id)
+
+    per_token = union_all(*[matches(token) for token in tokens]).subquery()
+    ranked = select(per_token.c.doctor_id, func.sum(per_token.c.weight).label('score')).group_by(
+        per_token.c.doctor_id
+    ).having(func.count() == len(tokens)).subquery()
+
+    columns = [(ranked.c.score, True), (ranked.c.doctor_id, False)]
+    statement = select(ranked.c.doctor_id, ranked.c.score).order_by(*keyset_order(columns))
+    if after:
+        statement = statement.where(keyset_filter(columns, after))
+    if limit:
+        statement = statement.limit(limit)
+    return [(row.doctor_id, row.score) for row in db.session.execute(statement)]
+
+
+def search_doctor_ids(query, limit=None):
+    """Danh sách doctor_id khớp với query, xếp theo độ liên quan."""
+    return [doctor_id for doctor_id, _ in rank_doctors(query, limit)]
+
+
+def _changed(obj, *attrs):
+    return any(get_history(obj, attr).has_changes() for attr in attrs)
+
+
+@event.listens_for(Session, 'after_flush')
+def _sync_search_documents(session, flush_context):
+    """Cập nhật tài liệu tìm kiếm của những bác sĩ bị ảnh hưởng bởi lần flush này."""
+    doctor_ids = set()
+    department_ids = set()
+    center_ids = set()
+    for obj in list(session.new) + list(session.deleted):
+        if isinstance(obj, (User, Doctor)):
+            doctor_ids.add(obj.id)
+        elif isinstance(obj, DoctorDepartment):
+            doctor_ids.add(obj.doctor_id)
+    for obj in session.dirty:
+        if isinstance(obj, User) and _changed(obj, 'first_name', 'last_name'):
+            doctor_ids.add(obj.id)
+        elif isinstance(obj, Doctor) and _changed(obj, 'description', 'medical_center_id'):
+            doctor_ids.add(obj.id)
+        elif isinstance(obj, DoctorDepartment) and _changed(obj, 'doctor_id', 'department_id'):
+            doctor_ids.add(obj.doctor_id)
+            doctor_ids.update(get_history(obj, 'doctor_id').deleted)
+        elif isinstance(obj, Department) and _changed(obj, 'name'):
+            department_ids.add(obj.id)
+        elif isinstance(obj, MedicalCenter) and _changed(obj, 'name'):
+            center_ids.add(obj.id)
+
+    if not (doctor_ids or department_ids or center_ids):
+        return
+
+    connection = session.connection()
+    if department_ids:
+        doctor_ids.update(connection.execute(
+            select(DoctorDepartment.__table__.c.doctor_id)
+            .where(DoctorDepartment.__table__.c.department_id.in_(department_ids))
+        ).scalars())
+    if center_ids:
+        doctor_ids.update(connection.execute(
+            select(Doctor.__table__.c.id).where(Doctor.__table__.c.medical_center_id.in_(center_ids))
+        ).scalars())
+    refresh_search_documents(connection, doctor_ids)
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        db.create_all()  # Chỉ tạo các bảng còn thiếu
+        print(f"Đã dựng lại chỉ mục tìm kiếm cho {rebuild_search_index()} bác sĩ.")
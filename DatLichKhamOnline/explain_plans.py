@@ -0,0 +1,243 @@
+# DatLichKhamOnline/explain_plans.py
+# Kiểm tra kế hoạch thực thi của các truy vấn nóng: dựng CSDL thử nghiệm (create_all rồi migrations.upgrade – các
+# migration phải không còn việc gì trên lược đồ mới), sinh đủ dữ liệu để bộ tối ưu dùng thống kê thật, gọi các
+# route và job nền, ghi lại mọi câu SELECT chạm vào bảng nóng rồi EXPLAIN lại từng câu với đúng tham số của nó.
+# Một câu không đạt khi kế hoạch quét toàn bộ một bảng nóng:
+#   - SQLite: dòng "SCAN <bảng>" của EXPLAIN QUERY PLAN (kể cả "SCAN ... USING INDEX" – quét hết chỉ mục)
+#   - MySQL: dòng EXPLAIN có type ALL hoặc index trên bảng nóng
+#
+#   python explain_plans.py              # SQLite trong bộ nhớ; thoát với mã 1 nếu có câu quét toàn bảng
+#   python explain_plans.py --db-uri mysql+pymysql://u:p@localhost/mas_explain -v
+#
+# Chỉ dùng với CSDL thử nghiệm: script tạo lại toàn bộ bảng.
+import argparse
+import os
+import re
+import sys
+from collections import namedtuple
+from datetime import date, datetime, time, timedelta
+
+parser = argparse.ArgumentParser(description='Kiểm tra EXPLAIN của các truy vấn nóng')
+parser.add_argument('--db-uri', help='Mặc định: SQLite trong bộ nhớ')
+parser.add_argument('--doctors', type=int, default=40)
+parser.add_argument('--days', type=int, default=30)
+parser.add_argument('--clients', type=int, default=200)
+parser.add_argument('--only', help='Chỉ kiểm tra các kịch bản có tên trong danh sách (cách nhau bởi dấu phẩy)')
+parser.add_argument('-v', '--verbose', action='store_true', help='In kế hoạch của mọi câu, không chỉ câu lỗi')
+args = parser.parse_args()
+
+os.environ['DATABASE_URL'] = args.db_uri or 'sqlite://'
+
+from sqlalchemy import event, insert
+from sqlalchemy.engine import Engine
+
+from DatLichKhamOnline import app, db, index, migrations, payments, response_cache, schedules, stats_rollup, \
+    doctor_search, ticket_expiry, archive, analytics, pagination
+from models import User, UserRole, Doctor, DoctorDepartment, Department, MedicalCenter, Shift, DoctorShift, \
+    Ticket, TicketStatus, PaymentAttempt, PaymentNotification
+
+PASSWORD = '123'
+HOT_TABLES = ('doctor_shifts', 'tickets', 'doctor_availability', 'payment_attempts', 'payment_notifications',
+              'doctor_shifts_archive', 'tickets_archive')
+HOT_PATTERN = re.compile(r'\b(?:%s)\b' % '|'.join(HOT_TABLES))
+
+Scenario = namedtuple('Scenario', 'name user action')
+
+
+def scenarios(fixtures):
+    """Kịch bản: (tên, người dùng đăng nhập, URL hoặc hàm chạy trong app context)."""
+    day = fixtures['day'].isoformat()
+    doctor_id = fixtures['doctor_id']
+    return [
+        Scenario('doctor_details', None, f'/doctor_details/{doctor_id}'),
+        Scenario('book_appointment', 'patient', f'/book_appointment/{doctor_id}?appointment_date={day}'),
+        Scenario('appointment_history', 'patient', '/appointment_history'),
+        Scenario('api_appointment_history', 'patient', '/api/appointment-history'),
+        Scenario('doctor_dashboard', 'doctor0', '/doctor/dashboard'),
+        Scenario('doctor_appointments', 'doctor0', f'/doctor/appointments?date={day}'),
+        Scenario('api_doctor_appointments', 'doctor0', f'/api/doctor/appointments?date={day}'),
+        Scenario('doctor_edit_shift', 'doctor0', f'/doctor/edit_shift/{day}'),
+        Scenario('api_availability', None, '/api/availability?department_id=1&days=14'),
+        Scenario('api_earliest_slots', None, '/api/earliest-slots?department_id=1&from=07:00&to=12:00'),
+        Scenario('materialize_shifts', None,
+                 lambda: schedules.materialize_shifts(doctor_id, {(fixtures['day'], 1), (fixtures['day'], 2)})),
+        Scenario('ticket_expiry', None, ticket_expiry.expire_pending),
+        Scenario('payment_queue', None, payments.process_batch),
+        # Các kịch bản sau chạy trên dữ liệu đã lưu trữ (ARCHIVE_AFTER_DAYS = --days / 4)
+        Scenario('archive_old', None, archive.archive_old),
+        Scenario('archived_history', 'patient', f"/api/appointment-history?cursor={fixtures['archive_cursor']}"),
+        Scenario('archived_demand_report', None,
+                 lambda: analytics.demand_report(fixtures['day'] - timedelta(days=args.days), fixtures['day'])),
+    ]
+
+
+def build():
+    """Tạo lại CSDL với dữ liệu mẫu. Trả về id/ngày dùng trong kịch bản."""
+    db.drop_all()
+    with db.engine.begin() as connection:
+        migrations.version_table.drop(connection, checkfirst=True)
+    db.create_all()
+    migrations.upgrade()  # lược đồ mới đã đủ bảng/chỉ mục: chỉ ghi nhận phiên bản
+
+    password = User.hash_password(PASSWORD)
+    connection = db.session.connection()
+    connection.execute(insert(MedicalCenter.__table__), [
+        {'id': number, 'name': f'Bệnh viện {number}', 'address': 'Hà Nội'} for number in range(1, 6)])
+    connection.execute(insert(Department.__table__), [
+        {'id': number, 'name': name} for number, name in enumerate(('Tim mạch', 'Nhi khoa', 'Da liễu', 'Mắt'), 1)])
+    connection.execute(insert(Shift.__table__), [
+        {'start_time': time(hour, minute), 'end_time': time(hour + (minute + 30) // 60, (minute + 30) % 60),
+         'bit': (hour - 7) * 2 + minute // 30}
+        for hour in range(7, 23) for minute in (0, 30)])
+
+    users = [{'id': 1, 'username': 'patient', 'role': UserRole.USER}]
+    users += [{'id': 1 + number, 'username': f'client{number}', 'role': UserRole.USER}
+              for number in range(1, args.clients)]
+    doctor_ids = list(range(args.clients + 1, args.clients + 1 + args.doctors))
+    users += [{'id': doctor_id, 'username': f'doctor{number}', 'role': UserRole.DOCTOR}
+              for number, doctor_id in enumerate(doctor_ids)]
+    connection.execute(insert(User.__table__), [
+        {**user, 'password': password, 'email': f"{user['username']}@example.com", 'first_name': 'Nguyễn Văn',
+         'last_name': user['username']} for user in users])
+    connection.execute(insert(Doctor.__table__), [
+        {'id': doctor_id, 'medical_center_id': number % 5 + 1, 'start_year': 2010}
+        for number, doctor_id in enumerate(doctor_ids)])
+    connection.execute(insert(DoctorDepartment.__table__), [
+        {'doctor_id': doctor_id, 'department_id': number % 4 + 1} for number, doctor_id in enumerate(doctor_ids)])
+
+    # Lịch trải từ quá khứ tới tương lai; khoảng 1/3 số ca có vé, vé của 'patient' đủ nhiều trang
+    today = date.today()
+    shifts, tickets = [], []
+    for number, doctor_id in enumerate(doctor_ids):
+        for day in range(-args.days // 2, args.days - args.days // 2):
+            for shift_id in range(1 + (number + day) % 6, 33, 3):
+                shifts.append({'id': len(shifts) + 1, 'doctor_id': doctor_id, 'shift_id': shift_id,
+                               'work_date': today + timedelta(days=day)})
+                if len(shifts) % 3 == 0:
+                    client_id = 1 if len(tickets) % 40 == 0 else len(tickets) % args.clients + 1
+                    status = TicketStatus.CONFIRMED if day >= 0 else TicketStatus.COMPLETED
+                    tickets.append({'doctor_shift_id': len(shifts), 'client_id': client_id, 'status': status,
+                                    'uuid': f'ticket-{len(tickets)}', 'first_name': 'Trần Thị', 'last_name': 'Lan',
+                                    'birth_of_day': date(1990, 1, 1), 'gender': 'Nữ',
+                                    'created_at': datetime.now() - timedelta(days=max(0, -day) + 1)})
+    for start in range(0, len(shifts), 5000):
+        connection.execute(insert(DoctorShift.__table__), shifts[start:start + 5000])
+    for start in range(0, len(tickets), 5000):
+        connection.execute(insert(Ticket.__table__), tickets[start:start + 5000])
+    connection.execute(insert(PaymentAttempt.__table__), [
+        {'idempotency_key': f'key-{number}', 'order_id': f'order-{number}', 'ticket_id': number + 1,
+         'method': 'MOMO'} for number in range(0, len(tickets), 2)])
+    connection.execute(insert(PaymentNotification.__table__), [
+        {'gateway_txn_id': f'txn-{number}', 'order_id': f'order-{number}', 'result_code': 0,
+         'gateway_time': datetime.now(), 'payload': '{}', 'processed_at': datetime.now(), 'outcome': 'applied'}
+        for number in range(0, len(tickets), 2)])
+    db.session.commit()
+    stats_rollup.backfill()
+    doctor_search.rebuild_search_index()
+    db.session.commit()
+
+    with db.engine.begin() as connection:
+        if connection.dialect.name == 'mysql':
+            connection.exec_driver_sql('ANALYZE TABLE ' + ', '.join(HOT_TABLES))
+        else:
+            connection.exec_driver_sql('ANALYZE')
+    print(f'{len(doctor_ids)} bác sĩ, {len(shifts):,} ca, {len(tickets):,} vé')
+    return {'doctor_id': doctor_ids[0], 'day': today + timedelta(days=1),
+            'archive_cursor': pagination.encode_cursor((archive.archive_cutoff(), time(0, 0), 0))}
+
+
+def _base_table(name):
+    """Tên bảng gốc của một bí danh SQLAlchemy (doctor_shifts_1 -> doctor_shifts)."""
+    return re.sub(r'_\d+$', '', name or '')
+
+
+def full_scans(connection, statement, parameters):
+    """(các dòng kế hoạch quét toàn bộ bảng nóng, toàn bộ kế hoạch) của một câu SELECT."""
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        plan = [row[-1] for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)]
+        scans = [line for line in plan
+                 if (match := re.match(r'SCAN (\w+)', line)) and _base_table(match.group(1)) in HOT_TABLES]
+        return scans, plan
+    if dialect == 'mysql':
+        rows = connection.exec_driver_sql('EXPLAIN ' + statement, parameters).mappings().all()
+        plan = [f"{row['table']}: type={row['type']} key={row['key']} rows={row['rows']} {row['Extra'] or ''}"
+                for row in rows]
+        scans = [line for line, row in zip(plan, rows)
+                 if row['type'] in ('ALL', 'index') and _base_table(row['table']) in HOT_TABLES]
+        return scans, plan
+    sys.exit(f'Chưa hỗ trợ EXPLAIN cho {dialect}')
+
+
+def capture(run):
+    """Chạy `run()` và trả về các câu SELECT (không trùng) chạm vào bảng nóng: list (câu lệnh, tham số)."""
+    statements = {}
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith('SELECT') and HOT_PATTERN.search(statement):
+            statements.setdefault(statement, parameters)
+
+    event.listen(Engine, 'before_cursor_execute', record)
+    try:
+        run()
+    finally:
+        event.remove(Engine, 'before_cursor_execute', record)
+    return list(statements.items())
+
+
+def run_scenario(scenario, clients):
+    if callable(scenario.action):
+        def run():
+            with app.app_context():
+                scenario.action()
+                db.session.rollback()
+    else:
+        def run():
+            response = clients[scenario.user].get(scenario.action)
+            if response.status_code >= 400:
+                sys.exit(f'{scenario.name}: HTTP {response.status_code}')
+    response_cache.backend.clear()
+    return capture(run)
+
+
+if __name__ == '__main__':
+    app.config['TESTING'] = True
+    app.config['SQL_PROFILER_TOOLBAR'] = False
+    app.config['ARCHIVE_AFTER_DAYS'] = args.days // 4
+    app.config['ARCHIVE_BATCH_SIZE'] = 1000
+    app.config['ARCHIVE_PAUSE'] = 0
+    selected = set(args.only.split(',')) if args.only else None
+    with app.app_context():
+        fixtures = build()
+        items = [scenario for scenario in scenarios(fixtures) if not selected or scenario.name in selected]
+    clients = {}
+    for user in {scenario.user for scenario in items}:
+        clients[user] = app.test_client()
+        if user:
+            clients[user].post('/user_login', data={'username': user, 'password': PASSWORD})
+
+    failed = 0
+    print(f"{'kịch bản':<28}{'câu':>6}  kết quả")
+    for scenario in items:
+        # Lần đầu nạp các cache trong bộ nhớ (dữ liệu tham chiếu, thứ tự ca...), lần hai mới ghi lại
+        run_scenario(scenario, clients)
+        statements = run_scenario(scenario, clients)
+        reports = []
+        with app.app_context(), db.engine.connect() as connection:
+            for statement, parameters in statements:
+                scans, plan = full_scans(connection, statement, parameters)
+                reports.append((statement, scans, plan))
+        bad = [report for report in reports if report[1]]
+        failed += bool(bad)
+        print(f"{scenario.name:<28}{len(reports):>6}  "
+              + (f"QUÉT TOÀN BẢNG: {'; '.join(scan for _, scans, _ in bad for scan in scans)}" if bad else 'OK'))
+        for statement, scans, plan in reports:
+            if scans or args.verbose:
+                print(f"      {' '.join(statement.split())[:200]}")
+                for line in plan:
+                    print(f"        {'!!' if line in scans else '  '} {line}")
+
+    if failed:
+        print(f"\n{failed} kịch bản có truy vấn quét toàn bộ bảng nóng.")
+        sys.exit(1)
+    print("\nMọi truy vấn nóng đều dùng chỉ mục.")
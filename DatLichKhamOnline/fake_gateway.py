@@ -0,0 +1,213 @@
+# DatLichKhamOnline/fake_gateway.py
+# Cổng thanh toán giả lập để kiểm tra hàng đợi IPN (payments.py): tạo N vé PENDING, mỗi vé một PaymentAttempt,
+# rồi bắn hàng nghìn IPN đã ký tới /payment/ipn qua Flask test client từ nhiều luồng – mỗi giao dịch được gửi
+# lặp lại nhiều lần, toàn bộ bị xáo trộn thứ tự (thông báo thất bại cũ có thể đến sau thông báo thành công).
+# Sau khi worker xử lý hết hàng đợi, kiểm tra:
+#   - mỗi giao dịch chỉ có đúng một dòng trong payment_notifications,
+#   - vé có giao dịch thành công -> CONFIRMED, vé chỉ có giao dịch thất bại/không thanh toán -> vẫn PENDING,
+#   - số outcome 'applied' bằng số vé đã thanh toán, hàng đợi rỗng.
+# CSDL chỉ định bởi --db-uri bị TẠO LẠI từ đầu.
+#
+#   python fake_gateway.py                       # 2000 vé, tối đa 4 bản gửi lặp mỗi giao dịch, 8 luồng
+#   python fake_gateway.py --tickets 5000 --duplicates 6 --threads 16 --worker thread
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time as timer
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, time, timedelta
+
+DEFAULT_DB_PATH = os.path.join(tempfile.gettempdir(), 'mas_fake_gateway.sqlite3')
+
+parser = argparse.ArgumentParser(description='Bắn IPN trùng lặp/sai thứ tự vào hàng đợi thanh toán')
+parser.add_argument('--db-uri', help=f'CSDL dùng để kiểm tra (bị tạo lại). Mặc định: sqlite:///{DEFAULT_DB_PATH}')
+parser.add_argument('--tickets', type=int, default=2000, help='Số vé chờ thanh toán')
+parser.add_argument('--duplicates', type=int, default=4, help='Số lần gửi tối đa của mỗi IPN')
+parser.add_argument('--threads', type=int, default=8, help='Số luồng gửi IPN đồng thời')
+parser.add_argument('--worker', choices=('after', 'thread'), default='after',
+                    help="'after': xử lý hàng đợi sau khi gửi xong; 'thread': worker nền chạy song song khi gửi")
+parser.add_argument('--seed', type=int, default=42)
+args = parser.parse_args()
+
+if args.db_uri is None and os.path.exists(DEFAULT_DB_PATH):
+    os.remove(DEFAULT_DB_PATH)
+os.environ['DATABASE_URL'] = args.db_uri or 'sqlite:///' + DEFAULT_DB_PATH
+
+from sqlalchemy import event
+
+from DatLichKhamOnline import app, db, index, payments  # index đăng ký toàn bộ route
+from models import User, UserRole, Doctor, DoctorShift, Ticket, TicketStatus, MedicalCenter, Shift, \
+    PaymentNotification
+
+DOCTORS = 20
+
+
+def tune_sqlite(engine):
+    """SQLite chỉ cho một luồng ghi: dùng WAL và chờ khóa lâu hơn để các luồng gửi IPN xếp hàng thay vì lỗi
+    'database is locked' (MySQL/PostgreSQL không cần)."""
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def _pragmas(connection, record):
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout=30000')
+        cursor.close()
+
+
+def build_fixtures(ticket_count):
+    """Tạo lại CSDL với `ticket_count` vé PENDING (mỗi vé một ca riêng) và PaymentAttempt tương ứng."""
+    db.drop_all()
+    db.create_all()
+    center = MedicalCenter(name='Bệnh viện Bạch Mai', address='Hà Nội')
+    shift = Shift(start_time=time(8, 0), end_time=time(8, 30))
+    patient = User(username='patient', password=User.hash_password('123'), email='patient@example.com',
+                   role=UserRole.USER, first_name='Trần Thị', last_name='Lan')
+    db.session.add_all([center, shift, patient])
+    db.session.flush()
+    doctors = []
+    for number in range(DOCTORS):
+        user = User(username=f'doctor{number}', password=patient.password, email=f'doctor{number}@example.com',
+                    role=UserRole.DOCTOR, first_name='Nguyễn Văn', last_name=f'Bình {number}')
+        db.session.add(user)
+        db.session.flush()
+        db.session.add(Doctor(id=user.id, medical_center_id=center.id, start_year=2010))
+        doctors.append(user.id)
+
+    today = date.today()
+    tickets = []
+    for number in range(ticket_count):
+        doctor_shift = DoctorShift(doctor_id=doctors[number % DOCTORS], shift_id=shift.id,
+                                   work_date=today + timedelta(days=number // DOCTORS + 1))
+        ticket = Ticket(doctor_shift=doctor_shift, client_id=patient.id, status=TicketStatus.PENDING,
+                        first_name='Trần Thị', last_name='Lan', birth_of_day=date(1990, 1, 1), gender='Nữ')
+        db.session.add(ticket)
+        tickets.append(ticket)
+    db.session.commit()
+    return [payments.get_or_create_attempt(ticket, 'momo') for ticket in tickets]
+
+
+def ipn(order_id, txn_id, result_code, gateway_time):
+    fields = {'order_id': order_id, 'txn_id': txn_id, 'result_code': result_code,
+              'gateway_time': gateway_time.isoformat()}
+    return dict(fields, signature=payments.sign(fields))
+
+
+def build_traffic(attempts, duplicates, rng):
+    """Danh sách IPN đã xáo trộn và tập ticket_id được thanh toán thành công.
+
+    70% vé: một lần thất bại rồi một lần thành công (đôi khi thêm một thông báo thất bại muộn hơn);
+    20% vé: chỉ có giao dịch thất bại; 10% vé: không có IPN nào."""
+    traffic, paid, transactions = [], set(), 0
+    base = datetime.now()
+    for attempt in attempts:
+        roll = rng.random()
+        if roll >= 0.9:
+            continue
+        events = [(1, 0)]
+        if roll < 0.7:
+            events.append((0, 1))
+            paid.add(attempt.ticket_id)
+            if rng.random() < 0.3:
+                events.append((1, 2))
+        for number, (result_code, offset) in enumerate(events):
+            payload = ipn(attempt.order_id, f'TXN-{attempt.order_id}-{number}', result_code,
+                          base + timedelta(seconds=offset))
+            traffic.extend([payload] * rng.randint(1, duplicates))
+            transactions += 1
+    rng.shuffle(traffic)
+    return traffic, paid, transactions
+
+
+def send(traffic, threads):
+    """Gửi toàn bộ IPN, mỗi luồng một test client. Trả về (độ trễ từng request ms, số request không được 200)."""
+    local = threading.local()
+
+    def post(payload):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        started = timer.perf_counter()
+        response = local.client.post('/payment/ipn', json=payload)
+        return (timer.perf_counter() - started) * 1000, response.status_code
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(post, traffic))
+    return [latency for latency, _ in results], sum(1 for _, status in results if status != 200)
+
+
+def wait_for_queue(timeout=120):
+    deadline = timer.monotonic() + timeout
+    while timer.monotonic() < deadline:
+        with app.app_context():
+            if not payments.queue_depth():
+                return True
+        timer.sleep(0.2)
+    return False
+
+
+def main():
+    rng = random.Random(args.seed)
+    app.config['TESTING'] = True
+    app.config['PAYMENT_WORKER'] = 'thread' if args.worker == 'thread' else 'off'
+
+    with app.app_context():
+        tune_sqlite(db.engine)
+        attempts = build_fixtures(args.tickets)
+        traffic, paid, transactions = build_traffic(attempts, args.duplicates, rng)
+        ticket_ids = [attempt.ticket_id for attempt in attempts]
+    print(f'{args.tickets} vé, {transactions} giao dịch, {len(traffic)} IPN (đã nhân bản và xáo trộn)')
+
+    started = timer.perf_counter()
+    latencies, rejected = send(traffic, args.threads)
+    elapsed = timer.perf_counter() - started
+    latencies.sort()
+    print(f'Gửi IPN: {len(traffic) / elapsed:.0f} req/s, ack p50 {statistics.median(latencies):.1f} ms, '
+          f'p99 {latencies[int(len(latencies) * 0.99) - 1]:.1f} ms, không phải 200: {rejected}')
+
+    started = timer.perf_counter()
+    if args.worker == 'thread':
+        drained = wait_for_queue()
+    else:
+        with app.app_context():
+            payments.drain()
+        drained = True
+    print(f'Xử lý hàng đợi: {timer.perf_counter() - started:.2f} s sau khi gửi xong')
+
+    failures = []
+    with app.app_context():
+        stored = db.session.query(PaymentNotification).count()
+        outcomes = Counter(dict(db.session.query(PaymentNotification.outcome, db.func.count()).group_by(
+            PaymentNotification.outcome).tuples().all()))
+        statuses = dict(db.session.query(Ticket.id, Ticket.status).filter(Ticket.id.in_(ticket_ids)).tuples().all())
+        pending = payments.queue_depth()
+    print(f'Outcome: {dict(outcomes)}')
+
+    if not drained or pending:
+        failures.append(f'hàng đợi còn {pending} IPN chưa xử lý')
+    if rejected:
+        failures.append(f'{rejected} IPN không được trả lời 200')
+    if stored != transactions:
+        failures.append(f'{stored} dòng payment_notifications cho {transactions} giao dịch')
+    if outcomes.get(payments.APPLIED, 0) != len(paid):
+        failures.append(f"{outcomes.get(payments.APPLIED, 0)} outcome 'applied' cho {len(paid)} vé đã thanh toán")
+    wrong = [ticket_id for ticket_id, status in statuses.items()
+             if status != (TicketStatus.CONFIRMED if ticket_id in paid else TicketStatus.PENDING)]
+    if wrong:
+        failures.append(f'{len(wrong)} vé sai trạng thái (ví dụ: {wrong[:5]})')
+
+    for failure in failures:
+        print(f'LỖI: {failure}')
+    if not failures:
+        print('Trạng thái vé đúng sau IPN trùng lặp/sai thứ tự.')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,66 @@
+# DatLichKhamOnline/fragment_cache.py
+# Cache HTML đã render của các mảnh giao diện lặp lại nhiều lần trên một trang (thẻ bác sĩ trong
+# doctor_list.html và medical_center_details.html). Dùng chung backend với response_cache (memory hoặc
+# SQLite dùng chung giữa các worker).
+#
+# Khóa gồm id bác sĩ và updated_at của User/Doctor: sửa hồ sơ, đổi ảnh đại diện hay nơi công tác làm
+# updated_at thay đổi nên khóa cũ tự hết hiệu lực. Tên chuyên khoa, tên bệnh viện và liên kết bác sĩ –
+# chuyên khoa không làm đổi updated_at của bác sĩ; các mục được gắn tag 'doctor_cards' và bị xóa khi các
+# model đó được commit (xem response_cache.MODEL_TAGS).
+#
+# Cấu hình qua app.config:
+#   FRAGMENT_CACHE_ENABLED = bật/tắt cache (tắt thì luôn render lại)
+#   FRAGMENT_CACHE_TTL     = thời gian sống (giây) của mỗi mảnh
+import time
+from collections import Counter
+from datetime import datetime
+
+from markupsafe import Markup
+
+from DatLichKhamOnline import app, response_cache
+
+app.config.setdefault('FRAGMENT_CACHE_ENABLED', True)
+app.config.setdefault('FRAGMENT_CACHE_TTL', 3600)
+
+DOCTOR_CARD_TEMPLATE = 'doctor/doctor_card.html'
+stats = Counter()
+
+
+def _stamp(*objects):
+    stamps = [obj.updated_at for obj in objects if obj is not None and obj.updated_at is not None]
+    return max(stamps).isoformat() if stamps else '-'
+
+
+def doctor_card_key(doctor_user, doctor):
+    # Số năm kinh nghiệm phụ thuộc năm hiện tại nên năm cũng nằm trong khóa
+    return f'fragment:doctor_card:{doctor_user.id}:{_stamp(doctor_user, doctor)}:{datetime.now().year}'
+
+
+@app.template_global()
+def doctor_card(doctor_user, doctor=None):
+    """HTML thẻ bác sĩ, lấy từ cache nếu có.
+
+    `doctor` mặc định là doctor_user.doctor; truyền vào khi đã có sẵn đối tượng Doctor (trang bệnh viện
+    nạp Doctor -> User) để tránh nạp lười quan hệ ngược User.doctor.
+    """
+    if doctor is None:
+        doctor = doctor_user.doctor
+    key = doctor_card_key(doctor_user, doctor)
+    if app.config['FRAGMENT_CACHE_ENABLED']:
+        entry = response_cache.backend.get(key)
+        if entry is not None:
+            stats['doctor_card.hit'] += 1
+            return Markup(entry.body.decode('utf-8'))
+        stats['doctor_card.miss'] += 1
+
+    html = app.jinja_env.get_template(DOCTOR_CARD_TEMPLATE).render(
+        doctor_user=doctor_user, doctor=doctor, current_year=datetime.now().year)
+    if app.config['FRAGMENT_CACHE_ENABLED']:
+        response_cache.backend.set(key, response_cache.CacheEntry(
+            html.encode('utf-8'), None, 'text/html', ('doctor_cards',),
+            time.time() + app.config['FRAGMENT_CACHE_TTL']))
+    return Markup(html)
+
+
+def cache_stats():
+    return dict(stats)
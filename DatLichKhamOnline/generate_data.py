@@ -0,0 +1,297 @@
+# DatLichKhamOnline/generate_data.py
+# Sinh dữ liệu giả lập quy mô lớn theo đúng schema trong models.py để thử hiệu năng:
+# bệnh viện, bác sĩ (nhiều chuyên khoa), bệnh nhân, DoctorShift và Ticket với phân bố lệch
+# (một số bệnh viện/bác sĩ/bệnh nhân chiếm phần lớn dữ liệu, giống thực tế).
+#
+#   python generate_data.py                                  # preset 'small', SQLite file trong thư mục tạm
+#   python generate_data.py --preset large                   # 50k bác sĩ, 10M DoctorShift, 5M Ticket
+#   python generate_data.py --db-uri mysql+pymysql://u:p@localhost/mas_bench --doctors 20000
+#
+# Chỉ dùng với CSDL thử nghiệm. Mọi tài khoản sinh ra có mật khẩu '123'.
+import argparse
+import os
+import tempfile
+import time as timer
+import uuid
+from datetime import date, datetime, time, timedelta
+
+PRESETS = {
+    'small': dict(centers=60, doctors=2_000, clients=5_000, doctor_shifts=200_000, tickets=100_000),
+    'medium': dict(centers=200, doctors=10_000, clients=50_000, doctor_shifts=2_000_000, tickets=1_000_000),
+    'large': dict(centers=500, doctors=50_000, clients=200_000, doctor_shifts=10_000_000, tickets=5_000_000),
+}
+DEFAULT_DB_PATH = os.path.join(tempfile.gettempdir(), 'mas_bench.sqlite3')
+
+parser = argparse.ArgumentParser(description='Sinh dữ liệu giả lập quy mô lớn')
+parser.add_argument('--db-uri', help=f'Mặc định: sqlite:///{DEFAULT_DB_PATH}')
+parser.add_argument('--preset', choices=sorted(PRESETS), default='small')
+for name in PRESETS['small']:
+    parser.add_argument('--' + name.replace('_', '-'), type=int, help='Ghi đè giá trị của preset')
+parser.add_argument('--past-days', type=int, default=60, help='Số ngày trong quá khứ có lịch')
+parser.add_argument('--future-days', type=int, default=30, help='Số ngày trong tương lai có lịch')
+parser.add_argument('--seed', type=int, default=42)
+parser.add_argument('--batch-size', type=int, default=20_000)
+parser.add_argument('--skip-derived', action='store_true',
+                    help='Không dựng lại các bảng dẫn xuất (chỉ mục tìm kiếm, doctor_availability, thống kê)')
+args = parser.parse_args()
+sizes = {name: getattr(args, name) or value for name, value in PRESETS[args.preset].items()}
+
+os.environ['DATABASE_URL'] = args.db_uri or 'sqlite:///' + DEFAULT_DB_PATH
+
+import numpy as np
+from sqlalchemy import select, func, insert
+
+from DatLichKhamOnline import app, db, doctor_search, reference_data, stats_rollup
+from models import User, UserRole, Doctor, DoctorDepartment, Department, MedicalCenter, Shift, DoctorShift, \
+    Ticket, TicketStatus
+
+FAMILY_NAMES = ['Nguyễn', 'Trần', 'Lê', 'Phạm', 'Hoàng', 'Huỳnh', 'Phan', 'Vũ', 'Võ', 'Đặng', 'Bùi', 'Đỗ',
+                'Hồ', 'Ngô', 'Dương', 'Lý']
+MIDDLE_NAMES = ['Văn', 'Thị', 'Hữu', 'Minh', 'Thanh', 'Ngọc', 'Quốc', 'Đức', 'Hoàng', 'Thu', 'Kim', 'Gia']
+GIVEN_NAMES = ['An', 'Bình', 'Châu', 'Dũng', 'Dung', 'Giang', 'Hà', 'Hải', 'Hạnh', 'Hiếu', 'Hoa', 'Hùng',
+               'Hương', 'Khánh', 'Lan', 'Linh', 'Long', 'Mai', 'Nam', 'Nga', 'Phong', 'Phúc', 'Quang', 'Sơn',
+               'Tâm', 'Thảo', 'Thắng', 'Trang', 'Trung', 'Tuấn', 'Vân', 'Vy', 'Yến']
+CENTER_KINDS = ['Bệnh viện Đa khoa', 'Bệnh viện', 'Phòng khám', 'Trung tâm Y tế', 'Bệnh viện Quốc tế']
+AREAS = ['Sài Gòn', 'Gia Định', 'Thủ Đức', 'Bình Thạnh', 'Tân Bình', 'Gò Vấp', 'Phú Nhuận', 'Quận 1', 'Quận 3',
+         'Quận 5', 'Quận 7', 'Quận 10', 'Hà Nội', 'Đà Nẵng', 'Cần Thơ', 'Biên Hòa', 'Vũng Tàu', 'Nha Trang']
+# Tâm các thành phố (vĩ độ, kinh độ) để rải tọa độ bệnh viện cho geo_index
+CITY_COORDINATES = [(10.7769, 106.7009), (21.0285, 105.8542), (16.0544, 108.2022), (10.0452, 105.7469),
+                    (10.9574, 106.8427), (10.3460, 107.0843), (12.2388, 109.1967)]
+DEPARTMENT_NAMES = ["Nhãn khoa", "Răng - Hàm - Mặt", "Tai - Mũi - Họng", "Tâm thần", "Da liễu",
+                    "Tiêu hóa - Gan mật", "Sản phụ khoa", "Tim mạch", "Hô hấp", "Chấn thương Chỉnh hình",
+                    "Ngoại tổng quát", "Nhi khoa", "Ung bướu"]
+PASSWORD = User.hash_password('123')
+
+rng = np.random.default_rng(args.seed)
+
+
+def skewed(n, exponent=1.0):
+    """Trọng số kiểu Zipf cho n phần tử đã xáo trộn: vài phần tử chiếm phần lớn."""
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    rng.shuffle(weights)
+    return weights / weights.sum()
+
+
+def next_id(connection, table):
+    return (connection.execute(select(func.max(table.c.id))).scalar() or 0) + 1
+
+
+def bulk_insert(connection, table, columns, rows):
+    """INSERT nhiều dòng qua executemany của driver (nhanh hơn nhiều so với dựng dict cho từng dòng)."""
+    if not rows:
+        return
+    if connection.dialect.name == 'sqlite':
+        # Lưu ngày giờ theo định dạng chuỗi mà kiểu Date/DateTime của SQLAlchemy đọc lại được
+        temporal = [i for i, value in enumerate(rows[0]) if isinstance(value, date)]
+        if temporal:
+            rows = [tuple(value.isoformat(' ') if i in temporal and isinstance(value, datetime)
+                          else value.isoformat() if i in temporal else value for i, value in enumerate(row))
+                    for row in rows]
+    placeholder = '?' if connection.dialect.paramstyle == 'qmark' else '%s'
+    statement = (f"INSERT INTO {table.name} ({', '.join(columns)}) "
+                 f"VALUES ({', '.join([placeholder] * len(columns))})")
+    cursor = connection.connection.cursor()
+    try:
+        cursor.executemany(statement, rows)
+    finally:
+        cursor.close()
+
+
+class Progress:
+    def __init__(self, label, total):
+        self.label, self.total, self.done = label, total, 0
+        self.started = timer.perf_counter()
+
+    def add(self, count):
+        self.done += count
+        elapsed = timer.perf_counter() - self.started
+        print(f"\r  {self.label}: {self.done:,}/{self.total:,} ({self.done / elapsed if elapsed else 0:,.0f} dòng/s)",
+              end='', flush=True)
+
+    def finish(self):
+        print()
+
+
+def person_names(count):
+    families = rng.choice(FAMILY_NAMES, count, p=skewed(len(FAMILY_NAMES), 0.8))
+    middles = rng.choice(MIDDLE_NAMES, count)
+    givens = rng.choice(GIVEN_NAMES, count)
+    return [(f"{family} {middle}", given) for family, middle, given in zip(families, middles, givens)]
+
+
+def ensure_reference_data(connection):
+    if not connection.execute(select(func.count()).select_from(Shift.__table__)).scalar():
+        connection.execute(insert(Shift.__table__), [
+            {'start_time': time(hour, minute), 'end_time': (datetime.combine(date.today(), time(hour, minute))
+                                                            + timedelta(minutes=30)).time(),
+             'bit': (hour - 7) * 2 + minute // 30}
+            for hour in range(7, 23) for minute in (0, 30)])
+    existing = set(connection.execute(select(Department.__table__.c.name)).scalars())
+    missing = [name for name in DEPARTMENT_NAMES if name not in existing]
+    if missing:
+        connection.execute(insert(Department.__table__), [{'name': name} for name in missing])
+    if not connection.execute(select(User.__table__.c.id).where(User.__table__.c.username == 'gen_admin')).first():
+        connection.execute(insert(User.__table__), [{
+            'username': 'gen_admin', 'email': 'gen_admin@example.com', 'password': PASSWORD,
+            'role': UserRole.ADMIN, 'first_name': 'Admin', 'last_name': 'Bench'}])
+
+
+def generate_centers(connection, count):
+    first_id = next_id(connection, MedicalCenter.__table__)
+    now = datetime.now()
+    cities = rng.integers(0, len(CITY_COORDINATES), count)
+    offsets = rng.normal(0, 0.08, (count, 2))
+    rows = [(first_id + i, f"{rng.choice(CENTER_KINDS)} {rng.choice(AREAS)} {first_id + i}",
+             f"{rng.integers(1, 999)} Đường số {rng.integers(1, 60)}, {rng.choice(AREAS)}",
+             f"028{rng.integers(10_000_000, 99_999_999)}", 'Cơ sở y tế sinh tự động để thử hiệu năng.',
+             round(CITY_COORDINATES[cities[i]][0] + offsets[i][0], 6),
+             round(CITY_COORDINATES[cities[i]][1] + offsets[i][1], 6), now, now)
+            for i in range(count)]
+    bulk_insert(connection, MedicalCenter.__table__,
+                ('id', 'name', 'address', 'phone', 'description', 'latitude', 'longitude', 'created_at',
+                 'updated_at'), rows)
+    return np.arange(first_id, first_id + count)
+
+
+def generate_users(connection, count, role, prefix, batch_size):
+    first_id = next_id(connection, User.__table__)
+    token = uuid.uuid4().hex[:6]
+    now = datetime.now()
+    progress = Progress(f'{prefix}', count)
+    for start in range(0, count, batch_size):
+        names = person_names(min(batch_size, count - start))
+        rows = []
+        for offset, (first_name, last_name) in enumerate(names):
+            user_id = first_id + start + offset
+            username = f'{prefix}_{token}_{start + offset}'
+            rows.append((user_id, username, f'{username}@example.com', PASSWORD, role.name, first_name, last_name,
+                         now, now))
+        bulk_insert(connection, User.__table__, ('id', 'username', 'email', 'password', 'role', 'first_name',
+                                                 'last_name', 'created_at', 'updated_at'), rows)
+        progress.add(len(rows))
+    progress.finish()
+    return np.arange(first_id, first_id + count)
+
+
+def generate_doctors(connection, doctor_ids, center_ids):
+    now = datetime.now()
+    centers = rng.choice(center_ids, len(doctor_ids), p=skewed(len(center_ids), 0.9))
+    start_years = rng.integers(1985, 2022, len(doctor_ids))
+    bulk_insert(connection, Doctor.__table__, ('id', 'medical_center_id', 'start_year', 'description',
+                                               'created_at', 'updated_at'),
+                [(int(doctor_id), int(center), int(year), 'Bác sĩ sinh tự động để thử hiệu năng.', now, now)
+                 for doctor_id, center, year in zip(doctor_ids, centers, start_years)])
+
+    department_ids = np.array(connection.execute(select(Department.__table__.c.id)).scalars().all())
+    weights = skewed(len(department_ids), 0.7)
+    links = []
+    for doctor_id, extra in zip(doctor_ids, (rng.random(len(doctor_ids)) < 0.3) + (rng.random(len(doctor_ids)) < 0.1)):
+        for department_id in rng.choice(department_ids, 1 + int(extra), replace=False, p=weights):
+            links.append((int(doctor_id), int(department_id), now, now))
+    bulk_insert(connection, DoctorDepartment.__table__, ('doctor_id', 'department_id', 'created_at', 'updated_at'),
+                links)
+
+
+def generate_schedule(connection, doctor_ids, client_ids, total_shifts, total_tickets, batch_size):
+    """Sinh DoctorShift và Ticket cho từng bác sĩ; số vé tỉ lệ với độ "nổi tiếng" (lệch) của bác sĩ.
+
+    Mỗi lô được commit riêng để giao dịch không phình to trên MySQL.
+    """
+    shifts = connection.execute(select(Shift.__table__.c.id, Shift.__table__.c.start_time)
+                                .order_by(Shift.__table__.c.start_time)).all()
+    shift_ids = np.array([shift.id for shift in shifts])
+    shift_minutes = np.array([shift.start_time.hour * 60 + shift.start_time.minute for shift in shifts])
+    first_day = date.today() - timedelta(days=args.past_days)
+    span = args.past_days + args.future_days
+    today_index = args.past_days
+
+    popularity = rng.pareto(1.2, len(doctor_ids)) + 1
+    # Chọn hệ số sao cho tỉ lệ đặt trung bình (sau khi chặn ở 95%) khớp với số vé mong muốn
+    target_rate, low, high = min(total_tickets / total_shifts, 0.95), 0.0, 1.0
+    while np.clip(high * popularity, 0, 0.95).mean() < target_rate and high < 1e6:
+        high *= 2
+    for _ in range(50):
+        middle = (low + high) / 2
+        low, high = (middle, high) if np.clip(middle * popularity, 0, 0.95).mean() < target_rate else (low, middle)
+    booking_rate = np.clip(high * popularity, 0, 0.95)
+    shifts_per_doctor = max(1, total_shifts // len(doctor_ids))
+    client_weights = skewed(len(client_ids), 1.1)
+
+    doctor_shift_id = next_id(connection, DoctorShift.__table__)
+    ticket_id = next_id(connection, Ticket.__table__)
+    shift_rows, ticket_rows = [], []
+    progress = Progress('doctor_shifts', shifts_per_doctor * len(doctor_ids))
+    now = datetime.now()
+    past_statuses = [TicketStatus.COMPLETED.name, TicketStatus.CANCELLED.name, TicketStatus.CONFIRMED.name]
+    future_statuses = [TicketStatus.CONFIRMED.name, TicketStatus.PENDING.name, TicketStatus.CANCELLED.name]
+
+    def flush():
+        connection = db.session.connection()
+        bulk_insert(connection, DoctorShift.__table__, ('id', 'doctor_id', 'shift_id', 'work_date', 'created_at',
+                                                        'updated_at'), shift_rows)
+        bulk_insert(connection, Ticket.__table__, ('id', 'uuid', 'doctor_shift_id', 'client_id', 'status',
+                                                   'first_name', 'last_name', 'birth_of_day', 'gender',
+                                                   'created_at', 'updated_at'), ticket_rows)
+        db.session.commit()
+        progress.add(len(shift_rows))
+        shift_rows.clear()
+        ticket_rows.clear()
+
+    for doctor_id, rate in zip(doctor_ids, booking_rate):
+        block = int(rng.integers(4, 13))  # số ca liên tiếp mỗi ngày làm việc
+        days = np.sort(rng.choice(span, min(span, max(1, shifts_per_doctor // block)), replace=False))
+        first_shift = rng.integers(0, len(shift_ids) - block + 1, len(days))
+        day_index = np.repeat(days, block)
+        shift_index = (first_shift[:, None] + np.arange(block)).ravel()
+        booked = rng.random(len(day_index)) < rate
+        clients = rng.choice(client_ids, int(booked.sum()), p=client_weights)
+        lead_minutes = rng.exponential(3 * 24 * 60, int(booked.sum()))
+        status_draw = rng.random(int(booked.sum()))
+
+        ticket_number = 0
+        for day, shift, is_booked in zip(day_index, shift_index, booked):
+            work_date = first_day + timedelta(days=int(day))
+            shift_rows.append((doctor_shift_id, int(doctor_id), int(shift_ids[shift]), work_date, now, now))
+            if is_booked:
+                slot_start = datetime.combine(work_date, time()) + timedelta(minutes=int(shift_minutes[shift]))
+                created_at = min(slot_start - timedelta(minutes=float(lead_minutes[ticket_number])), now)
+                draw = status_draw[ticket_number]
+                statuses = past_statuses if day < today_index else future_statuses
+                status = statuses[0] if draw < 0.7 else statuses[1] if draw < 0.88 else statuses[2]
+                ticket_rows.append((ticket_id, str(uuid.uuid4()), doctor_shift_id, int(clients[ticket_number]),
+                                    status, 'Bệnh nhân', str(ticket_id), date(1990, 1, 1),
+                                    'male' if ticket_id % 2 else 'female', created_at, created_at))
+                ticket_id += 1
+                ticket_number += 1
+            doctor_shift_id += 1
+        if len(shift_rows) >= batch_size:
+            flush()
+    flush()
+    progress.finish()
+
+
+if __name__ == '__main__':
+    started = timer.perf_counter()
+    with app.app_context():
+        db.create_all()  # Chỉ tạo các bảng còn thiếu
+        connection = db.session.connection()
+        if connection.dialect.name == 'sqlite':
+            connection.exec_driver_sql('PRAGMA synchronous=OFF')
+        print(f"Sinh dữ liệu ({args.preset}): {sizes}")
+        ensure_reference_data(connection)
+        center_ids = generate_centers(connection, sizes['centers'])
+        doctor_ids = generate_users(connection, sizes['doctors'], UserRole.DOCTOR, 'gen_doctor', args.batch_size)
+        generate_doctors(connection, doctor_ids, center_ids)
+        client_ids = generate_users(connection, sizes['clients'], UserRole.USER, 'gen_client', args.batch_size)
+        db.session.commit()
+        generate_schedule(db.session.connection(), doctor_ids, client_ids, sizes['doctor_shifts'], sizes['tickets'],
+                          args.batch_size)
+        db.session.commit()
+
+        if not args.skip_derived:
+            print("Dựng lại chỉ mục tìm kiếm, doctor_availability và bảng thống kê...")
+            doctor_search.rebuild_search_index()
+            stats_rollup.backfill()
+        # Ca/chuyên khoa/bệnh viện được ghi bằng Core: báo cho các tiến trình web đang chạy nạp lại
+        reference_data.invalidate()
+    print(f"Hoàn tất sau {timer.perf_counter() - started:.1f}s. CSDL: {os.environ['DATABASE_URL']}")
@@ -0,0 +1,128 @@
+# DatLichKhamOnline/geo_index.py
+# Chỉ mục không gian trong bộ nhớ cho bệnh viện: lưới ô vuông GEO_CELL_DEGREES độ, mỗi ô giữ danh sách các
+# bệnh viện có tọa độ nằm trong ô. Được dựng từ snapshot reference_data (không truy vấn thêm) và dựng lại khi
+# snapshot đổi (admin/bulk_import sửa bệnh viện).
+#
+# Tìm gần nhất: duyệt các "vành" ô quanh ô chứa điểm cần tìm (vành 0 là chính ô đó, vành r là các ô cách r ô),
+# chỉ tính khoảng cách haversine cho bệnh viện trong các ô đã duyệt và dừng khi khoảng cách thứ `limit` tốt nhất
+# không lớn hơn khoảng cách tối thiểu tới vành kế tiếp – các bệnh viện ở xa không bao giờ bị tính.
+import heapq
+import math
+import threading
+from collections import defaultdict, namedtuple
+
+from DatLichKhamOnline import app, reference_data
+
+app.config.setdefault('GEO_CELL_DEGREES', 0.05)  # ~5,5 km theo vĩ độ
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+Nearby = namedtuple('Nearby', 'center distance_km')
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def valid_coordinates(latitude, longitude):
+    return latitude is not None and longitude is not None and -90 <= latitude <= 90 and -180 <= longitude <= 180
+
+
+class GridIndex:
+    """Lưới ô vuông (theo độ) của các MedicalCenterRef có tọa độ."""
+
+    def __init__(self, centers, cell_degrees):
+        self.cell_degrees = cell_degrees
+        self.cells = defaultdict(list)
+        self.size = 0
+        for center in centers:
+            if valid_coordinates(center.latitude, center.longitude):
+                self.cells[self._cell(center.latitude, center.longitude)].append(center)
+                self.size += 1
+        self.cells = dict(self.cells)
+
+    def _cell(self, latitude, longitude):
+        return math.floor(latitude / self.cell_degrees), math.floor(longitude / self.cell_degrees)
+
+    def _ring(self, origin, ring):
+        x0, y0 = origin
+        if ring == 0:
+            yield origin
+            return
+        for dx in range(-ring, ring + 1):
+            yield x0 + dx, y0 - ring
+            yield x0 + dx, y0 + ring
+        for dy in range(-ring + 1, ring):
+            yield x0 - ring, y0 + dy
+            yield x0 + ring, y0 + dy
+
+    def _ring_distance_km(self, latitude, ring):
+        """Khoảng cách tối thiểu từ điểm tới mọi ô thuộc vành `ring` (cận dưới, tính ở vĩ độ cao nhất có thể)."""
+        if ring <= 0:
+            return 0.0
+        worst_latitude = min(89.9, abs(latitude) + (ring + 1) * self.cell_degrees)
+        cell_km = self.cell_degrees * KM_PER_DEGREE * min(1.0, math.cos(math.radians(worst_latitude)))
+        return (ring - 1) * cell_km
+
+    def nearest(self, latitude, longitude, limit, radius_km=None, accept=None):
+        """Các Nearby gần nhất, tăng dần theo khoảng cách. `accept(center)` lọc thêm (ví dụ theo chuyên khoa)."""
+        if not self.size or limit <= 0:
+            return []
+        origin = self._cell(latitude, longitude)
+        best = []  # heap (-khoảng cách, -id, center) giữ `limit` bệnh viện gần nhất
+
+        def consider(cells):
+            for cell in cells:
+                for center in self.cells.get(cell, ()):
+                    if accept is not None and not accept(center):
+                        continue
+                    distance = haversine_km(latitude, longitude, center.latitude, center.longitude)
+                    if radius_km is not None and distance > radius_km:
+                        continue
+                    item = (-distance, -center.id, center)
+                    if len(best) < limit:
+                        heapq.heappush(best, item)
+                    elif item > best[0]:
+                        heapq.heapreplace(best, item)
+
+        ring = 0
+        while True:
+            bound = self._ring_distance_km(latitude, ring)
+            if radius_km is not None and bound > radius_km:
+                break
+            if len(best) >= limit and -best[0][0] <= bound:
+                break
+            if 8 * ring > len(self.cells):
+                # Vành đã lớn hơn số ô có dữ liệu (điểm ở xa mọi bệnh viện): duyệt thẳng các ô còn lại
+                consider([cell for cell in self.cells
+                          if max(abs(cell[0] - origin[0]), abs(cell[1] - origin[1])) >= ring])
+                break
+            consider(self._ring(origin, ring))
+            ring += 1
+        return [Nearby(center, -distance) for distance, _, center in sorted(best, reverse=True)]
+
+
+_index = None
+_index_snapshot = None
+_lock = threading.Lock()
+
+
+def get_index():
+    """Chỉ mục của snapshot reference_data hiện tại (dựng lại khi snapshot đổi)."""
+    global _index, _index_snapshot
+    snapshot = reference_data.get()
+    if _index_snapshot is not snapshot:
+        with _lock:
+            if _index_snapshot is not snapshot:
+                _index = GridIndex(snapshot.medical_centers, app.config['GEO_CELL_DEGREES'])
+                _index_snapshot = snapshot
+    return _index
+
+
+def nearest_centers(latitude, longitude, limit=10, radius_km=None, center_ids=None):
+    """Các bệnh viện gần (latitude, longitude) nhất; center_ids giới hạn trong một tập id."""
+    accept = (lambda center: center.id in center_ids) if center_ids is not None else None
+    return get_index().nearest(latitude, longitude, limit, radius_km=radius_km, accept=accept)
@@ -1,18 +1,21 @@
 # DatLichKhamOnline/index.py
 import uuid
 from datetime import datetime, date, time, timedelta
-from cloudinary import uploader
 from flask import render_template, request, flash, redirect, url_for, session, \
     g  # Import g để lưu biến global cho request
-from sqlalchemy.orm import joinedload, subqueryload
+from sqlalchemy.orm import joinedload, subqueryload, selectinload, contains_eager
 from sqlalchemy.orm.attributes import InstrumentedAttribute
 from sqlalchemy.sql.sqltypes import Date
 from flask import jsonify
 from DatLichKhamOnline import app, db, login
 from models import User, MedicalCenter, DoctorDepartment, Department, Ticket, UserRole, Doctor, DoctorShift, \
-    Shift, TicketStatus  # Đảm bảo đã import 'Shift'
+    Shift, TicketStatus, ScheduleTemplate, PaymentAttempt, PaymentNotification, DoctorShiftArchive, \
+    TicketArchive  # Đảm bảo đã import 'Shift'
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from DatLichKhamOnline.admin import admin
+from DatLichKhamOnline import availability, booking, doctor_search, autocomplete, pagination, response_cache, \
+    schedules, avatar_upload, sql_profiler, fragment_cache, reference_data, user_identity, payments, ticket_expiry, \
+    geo_index, archive
 
 
 # Middleware để tải thông tin người dùng trước mỗi request
@@ -59,33 +62,24 @@ def api_suggestions():
     if not query or len(query) < 2:
         return jsonify([])
 
-    doctors = db.session.query(User).filter(
-        User.role == UserRole.DOCTOR,
-        (User.first_name + " " + User.last_name).ilike(f'%{query}%')
-    ).limit(5).all()
-
-    centers = db.session.query(MedicalCenter).filter(
-        MedicalCenter.name.ilike(f'%{query}%')
-    ).limit(3).all()
-
-    departments = db.session.query(Department).filter(
-        Department.name.ilike(f'%{query}%')
-    ).limit(3).all()
+    # Trả lời từ chỉ mục trong bộ nhớ, không truy vấn CSDL (xem autocomplete.py)
+    return jsonify(autocomplete.suggest(query))
 
-    suggestions = []
-    for d in doctors:
-        suggestions.append(f"{d.first_name} {d.last_name} - Bác sĩ")
-    for c in centers:
-        suggestions.append(f"{c.name} - Bệnh viện")
-    for d in departments:
-        suggestions.append(f"{d.name} - Chuyên khoa")
 
-    return jsonify(suggestions)
+def doctor_to_dict(user):
+    return {
+        'id': user.id,
+        'full_name': f"{user.first_name} {user.last_name}",
+        'avatar': user.avatar,
+        'specialty': ', '.join([dd.department.name for dd in user.doctor.doctor_departments]),
+        'medical_center': user.doctor.medical_center.name if user.doctor.medical_center else None,
+        'experience_years': datetime.now().year - user.doctor.start_year if user.doctor.start_year else None
+    }
 
 
 @app.route('/api/featured-doctors')
+@response_cache.cached_response('doctors')
 def api_featured_doctors():
-    current_year = datetime.now().year
     doctors = db.session.query(User).options(
         subqueryload(User.doctor).options(
             joinedload(Doctor.medical_center),
@@ -93,21 +87,12 @@ def api_featured_doctors():
         )
     ).filter(User.role == UserRole.DOCTOR).limit(6).all()
 
-    doctor_list = []
-    for user in doctors:
-        if user.doctor:
-            doctor_list.append({
-                'id': user.id,
-                'full_name': f"{user.first_name} {user.last_name}",
-                'avatar': user.avatar, # <-- ĐẢM BẢO DÒNG NÀY TỒN TẠI
-                'specialty': ', '.join([dd.department.name for dd in user.doctor.doctor_departments]),
-                'medical_center': user.doctor.medical_center.name if user.doctor.medical_center else None,
-                'experience_years': current_year - user.doctor.start_year if user.doctor.start_year else None
-            })
+    doctor_list = [doctor_to_dict(user) for user in doctors if user.doctor]
 
     return jsonify(doctor_list)
 
 @app.route('/api/medical-centers')
+@response_cache.cached_response('medical_centers')
 def api_medical_centers():
     centers = db.session.query(MedicalCenter).limit(6).all()
 
@@ -122,27 +107,205 @@ def api_medical_centers():
     return jsonify(center_list)
 
 
+@app.route('/api/cache-stats')
+def api_cache_stats():
+    if not current_user.is_authenticated or current_user.role != UserRole.ADMIN:
+        return jsonify({'error': 'forbidden'}), 403
+    return jsonify({**response_cache.cache_stats(), **fragment_cache.cache_stats()})
+
+
+def doctor_page(query):
+    """Một trang kết quả tìm bác sĩ: (danh sách User, cursor trang kế tiếp)."""
+    limit = pagination.page_size()
+    doctors_query = db.session.query(User).options(
+        contains_eager(User.doctor).options(
+            joinedload(Doctor.medical_center),
+            selectinload(Doctor.doctor_departments).joinedload(DoctorDepartment.department)
+        )
+    ).join(User.doctor).filter(User.role == UserRole.DOCTOR)
+
+    if not query:
+        cursor = pagination.decode_cursor(request.args.get('cursor'), (int,))
+        return pagination.paginate(doctors_query, [(User.id, False)], cursor, limit, lambda user: (user.id,))
+
+    # Tìm theo tên BS, tên khoa, tên bệnh viện hoặc mô tả qua chỉ mục tìm kiếm (không phân biệt dấu)
+    cursor = pagination.decode_cursor(request.args.get('cursor'), (int, int))
+    ranked = doctor_search.rank_doctors(query, limit=limit + 1, after=cursor)
+    if not ranked:
+        return [], None
+    next_cursor = None
+    if len(ranked) > limit:
+        last_doctor_id, last_score = ranked[limit - 1]
+        next_cursor = pagination.encode_cursor((int(last_score), last_doctor_id))
+    ranked = ranked[:limit]
+    position = {doctor_id: i for i, (doctor_id, _) in enumerate(ranked)}
+    doctors = doctors_query.filter(User.id.in_(position)).all()
+    return sorted(doctors, key=lambda user: position[user.id]), next_cursor
+
+
 @app.route("/search_doctor")
+@response_cache.cached_page('doctors', params=('q', 'cursor', 'limit'))
 def search_doctor():
     query = request.args.get('q', '').lower()
-    doctors_query = db.session.query(User).options(
-        subqueryload(User.doctor).options(
+    doctors, next_cursor = doctor_page(query)
+    return render_template('doctor/doctor_list.html', doctors=doctors,
+                           next_page_url=pagination.next_page_url(next_cursor))
+
+
+@app.route('/api/doctors')
+def api_doctors():
+    doctors, next_cursor = doctor_page(request.args.get('q', '').lower())
+    return jsonify({'items': [doctor_to_dict(user) for user in doctors], 'next_cursor': next_cursor})
+
+
+# Số ngày tối đa của ma trận ca trống
+MAX_AVAILABILITY_DAYS = 31
+
+
+@app.route('/api/availability')
+def api_availability():
+    # Ma trận ca trống của nhiều bác sĩ: mỗi ô (bác sĩ, ngày) là một bitmask, bit i ứng với shifts[i]
+    # (các ca sắp theo giờ bắt đầu; free_mask trong CSDL theo Shift.bit được đổi sang thứ tự này).
+    # Mặc định `free` của mỗi bác sĩ là chuỗi base64url ghép bitmask các ngày (bytes_per_day byte mỗi ngày,
+    # little-endian); ?encoding=int trả về list số nguyên.
+    # ?start=YYYY-MM-DD&days=14&department_id=&medical_center_id=&limit=&cursor=&encoding=
+    try:
+        start_date = datetime.strptime(request.args['start'], '%Y-%m-%d').date() \
+            if request.args.get('start') else date.today()
+    except ValueError:
+        return jsonify({'error': 'start phải có dạng YYYY-MM-DD'}), 400
+    days = max(1, min(request.args.get('days', 14, type=int), MAX_AVAILABILITY_DAYS))
+    cursor = pagination.decode_cursor(request.args.get('cursor'), (int,))
+
+    doctors, has_more = availability.availability_matrix(
+        start_date, days,
+        department_id=request.args.get('department_id', type=int),
+        medical_center_id=request.args.get('medical_center_id', type=int),
+        after_doctor_id=cursor[0] if cursor else None,
+        limit=pagination.page_size())
+    next_cursor = pagination.encode_cursor([doctors[-1][0]]) if has_more else None
+    shifts = reference_data.shifts()
+    bits = reference_data.get().shift_bits
+    doctors = [(doctor_id, first_name, last_name, medical_center_id,
+                [availability.to_time_order(mask, bits) for mask in masks])
+               for doctor_id, first_name, last_name, medical_center_id, masks in doctors]
+    bytes_per_day = max(1, (len(shifts) + 7) // 8)
+    as_int = request.args.get('encoding') == 'int'
+    return jsonify({
+        'start_date': start_date.isoformat(),
+        'days': days,
+        'shifts': [{'id': shift.id, 'start': shift.start_time.strftime('%H:%M'), 'end': shift.end_time.strftime('%H:%M')}
+                   for shift in shifts],
+        'encoding': 'int' if as_int else 'base64',
+        'bytes_per_day': bytes_per_day,
+        'doctors': [{'id': doctor_id, 'name': f'{first_name} {last_name}', 'medical_center_id': medical_center_id,
+                     'free': masks if as_int else availability.pack_masks(masks, bytes_per_day)}
+                    for doctor_id, first_name, last_name, medical_center_id, masks in doctors],
+        'next_cursor': next_cursor,
+    })
+
+
+@app.route('/api/earliest-slots')
+def api_earliest_slots():
+    # Các khung giờ trống sớm nhất của mọi bác sĩ thuộc chuyên khoa/bệnh viện, trong khung giờ [from, to] nếu có.
+    # ?department_id=&medical_center_id=&from=HH:MM&to=HH:MM&limit=
+    try:
+        start_time, end_time = [datetime.strptime(request.args[name], '%H:%M').time()
+                                if request.args.get(name) else None for name in ('from', 'to')]
+    except ValueError:
+        return jsonify({'error': 'from/to phải có dạng HH:MM'}), 400
+    slots = booking.earliest_free_slots(
+        limit=pagination.page_size(),
+        department_id=request.args.get('department_id', type=int),
+        medical_center_id=request.args.get('medical_center_id', type=int),
+        start_time=start_time or (time.min if end_time else None),
+        end_time=end_time or (time.max if start_time else None))
+    return jsonify({'items': [{
+        'doctor_shift_id': slot.id,
+        'doctor_id': slot.doctor_id,
+        'doctor_name': f'{slot.doctor.user.first_name} {slot.doctor.user.last_name}',
+        'medical_center': slot.doctor.medical_center.name if slot.doctor.medical_center else None,
+        'work_date': slot.work_date.isoformat(),
+        'start_time': slot.shift.start_time.strftime('%H:%M'),
+        'end_time': slot.shift.end_time.strftime('%H:%M'),
+        'booking_url': url_for('book_appointment', doctor_id=slot.doctor_id,
+                               appointment_date=slot.work_date.isoformat()),
+    } for slot in slots]})
+
+
+def _nearby_args():
+    """(lat, lon, radius_km) từ query string; lat/lon là độ thập phân do trình duyệt/ứng dụng cung cấp."""
+    latitude = request.args.get('lat', type=float)
+    longitude = request.args.get('lon', type=float)
+    if not geo_index.valid_coordinates(latitude, longitude):
+        return None
+    radius_km = request.args.get('radius_km', type=float)
+    return latitude, longitude, radius_km if radius_km and radius_km > 0 else None
+
+
+@app.route('/api/centers/nearby')
+def api_centers_nearby():
+    # Các bệnh viện gần vị trí người dùng nhất, tăng dần theo khoảng cách (chỉ mục lưới trong bộ nhớ, geo_index.py)
+    # ?lat=&lon=&radius_km=&limit=
+    args = _nearby_args()
+    if args is None:
+        return jsonify({'error': 'Cần lat trong [-90, 90] và lon trong [-180, 180]'}), 400
+    latitude, longitude, radius_km = args
+    nearby = geo_index.nearest_centers(latitude, longitude, limit=pagination.page_size(), radius_km=radius_km)
+    return jsonify({'items': [{
+        'id': item.center.id,
+        'name': item.center.name,
+        'address': item.center.address,
+        'image': item.center.image,
+        'latitude': item.center.latitude,
+        'longitude': item.center.longitude,
+        'distance_km': round(item.distance_km, 3),
+    } for item in nearby]})
+
+
+@app.route('/api/doctors/nearby')
+def api_doctors_nearby():
+    # Các bác sĩ của một chuyên khoa ở những bệnh viện gần vị trí người dùng nhất.
+    # ?lat=&lon=&department_id=&radius_km=&limit=
+    args = _nearby_args()
+    if args is None:
+        return jsonify({'error': 'Cần lat trong [-90, 90] và lon trong [-180, 180]'}), 400
+    department_id = request.args.get('department_id', type=int)
+    if department_id is None:
+        return jsonify({'error': 'Thiếu department_id'}), 400
+    latitude, longitude, radius_km = args
+    limit = pagination.page_size()
+
+    center_ids = {center_id for center_id, in db.session.query(Doctor.medical_center_id).join(
+        Doctor.doctor_departments).filter(DoctorDepartment.department_id == department_id,
+                                          Doctor.medical_center_id.isnot(None)).distinct().tuples()}
+    # Mỗi bệnh viện được chọn có ít nhất một bác sĩ của khoa, nên `limit` bác sĩ gần nhất nằm trong
+    # `limit` bệnh viện gần nhất
+    nearby = geo_index.nearest_centers(latitude, longitude, limit=limit, radius_km=radius_km,
+                                       center_ids=center_ids)
+    if not nearby:
+        return jsonify({'items': []})
+    distances = {item.center.id: item.distance_km for item in nearby}
+    doctors = db.session.query(User).options(
+        contains_eager(User.doctor).options(
             joinedload(Doctor.medical_center),
-            joinedload(Doctor.doctor_departments).joinedload(DoctorDepartment.department)
+            selectinload(Doctor.doctor_departments).joinedload(DoctorDepartment.department)
         )
-    ).join(User.doctor).filter(User.role == UserRole.DOCTOR)
-    if query:
-        # Tìm kiếm theo tên BS, tên khoa, hoặc tên bệnh viện
-        doctors_query = doctors_query.join(Doctor.doctor_departments).join(Department).join(Doctor.medical_center).filter(
-            ((User.first_name + " " + User.last_name).ilike(f'%{query}%')) |
-            (Department.name.ilike(f'%{query}%')) |
-            (MedicalCenter.name.ilike(f'%{query}%'))
-        ).distinct()
-    doctors = doctors_query.all()
-    return render_template('doctor/doctor_list.html', doctors=doctors)
+    ).join(User.doctor).filter(
+        User.role == UserRole.DOCTOR,
+        Doctor.medical_center_id.in_(distances),
+        Doctor.doctor_departments.any(DoctorDepartment.department_id == department_id),
+    ).all()
+    doctors.sort(key=lambda user: (distances[user.doctor.medical_center_id], user.id))
+    return jsonify({'items': [{
+        **doctor_to_dict(user),
+        'medical_center_id': user.doctor.medical_center_id,
+        'distance_km': round(distances[user.doctor.medical_center_id], 3),
+    } for user in doctors[:limit]]})
 
 
 @app.route("/search_medical_center")
+@response_cache.cached_page('medical_centers', params=('q',))
 def search_medical_center():
     query = request.args.get('q', '')
     medical_centers = db.session.query(MedicalCenter).filter(
@@ -170,6 +333,7 @@ def user_login():
 
         if user and user.check_password(password):
             login_user(user=user)  # Hàm từ Flask-Login
+            user_identity.remember(user)
             flash(f"Đăng nhập thành công! Chào mừng {user.first_name} {user.last_name}.", "success")
 
             # --- KIỂM TRA VAI TRÒ VÀ CHUYỂN HƯỚNG TẠI ĐÂY ---
@@ -204,22 +368,9 @@ def doctor_dashboard():
             flash('Vui lòng chọn ngày và ít nhất một ca làm việc.', 'warning')
         else:
             work_date = datetime.strptime(work_date_str, '%Y-%m-%d').date()
-            new_shifts_count = 0
-            for shift_id in selected_shift_ids:
-                existing_shift = db.session.query(DoctorShift).filter_by(
-                    doctor_id=current_user.id,
-                    shift_id=int(shift_id),
-                    work_date=work_date
-                ).first()
-
-                if not existing_shift:
-                    new_doctor_shift = DoctorShift(
-                        doctor_id=current_user.id,
-                        shift_id=int(shift_id),
-                        work_date=work_date
-                    )
-                    db.session.add(new_doctor_shift)
-                    new_shifts_count += 1
+            # Thêm tất cả các ca còn thiếu bằng một lệnh INSERT (xem schedules.py)
+            new_shifts_count = schedules.materialize_shifts(
+                current_user.id, {(work_date, int(shift_id)) for shift_id in selected_shift_ids})
 
             if new_shifts_count > 0:
                 db.session.commit()
@@ -231,10 +382,10 @@ def doctor_dashboard():
 
         return redirect(url_for('doctor_dashboard'))
 
-    # Lấy dữ liệu để hiển thị cho trang (GET request)
-    all_shifts = db.session.query(Shift).order_by(Shift.start_time).all()
+    # Lấy dữ liệu để hiển thị cho trang (GET request); danh sách ca đọc từ cache dữ liệu tham chiếu
+    all_shifts = reference_data.shifts()
 
-    registered_shifts = db.session.query(DoctorShift).join(Shift).filter(
+    registered_shifts = db.session.query(DoctorShift).join(Shift).options(contains_eager(DoctorShift.shift)).filter(
         DoctorShift.doctor_id == current_user.id,
         DoctorShift.work_date >= date.today()
     ).order_by(DoctorShift.work_date, Shift.start_time).all()
@@ -255,9 +406,111 @@ def doctor_dashboard():
                            today_date=today_date)  # <-- Truyền biến mới
 
 
+def parse_schedule_template_form():
+    """Đọc form lịch lặp lại; trả về (giá trị, None) hoặc (None, thông báo lỗi)."""
+    weekdays = request.form.getlist('weekdays', type=int)
+    try:
+        start_time = datetime.strptime(request.form.get('start_time', ''), '%H:%M').time()
+        end_time = datetime.strptime(request.form.get('end_time', ''), '%H:%M').time()
+        start_date = datetime.strptime(request.form.get('start_date', ''), '%Y-%m-%d').date()
+        end_date = datetime.strptime(request.form.get('end_date', ''), '%Y-%m-%d').date()
+    except ValueError:
+        return None, 'Vui lòng nhập đầy đủ giờ và ngày hợp lệ.'
+    if not weekdays or any(weekday not in range(7) for weekday in weekdays):
+        return None, 'Vui lòng chọn ít nhất một ngày trong tuần.'
+    if start_time >= end_time or start_date > end_date:
+        return None, 'Thời gian bắt đầu phải trước thời gian kết thúc.'
+    if (end_date - start_date).days >= schedules.MAX_TEMPLATE_DAYS:
+        return None, f'Lịch lặp lại chỉ được kéo dài tối đa {schedules.MAX_TEMPLATE_DAYS} ngày.'
+    return (weekdays, start_time, end_time, start_date, end_date), None
+
+
+@app.route('/doctor/schedule_templates', methods=['GET', 'POST'])
+def doctor_schedule_templates():
+    if not current_user or current_user.role != UserRole.DOCTOR:
+        flash('Bạn không có quyền truy cập trang này.', 'danger')
+        return redirect(url_for('home'))
+
+    if request.method == 'POST':
+        values, error = parse_schedule_template_form()
+        if error:
+            flash(error, 'warning')
+            return redirect(url_for('doctor_schedule_templates'))
+        weekdays, start_time, end_time, start_date, end_date = values
+        template = ScheduleTemplate(doctor_id=current_user.id, weekday_mask=schedules.weekday_mask(weekdays),
+                                    start_time=start_time, end_time=end_time,
+                                    start_date=start_date, end_date=end_date)
+        db.session.add(template)
+        added = schedules.apply_template(template)
+        db.session.commit()
+        flash(f'Đã tạo lịch lặp lại và đăng ký {added} ca làm việc mới.', 'success')
+        return redirect(url_for('doctor_schedule_templates'))
+
+    templates = db.session.query(ScheduleTemplate).filter_by(doctor_id=current_user.id).order_by(
+        ScheduleTemplate.start_date, ScheduleTemplate.id).all()
+    editing = None
+    edit_id = request.args.get('edit', type=int)
+    if edit_id:
+        editing = next((template for template in templates if template.id == edit_id), None)
+    all_shifts = reference_data.shifts()
+    return render_template('doctor/schedule_templates.html',
+                           templates=templates,
+                           editing=editing,
+                           all_shifts=all_shifts,
+                           weekday_names=schedules.WEEKDAY_NAMES,
+                           weekdays_of=schedules.weekdays_of,
+                           today_date=date.today())
+
+
+def get_own_schedule_template(template_id):
+    template = db.session.get(ScheduleTemplate, template_id)
+    if not template or template.doctor_id != current_user.id:
+        return None
+    return template
+
+
+@app.route('/doctor/schedule_templates/<int:template_id>/edit', methods=['POST'])
+def edit_schedule_template(template_id):
+    if not current_user or current_user.role != UserRole.DOCTOR:
+        flash('Bạn không có quyền truy cập trang này.', 'danger')
+        return redirect(url_for('home'))
+
+    template = get_own_schedule_template(template_id)
+    if not template:
+        flash('Không tìm thấy lịch lặp lại này.', 'danger')
+        return redirect(url_for('doctor_schedule_templates'))
+
+    values, error = parse_schedule_template_form()
+    if error:
+        flash(error, 'warning')
+        return redirect(url_for('doctor_schedule_templates', edit=template_id))
+    added, removed = schedules.update_template(template, *values)
+    db.session.commit()
+    flash(f'Đã cập nhật lịch lặp lại: thêm {added} ca, xóa {removed} ca chưa có người đặt.', 'success')
+    return redirect(url_for('doctor_schedule_templates'))
+
+
+@app.route('/doctor/schedule_templates/<int:template_id>/delete', methods=['POST'])
+def delete_schedule_template(template_id):
+    if not current_user or current_user.role != UserRole.DOCTOR:
+        flash('Bạn không có quyền truy cập trang này.', 'danger')
+        return redirect(url_for('home'))
+
+    template = get_own_schedule_template(template_id)
+    if not template:
+        flash('Không tìm thấy lịch lặp lại này.', 'danger')
+        return redirect(url_for('doctor_schedule_templates'))
+
+    removed = schedules.delete_template(template)
+    db.session.commit()
+    flash(f'Đã xóa lịch lặp lại và {removed} ca làm việc chưa có người đặt.', 'success')
+    return redirect(url_for('doctor_schedule_templates'))
+
+
 @app.route("/logout")
 def logout():
     logout_user()
+    user_identity.forget()
     flash("Đã đăng xuất.", "success")
     return redirect(url_for("home"))
 
@@ -329,7 +582,7 @@ def book_appointment(doctor_id):
             selected_date_obj = None
 
     if request.method == 'POST':
-        doctor_shift_id = request.form.get('doctor_shift_id')
+        doctor_shift_id = request.form.get('doctor_shift_id', type=int)
         first_name = request.form.get('first_name')
         last_name = request.form.get('last_name')
         birth_of_day_str = request.form.get('birth_of_day')
@@ -344,57 +597,47 @@ def book_appointment(doctor_id):
             flash('Bạn cần đăng nhập để đặt lịch.', 'danger')
             return redirect(url_for('user_login'))
 
-        doctor_shift = db.session.get(DoctorShift, doctor_shift_id)
-        if not doctor_shift:
+        try:
+            birth_of_day = datetime.strptime(birth_of_day_str, '%Y-%m-%d').date()
+        except ValueError:
+            flash('Ngày sinh không hợp lệ.', 'danger')
+            return redirect(url_for('book_appointment', doctor_id=doctor_id, appointment_date=selected_date_str or ''))
+
+        # Chiếm khung giờ một cách nguyên tử (xem booking.py)
+        result = booking.book_slot(doctor_id, doctor_shift_id, client_id,
+                                   first_name, last_name, birth_of_day, gender)
+
+        if result.status == booking.INVALID_SLOT:
             flash('Khung giờ không hợp lệ.', 'danger')
             return redirect(url_for('book_appointment', doctor_id=doctor_id))
 
-        existing_ticket = db.session.query(Ticket).join(DoctorShift).filter(
-            Ticket.client_id == client_id,
-            DoctorShift.doctor_id == doctor_id,
-            DoctorShift.work_date == doctor_shift.work_date,
-            Ticket.status.in_([TicketStatus.PENDING, TicketStatus.CONFIRMED])
-        ).first()
-
-        if existing_ticket:
-            flash(f'Bạn đã có lịch khám với bác sĩ này trong ngày {doctor_shift.work_date.strftime("%d/%m/%Y")}.',
+        if result.status == booking.ALREADY_BOOKED:
+            flash(f'Bạn đã có lịch khám với bác sĩ này trong ngày {result.doctor_shift.work_date.strftime("%d/%m/%Y")}.',
                   'warning')
             return redirect(url_for('book_appointment', doctor_id=doctor_id, appointment_date=selected_date_str or ''))
 
-        new_ticket = Ticket(
-            uuid=str(uuid.uuid4()),
-            doctor_shift_id=doctor_shift.id,
-            client_id=client_id,
-            status=TicketStatus.PENDING,
-            first_name=first_name,
-            last_name=last_name,
-            birth_of_day=datetime.strptime(birth_of_day_str, '%Y-%m-%d').date(),
-            gender=gender
-        )
-        db.session.add(new_ticket)
-        db.session.commit()
+        if result.status == booking.SLOT_TAKEN:
+            if result.alternatives:
+                suggestions = ', '.join(f"{ds.shift.start_time.strftime('%H:%M')} ngày {ds.work_date.strftime('%d/%m')}"
+                                        for ds in result.alternatives)
+                flash(f'Khung giờ này vừa có người đặt. Các khung giờ còn trống gần nhất: {suggestions}.', 'warning')
+                return redirect(url_for('book_appointment', doctor_id=doctor_id,
+                                        appointment_date=result.alternatives[0].work_date.strftime('%Y-%m-%d')))
+            flash('Khung giờ này vừa có người đặt và bác sĩ không còn khung giờ trống trong những ngày tới.', 'warning')
+            return redirect(url_for('book_appointment', doctor_id=doctor_id))
+
         flash('Đặt lịch thành công! Vui lòng thanh toán.', 'success')
-        return redirect(url_for('payment', ticket_uuid=new_ticket.uuid))
-
-    # --- SỬA LỖI TRUY VẤN VÀ SẮP XẾP ---
-    all_doctor_shifts = db.session.query(DoctorShift).join(Shift).outerjoin(Ticket).filter(
-        DoctorShift.doctor_id == doctor_id,
-        DoctorShift.work_date >= date.today(),
-        DoctorShift.work_date <= date.today() + timedelta(days=7),
-        Ticket.id == None  # <-- THÊM DÒNG NÀY: Chỉ lấy những ca chưa có vé (còn trống)
-    ).order_by(DoctorShift.work_date, Shift.start_time).all()
+        return redirect(url_for('payment', ticket_uuid=result.ticket.uuid))
 
-    shifts_by_work_date = {}
-    for ds in all_doctor_shifts:
-        if ds.work_date not in shifts_by_work_date:
-            shifts_by_work_date[ds.work_date] = []
-        shifts_by_work_date[ds.work_date].append(ds)
+    # Đọc các ngày còn trống từ chỉ mục doctor_availability thay vì anti-join DoctorShift/Ticket
+    free_days = availability.available_days(doctor_id, date.today(), date.today() + timedelta(days=7))
+    free_masks = dict(free_days)
 
     available_dates_for_template = []
-    for work_date in sorted(shifts_by_work_date.keys()):
+    for work_date, free_mask in free_days:
         available_dates_for_template.append({
             'date': work_date,
-            'shift_count': len(shifts_by_work_date[work_date]),
+            'shift_count': availability.count_bits(free_mask),
             'is_selected': work_date == selected_date_obj
         })
 
@@ -403,9 +646,16 @@ def book_appointment(doctor_id):
         return redirect(url_for('book_appointment', doctor_id=doctor_id, appointment_date=first_available_date_str))
 
     current_date_shifts = {}
-    if selected_date_obj and selected_date_obj in shifts_by_work_date:
-        morning_shifts = [ds for ds in shifts_by_work_date[selected_date_obj] if ds.shift.start_time < time(12, 0)]
-        afternoon_shifts = [ds for ds in shifts_by_work_date[selected_date_obj] if ds.shift.start_time >= time(12, 0)]
+    if selected_date_obj and selected_date_obj in free_masks:
+        bits = reference_data.get().shift_bits
+        free_shift_ids = availability.mask_to_shift_ids(free_masks[selected_date_obj], bits)
+        day_shifts = db.session.query(DoctorShift).join(Shift).options(contains_eager(DoctorShift.shift)).filter(
+            DoctorShift.doctor_id == doctor_id,
+            DoctorShift.work_date == selected_date_obj,
+            DoctorShift.shift_id.in_(free_shift_ids)
+        ).order_by(Shift.start_time).all()
+        morning_shifts = [ds for ds in day_shifts if ds.shift.start_time < time(12, 0)]
+        afternoon_shifts = [ds for ds in day_shifts if ds.shift.start_time >= time(12, 0)]
         if morning_shifts:
             current_date_shifts['Buổi Sáng'] = morning_shifts
         if afternoon_shifts:
@@ -429,16 +679,30 @@ def payment(ticket_uuid):
     if not ticket:
         flash('Không tìm thấy vé đặt lịch này.', 'danger')
         return redirect(url_for('home'))
-    return render_template('payment/payment.html', ticket=ticket)
+    hold_expires_at = ticket_expiry.hold_expires_at(ticket) if ticket.status == TicketStatus.PENDING else None
+    return render_template('payment/payment.html', ticket=ticket, hold_expires_at=hold_expires_at)
 
 
 @app.route("/medical_center_details/<int:medical_center_id>")
+@response_cache.cached_page()
 def medical_center_details(medical_center_id):
-    medical_center = db.session.get(MedicalCenter, medical_center_id)
+    # Nạp toàn bộ đồ thị trong số câu SQL cố định: bệnh viện, bác sĩ + user, chuyên khoa.
+    # Doctor.medical_center lấy từ identity map (chính bệnh viện này) nên không phát sinh truy vấn.
+    medical_center = db.session.query(MedicalCenter).options(
+        selectinload(MedicalCenter.doctors).options(
+            joinedload(Doctor.user),
+            selectinload(Doctor.doctor_departments).joinedload(DoctorDepartment.department)
+        )
+    ).filter(MedicalCenter.id == medical_center_id).first_or_404()
+    response_cache.tag_page(f'medical_center:{medical_center.id}',
+                            *(f'doctor:{doctor.id}' for doctor in medical_center.doctors),
+                            *(f'department:{dd.department_id}' for doctor in medical_center.doctors
+                              for dd in doctor.doctor_departments))
     return render_template('hospital/medical_center_details.html', medical_center=medical_center)
 
 
 @app.route('/doctor_details/<int:doctor_id>')
+@response_cache.cached_page()
 def doctor_details(doctor_id):
     # --- CẬP NHẬT TRUY VẤN ĐỂ TẢI ĐẦY ĐỦ DỮ LIỆU ---
     # Truy vấn User và tải trước tất cả các thông tin liên quan cần thiết
@@ -450,6 +714,10 @@ def doctor_details(doctor_id):
     ).filter(User.id == doctor_id, User.role == UserRole.DOCTOR).first_or_404()
 
     # first_or_404() sẽ tự động trả về trang lỗi 404 nếu không tìm thấy bác sĩ
+    response_cache.tag_page(f'doctor:{doctor_user.id}')
+    if doctor_user.doctor:
+        response_cache.tag_page(f'medical_center:{doctor_user.doctor.medical_center_id}',
+                                *(f'department:{dd.department_id}' for dd in doctor_user.doctor.doctor_departments))
 
     return render_template('doctor/doctor_details.html', doctor=doctor_user)
 
@@ -460,27 +728,15 @@ def profile():
 
     user = current_user
     if request.method == 'POST':
-        print("=" * 30)
-        print("ĐÃ NHẬN ĐƯỢC YÊU CẦU POST TỚI /profile")
-        print("Dữ liệu form nhận được:", request.form)
-        print("Dữ liệu file nhận được:", request.files)
-        if 'avatar_file' in request.files:
-            print(">>> Đã tìm thấy key 'avatar_file' trong request.files.")
-            file = request.files['avatar_file']
-
-            if file and file.filename != '':
-                print(f"==> Tên file hợp lệ: '{file.filename}'. Bắt đầu tải lên Cloudinary...")
-                try:
-                    upload_result = uploader.upload(file)
-                    user.avatar = upload_result['secure_url']
-                    flash('Cập nhật ảnh đại diện thành công!', 'success')
-                except Exception as e:
-                    flash(f'Lỗi khi tải ảnh lên: {e}', 'danger')
-            else:
-                print("!!! File tồn tại nhưng không có tên file (người dùng chưa chọn file).")
-        else:
-            print("XXX KHÔNG TÌM THẤY key 'avatar_file' trong request.files. Các key có sẵn là:",
-                  list(request.files.keys()))
+        avatar_job = None
+        file = request.files.get('avatar_file')
+        if file and file.filename != '':
+            # Chỉ lưu file vào thư mục tạm (ngoài static); ảnh thu nhỏ và việc tải lên được xử lý ở nền (avatar_upload.py)
+            try:
+                avatar_job = avatar_upload.stage_avatar(user, file)
+                flash('Ảnh đại diện đang được xử lý và sẽ được cập nhật trong giây lát.', 'info')
+            except ValueError as e:
+                flash(f'Lỗi khi tải ảnh lên: {e}', 'danger')
 
         user.first_name = request.form.get('first_name')
         user.last_name = request.form.get('last_name')
@@ -493,27 +749,32 @@ def profile():
         user.phone = request.form.get('phone')
         user.address = request.form.get('address')
 
-        print(user)
-
         try:
             db.session.commit()
+            if avatar_job:
+                avatar_upload.submit(avatar_job)
             flash('Cập nhật thông tin cá nhân thành công!', 'success')
         except Exception as e:
             db.session.rollback()
+            if avatar_job:
+                avatar_upload.discard(avatar_job)
             flash(f'Lỗi khi cập nhật thông tin: {e}', 'danger')
 
         return redirect(url_for('profile'))
-    return render_template('user/profile.html', user=user)
+    return render_template('user/profile.html', user=user, avatar_pending=avatar_upload.is_pending(user))
 
 
 @app.route('/select_payment_method/<string:ticket_uuid>')
 def select_payment_method(ticket_uuid):
     ticket = db.session.query(Ticket).filter_by(uuid=ticket_uuid).first_or_404()
-    return render_template('payment/select_payment_method.html', ticket=ticket)
+    # Mỗi lần mở trang là một lần thanh toán mới; bấm lại/tải lại link bên dưới dùng lại cùng giao dịch
+    return render_template('payment/select_payment_method.html', ticket=ticket,
+                           idempotency_key=uuid.uuid4().hex)
 
 
 @app.route('/pay/<string:method>/<string:ticket_uuid>')
 def initiate_payment(method, ticket_uuid):
+    payments.gateway_secret()  # chưa cấu hình khóa thì dừng trước khi tạo giao dịch
     ticket = db.session.query(Ticket).filter_by(uuid=ticket_uuid).first_or_404()
 
     # Kiểm tra vé đã thanh toán chưa
@@ -521,94 +782,161 @@ def initiate_payment(method, ticket_uuid):
         flash('Lịch hẹn này đã được thanh toán rồi.', 'info')
         return redirect(url_for('payment_return', ticket_uuid=ticket.uuid))
 
-    # --- LOGIC TÍCH HỢP API THẬT SỰ SẼ NẰM Ở ĐÂY ---
-    # 1. Chuẩn bị các tham số: amount, orderId, orderInfo, returnUrl, ipnUrl,...
-    # 2. Tạo chữ ký (signature) bằng Secret Key
-    # 3. Gọi API của MoMo hoặc VNPay để lấy payUrl
-
-    # Giả lập: In ra thông tin và chuyển hướng thẳng đến trang kết quả
-    print(f"Bắt đầu quá trình thanh toán cho vé {ticket.uuid} bằng {method.upper()}")
-    print("Trong thực tế, tại đây sẽ gọi API và chuyển hướng đến payUrl của cổng thanh toán.")
+    # Cùng idempotency key -> cùng orderId: gửi lại request không tạo giao dịch thứ hai ở cổng thanh toán
+    idempotency_key = request.headers.get('Idempotency-Key') or request.args.get('idempotency_key')
+    attempt = payments.get_or_create_attempt(ticket, method, idempotency_key)
 
-    # Giả lập thành công: Chuyển hướng người dùng đến trang kết quả
-    # Trong thực tế, đây sẽ là `return redirect(payUrl)`
+    # --- LOGIC TÍCH HỢP API THẬT SỰ SẼ NẰM Ở ĐÂY ---
+    # Gọi API của MoMo/VNPay với orderId = attempt.order_id, returnUrl = payment_return,
+    # ipnUrl = payment_ipn rồi `return redirect(payUrl)`.
+
+    # Giả lập: cổng thanh toán báo thành công và chuyển người dùng về returnUrl với tham số đã ký.
+    # IPN của cùng giao dịch (cùng txn_id) nếu đến sau sẽ bị bỏ qua như bản trùng.
+    fields = {
+        'order_id': attempt.order_id,
+        'txn_id': f'{method.upper()}-{attempt.order_id}',
+        'result_code': payments.RESULT_SUCCESS,
+        'gateway_time': attempt.created_at.isoformat(),
+    }
     flash('Đang chuyển hướng đến cổng thanh toán...', 'info')
-    return redirect(url_for('payment_return', ticket_uuid=ticket.uuid, success='true'))
+    return redirect(url_for('payment_return', signature=payments.sign(fields), **fields))
 
 
 @app.route('/payment/return')
 def payment_return():
-    ticket_uuid = request.args.get('ticket_uuid')
-    ticket = db.session.query(Ticket).filter_by(uuid=ticket_uuid).first_or_404()
-
-    # Trong thực tế, bạn sẽ kiểm tra các tham số trả về từ MoMo/VNPay và xác thực chữ ký
-    # Tuy nhiên, nguồn đáng tin cậy nhất là trạng thái trong DB (được cập nhật bởi IPN)
-
-    # Giả lập cập nhật trạng thái thành công (bình thường việc này do IPN làm)
-    is_success = request.args.get('success') == 'true'
-    if is_success and ticket.status != TicketStatus.CONFIRMED:
-        ticket.status = TicketStatus.CONFIRMED
+    # Trang người dùng quay về từ cổng thanh toán. Tham số trả về được ghi vào hàng đợi như một IPN (bỏ qua nếu
+    # giao dịch đã có) – trạng thái vé chỉ do worker IPN cập nhật, nên tải lại trang này là an toàn.
+    order_id = request.args.get('order_id')
+    if order_id:
+        try:
+            notification = payments.parse_notification(request.args.to_dict())
+        except ValueError as e:
+            flash(f'Kết quả thanh toán không hợp lệ: {e}', 'danger')
+            return redirect(url_for('home'))
+        payments.enqueue(db.session.connection(), [notification])
         db.session.commit()
-        print(f"GIẢ LẬP: Cập nhật trạng thái vé {ticket.uuid} thành CONFIRMED.")
+        payments.notify_worker()
+        ticket = db.session.query(Ticket).join(
+            PaymentAttempt, PaymentAttempt.ticket_id == Ticket.id
+        ).filter(PaymentAttempt.order_id == order_id).first_or_404()
+    else:
+        ticket = db.session.query(Ticket).filter_by(uuid=request.args.get('ticket_uuid')).first_or_404()
 
-    return render_template('payment/payment_result.html', ticket=ticket)
+    processing = ticket.status == TicketStatus.PENDING and order_id is not None and db.session.query(
+        db.session.query(PaymentNotification.id).filter(
+            PaymentNotification.order_id == order_id, PaymentNotification.processed_at.is_(None)
+        ).exists()
+    ).scalar()
+    return render_template('payment/payment_result.html', ticket=ticket, processing=processing)
 
 
 # Route 3: Nơi MoMo/VNPay gọi để thông báo kết quả (Server-to-Server)
 @app.route('/payment/ipn', methods=['POST'])
 def payment_ipn():
-    # Đây là endpoint cực kỳ quan trọng, xử lý ngầm
-    data = request.get_json()
-    print("Đã nhận được IPN:", data)
-
-    # --- LOGIC XỬ LÝ IPN THẬT SỰ ---
-    # 1. Lấy dữ liệu từ request của cổng thanh toán
-    # 2. Kiểm tra chữ ký (signature) để đảm bảo dữ liệu là hợp lệ và từ cổng thanh toán gửi đến
-    # 3. Lấy thông tin đơn hàng (vé) từ database dựa trên orderId (hoặc uuid) trong dữ liệu IPN
-    # 4. Kiểm tra số tiền (amount) xem có khớp không
-    # 5. Cập nhật trạng thái vé trong database (ví dụ: PENDING -> CONFIRMED)
-    # 6. Phản hồi lại cho server của cổng thanh toán theo đúng định dạng họ yêu cầu
-
-    # Giả lập:
-    # resultCode = data.get('resultCode')
-    # if resultCode == 0:
-    #     ticket_uuid = data.get('orderId')
-    #     ticket = db.session.query(Ticket).filter_by(uuid=ticket_uuid).first()
-    #     if ticket:
-    #         ticket.status = TicketStatus.CONFIRMED
-    #         db.session.commit()
-    #         print(f"IPN: Cập nhật vé {ticket_uuid} thành công.")
+    # Chỉ kiểm tra chữ ký và ghi vào hàng đợi rồi trả lời ngay; việc cập nhật vé do worker IPN (payments.py)
+    # làm theo lô. Cổng thanh toán gửi lại IPN nhiều lần – các bản trùng gateway_txn_id bị bỏ qua khi ghi.
+    try:
+        notification = payments.parse_notification(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'resultCode': 1, 'message': str(e)}), 400
+    payments.enqueue(db.session.connection(), [notification])
+    db.session.commit()
+    payments.notify_worker()
 
     # Phải trả về response cho MoMo/VNPay, nếu không họ sẽ gửi lại IPN nhiều lần
-    return jsonify({'message': 'IPN received'}), 200
+    return jsonify({'resultCode': 0, 'message': 'IPN received'}), 200
+
+
+# Thứ tự khóa của lịch sử đặt khám: mới nhất trước
+HISTORY_ORDER = [(DoctorShift.work_date, True), (Shift.start_time, True), (Ticket.id, True)]
+ARCHIVE_HISTORY_ORDER = [(DoctorShiftArchive.work_date, True), (Shift.start_time, True), (TicketArchive.id, True)]
+HISTORY_CURSOR_TYPES = (date, time, int)
+
+
+def ticket_key(ticket):
+    return ticket.doctor_shift.work_date, ticket.doctor_shift.shift.start_time, ticket.id
+
+
+def appointment_history_page():
+    """Một trang lịch sử đặt khám của người dùng hiện tại: (danh sách Ticket/TicketArchive, cursor trang kế tiếp).
+
+    Vé của các ca trước archive_cutoff() có thể đã nằm trong kho lưu trữ (archive.py); hai nguồn cùng thứ tự
+    khóa nên trang được ghép lại theo ticket_key."""
+    query = db.session.query(Ticket).join(
+        DoctorShift, Ticket.doctor_shift_id == DoctorShift.id
+    ).join(
+        Shift, DoctorShift.shift_id == Shift.id
+    ).options(
+        contains_eager(Ticket.doctor_shift).contains_eager(DoctorShift.shift),
+        contains_eager(Ticket.doctor_shift).joinedload(DoctorShift.doctor).joinedload(Doctor.user),
+        contains_eager(Ticket.doctor_shift).joinedload(DoctorShift.doctor).joinedload(Doctor.medical_center),
+        contains_eager(Ticket.doctor_shift).joinedload(DoctorShift.doctor).selectinload(
+            Doctor.doctor_departments).joinedload(DoctorDepartment.department)
+    ).filter(
+        Ticket.client_id == current_user.id
+    )
+    cursor = pagination.decode_cursor(request.args.get('cursor'), HISTORY_CURSOR_TYPES)
+    limit = pagination.page_size()
+    tickets, next_cursor = pagination.paginate(query, HISTORY_ORDER, cursor, limit, ticket_key)
+    if next_cursor and tickets[-1].doctor_shift.work_date >= archive.archive_cutoff():
+        # Trang đầy và vẫn còn sau mốc lưu trữ: mọi vé đã lưu trữ đều nằm ở các trang sau
+        return tickets, next_cursor
+
+    archived_query = db.session.query(TicketArchive).join(
+        DoctorShiftArchive, TicketArchive.doctor_shift_id == DoctorShiftArchive.id
+    ).join(
+        Shift, DoctorShiftArchive.shift_id == Shift.id
+    ).options(
+        contains_eager(TicketArchive.doctor_shift).contains_eager(DoctorShiftArchive.shift),
+        contains_eager(TicketArchive.doctor_shift).joinedload(DoctorShiftArchive.doctor).joinedload(Doctor.user),
+        contains_eager(TicketArchive.doctor_shift).joinedload(DoctorShiftArchive.doctor).joinedload(
+            Doctor.medical_center),
+        contains_eager(TicketArchive.doctor_shift).joinedload(DoctorShiftArchive.doctor).selectinload(
+            Doctor.doctor_departments).joinedload(DoctorDepartment.department)
+    ).filter(
+        TicketArchive.client_id == current_user.id
+    )
+    archived, archived_next = pagination.paginate(archived_query, ARCHIVE_HISTORY_ORDER, cursor, limit, ticket_key)
+    merged = sorted(tickets + archived, key=ticket_key, reverse=True)
+    if len(merged) > limit or next_cursor or archived_next:
+        merged = merged[:limit]
+        return merged, pagination.encode_cursor(ticket_key(merged[-1]))
+    return merged, None
+
+
+def ticket_to_dict(ticket):
+    doctor = ticket.doctor_shift.doctor
+    return {
+        'id': ticket.id,
+        'uuid': ticket.uuid,
+        'status': ticket.status.name,
+        'work_date': ticket.doctor_shift.work_date.isoformat(),
+        'start_time': ticket.doctor_shift.shift.start_time.strftime('%H:%M'),
+        'doctor_id': doctor.id,
+        'doctor_name': f"{doctor.user.first_name} {doctor.user.last_name}",
+        'specialty': ', '.join([dd.department.name for dd in doctor.doctor_departments]),
+        'medical_center': doctor.medical_center.name if doctor.medical_center else None,
+        'patient_name': f"{ticket.first_name} {ticket.last_name}"
+    }
 
 
 @app.route('/appointment_history')
 def appointment_history():
     # Check if the user is logged in
-    if not current_user:
+    if not current_user.is_authenticated:
         flash('Vui lòng đăng nhập để xem lịch sử đặt khám.', 'warning')
         return redirect(url_for('user_login'))
 
-    # Query all tickets for the current user
-    # **FIX:** Added a second .join(Shift) to make the 'shifts.start_time' column available for sorting.
-    tickets = db.session.query(Ticket).options(
-        joinedload(Ticket.doctor_shift).joinedload(DoctorShift.shift),
-        joinedload(Ticket.doctor_shift).joinedload(DoctorShift.doctor).joinedload(Doctor.user),
-        joinedload(Ticket.doctor_shift).joinedload(DoctorShift.doctor).joinedload(Doctor.medical_center),
-        joinedload(Ticket.doctor_shift).joinedload(DoctorShift.doctor).joinedload(Doctor.doctor_departments).joinedload(
-            DoctorDepartment.department)
-    ).filter(
-        Ticket.client_id == current_user.id
-    ).join(
-        DoctorShift, Ticket.doctor_shift_id == DoctorShift.id
-    ).join(
-        Shift, DoctorShift.shift_id == Shift.id
-    ).order_by(
-        DoctorShift.work_date.desc(), Shift.start_time.desc()
-    ).all()
+    tickets, next_cursor = appointment_history_page()
+    return render_template('user/appointment_history.html', tickets=tickets,
+                           next_page_url=pagination.next_page_url(next_cursor))
+
 
-    return render_template('user/appointment_history.html', tickets=tickets)
+@app.route('/api/appointment-history')
+@login_required
+def api_appointment_history():
+    tickets, next_cursor = appointment_history_page()
+    return jsonify({'items': [ticket_to_dict(ticket) for ticket in tickets], 'next_cursor': next_cursor})
 
 @app.route('/cancel_appointment/<int:ticket_id>', methods=['POST'])
 @login_required
@@ -652,38 +980,23 @@ def edit_doctor_shift(work_date):
         selected_shift_ids = {int(id) for id in request.form.getlist('shift_ids')}
 
         # Lấy danh sách ID các ca đã đăng ký trước đó trong ngày
-        existing_shifts = db.session.query(DoctorShift).filter_by(doctor_id=current_user.id, work_date=work_date_obj).all()
-        existing_shift_ids = {ds.shift_id for ds in existing_shifts}
+        existing_shift_ids = {shift_id for shift_id, in db.session.query(DoctorShift.shift_id).filter_by(
+            doctor_id=current_user.id, work_date=work_date_obj).tuples()}
 
-        # Ca cần thêm mới = ca được chọn NHƯNG chưa có trong DB
+        # Ca cần thêm mới = ca được chọn NHƯNG chưa có trong DB; chỉ mục unique (doctor_id, work_date, shift_id)
+        # bảo đảm không có ca trùng, không cần kiểm tra từng ca
         shifts_to_add = selected_shift_ids - existing_shift_ids
-        # Ca cần xóa = ca đã có trong DB NHƯNG không được chọn nữa
+        schedules.materialize_shifts(current_user.id, {(work_date_obj, shift_id) for shift_id in shifts_to_add})
+        # Ca cần xóa = ca đã có trong DB NHƯNG không được chọn nữa; chỉ xóa ca chưa có người đặt
         shifts_to_delete = existing_shift_ids - selected_shift_ids
-
-        # Thêm ca mới
-        for shift_id in shifts_to_add:
-            # Kiểm tra xem ca này đã có người đặt chưa (an toàn)
-            has_ticket = db.session.query(Ticket).join(DoctorShift).filter(
-                DoctorShift.doctor_id == current_user.id,
-                DoctorShift.work_date == work_date_obj,
-                DoctorShift.shift_id == shift_id
-            ).first()
-            if not has_ticket:
-                db.session.add(DoctorShift(doctor_id=current_user.id, shift_id=shift_id, work_date=work_date_obj))
-
-        # Xóa ca cũ
-        for shift_id in shifts_to_delete:
-            shift_to_remove = next((ds for ds in existing_shifts if ds.shift_id == shift_id), None)
-            # Chỉ xóa nếu ca đó chưa có người đặt
-            if shift_to_remove and not shift_to_remove.ticket:
-                db.session.delete(shift_to_remove)
+        schedules.remove_unbooked_shifts(current_user.id, {(work_date_obj, shift_id) for shift_id in shifts_to_delete})
 
         db.session.commit()
         flash(f'Cập nhật lịch làm việc cho ngày {work_date_obj.strftime("%d/%m/%Y")} thành công!', 'success')
         return redirect(url_for('doctor_dashboard'))
 
     # Logic cho GET request
-    all_shifts = db.session.query(Shift).order_by(Shift.start_time).all()
+    all_shifts = reference_data.shifts()
     registered_shifts_for_date = db.session.query(DoctorShift).filter_by(doctor_id=current_user.id,
                                                                          work_date=work_date_obj).all()
     registered_shift_ids = {ds.shift_id for ds in registered_shifts_for_date}
@@ -731,24 +1044,15 @@ def delete_doctor_shifts_by_date(work_date):
     return redirect(url_for('doctor_dashboard'))
 
 
-@app.route('/doctor/appointments')
-def doctor_appointments():
-    # Bảo vệ route, chỉ bác sĩ mới được vào
-    if not current_user or current_user.role != UserRole.DOCTOR:
-        flash('Bạn không có quyền truy cập trang này.', 'danger')
-        return redirect(url_for('home'))
+# Lịch hẹn của bác sĩ: ngày mới nhất trước, trong ngày theo giờ tăng dần
+DOCTOR_APPOINTMENT_ORDER = [(DoctorShift.work_date, True), (Shift.start_time, False), (Ticket.id, False)]
 
-    # Lấy ngày được chọn từ query parameter để lọc (nếu có)
-    selected_date_str = request.args.get('filter_date')
-    query_date = None
-    if selected_date_str:
-        try:
-            query_date = datetime.strptime(selected_date_str, '%Y-%m-%d').date()
-        except ValueError:
-            flash('Định dạng ngày không hợp lệ.', 'warning')
 
-    # Xây dựng câu truy vấn cơ bản
-    query = db.session.query(Ticket).join(DoctorShift).filter(
+def doctor_appointments_page(query_date):
+    """Một trang lịch hẹn của bác sĩ hiện tại: (danh sách Ticket, cursor trang kế tiếp)."""
+    query = db.session.query(Ticket).join(DoctorShift).join(Shift).options(
+        contains_eager(Ticket.doctor_shift).contains_eager(DoctorShift.shift)
+    ).filter(
         DoctorShift.doctor_id == current_user.id
     )
 
@@ -756,15 +1060,57 @@ def doctor_appointments():
     if query_date:
         query = query.filter(DoctorShift.work_date == query_date)
 
-    # Sắp xếp lịch hẹn theo ngày và giờ bắt đầu
-    appointments = query.join(Shift).order_by(
-        DoctorShift.work_date.desc(),
-        Shift.start_time.asc()
-    ).all()
+    cursor = pagination.decode_cursor(request.args.get('cursor'), HISTORY_CURSOR_TYPES)
+    return pagination.paginate(query, DOCTOR_APPOINTMENT_ORDER, cursor, pagination.page_size(), ticket_key)
+
+
+def parse_filter_date():
+    selected_date_str = request.args.get('filter_date')
+    if selected_date_str:
+        try:
+            return selected_date_str, datetime.strptime(selected_date_str, '%Y-%m-%d').date()
+        except ValueError:
+            flash('Định dạng ngày không hợp lệ.', 'warning')
+    return selected_date_str, None
+
+
+@app.route('/doctor/appointments')
+def doctor_appointments():
+    # Bảo vệ route, chỉ bác sĩ mới được vào
+    if not current_user or current_user.role != UserRole.DOCTOR:
+        flash('Bạn không có quyền truy cập trang này.', 'danger')
+        return redirect(url_for('home'))
+
+    # Lấy ngày được chọn từ query parameter để lọc (nếu có)
+    selected_date_str, query_date = parse_filter_date()
+    appointments, next_cursor = doctor_appointments_page(query_date)
 
     return render_template('doctor/appointments.html',
                            appointments=appointments,
-                           filter_date=selected_date_str)
+                           filter_date=selected_date_str,
+                           next_page_url=pagination.next_page_url(next_cursor))
+
+
+@app.route('/api/doctor/appointments')
+def api_doctor_appointments():
+    if not current_user.is_authenticated or current_user.role != UserRole.DOCTOR:
+        return jsonify({'error': 'forbidden'}), 403
+
+    _, query_date = parse_filter_date()
+    appointments, next_cursor = doctor_appointments_page(query_date)
+    return jsonify({
+        'items': [{
+            'id': ticket.id,
+            'uuid': ticket.uuid,
+            'status': ticket.status.name,
+            'work_date': ticket.doctor_shift.work_date.isoformat(),
+            'start_time': ticket.doctor_shift.shift.start_time.strftime('%H:%M'),
+            'patient_name': f"{ticket.first_name} {ticket.last_name}",
+            'gender': ticket.gender,
+            'birth_of_day': ticket.birth_of_day.isoformat()
+        } for ticket in appointments],
+        'next_cursor': next_cursor
+    })
 
 
 @app.route('/doctor/profile', methods=['GET', 'POST'])
@@ -778,15 +1124,14 @@ def doctor_profile():
     doctor_info = current_user.doctor
 
     if request.method == 'POST':
-        if 'avatar_file' in request.files:
-            file = request.files['avatar_file']
-            if file.filename != '':
-                try:
-                    upload_result = uploader.upload(file)
-                    current_user.avatar = upload_result['secure_url']
-                    flash('Cập nhật ảnh đại diện thành công!', 'success')
-                except Exception as e:
-                    flash(f'Lỗi khi tải ảnh lên: {e}', 'danger')
+        avatar_job = None
+        file = request.files.get('avatar_file')
+        if file and file.filename != '':
+            try:
+                avatar_job = avatar_upload.stage_avatar(current_user, file)
+                flash('Ảnh đại diện đang được xử lý và sẽ được cập nhật trong giây lát.', 'info')
+            except ValueError as e:
+                flash(f'Lỗi khi tải ảnh lên: {e}', 'danger')
         current_user.first_name = request.form.get('first_name')
         current_user.last_name = request.form.get('last_name')
         current_user.phone = request.form.get('phone')
@@ -800,22 +1145,40 @@ def doctor_profile():
 
         try:
             db.session.commit()
+            if avatar_job:
+                avatar_upload.submit(avatar_job)
             flash('Cập nhật hồ sơ thành công!', 'success')
         except Exception as e:
             db.session.rollback()
+            if avatar_job:
+                avatar_upload.discard(avatar_job)
             flash(f'Lỗi khi cập nhật hồ sơ: {e}', 'danger')
 
         return redirect(url_for('doctor_profile'))
 
     # Lấy danh sách các trung tâm y tế để hiển thị trong dropdown
-    medical_centers = db.session.query(MedicalCenter).all()
+    medical_centers = reference_data.medical_centers()
+
+    return render_template('doctor/profile.html', user=current_user, doctor=doctor_info, medical_centers=medical_centers,
+                           avatar_pending=avatar_upload.is_pending(current_user))
 
-    return render_template('doctor/profile.html', user=current_user, doctor=doctor_info, medical_centers=medical_centers)
+
+@app.route('/api/avatar-status')
+@login_required
+def api_avatar_status():
+    # Giao diện hỏi định kỳ để thay ảnh cũ bằng ảnh mới khi xử lý xong
+    avatar = current_user.avatar
+    return jsonify({
+        'avatar': avatar,
+        'thumbnails': {size: avatar_upload.thumbnail_url(avatar, size) for size in avatar_upload.THUMBNAIL_SIZES},
+        'pending': avatar_upload.is_pending(current_user)
+    })
 
 
 @login.user_loader
 def load_user(user_id):
-    return db.session.get(User, int(user_id))
+    # Đọc từ snapshot đã ký trong session; chỉ truy vấn CSDL khi snapshot thiếu/hết hạn (xem user_identity.py)
+    return user_identity.load(user_id)
 
 
 
@@ -0,0 +1,387 @@
+# DatLichKhamOnline/migrations.py
+# Migration lược đồ có đánh số phiên bản cho CSDL đang chạy (models.py chỉ tạo lược đồ mới bằng
+# drop_all/create_all). Phiên bản đã áp dụng được ghi trong bảng schema_migrations; mỗi lần chạy chỉ áp dụng các
+# phiên bản còn thiếu, theo thứ tự.
+#
+# Mỗi bước kiểm tra trước khi làm (bảng/cột/chỉ mục đã có thì bỏ qua) nên chạy lại an toàn sau khi bị ngắt giữa
+# chừng, và chạy được trên CSDL tạo bằng create_all (các bước chỉ còn ghi nhận phiên bản). DDL được chạy theo cách
+# không chặn đọc/ghi trên bảng đang phục vụ:
+#   - MySQL: ALTER TABLE ... LOCK=NONE / CREATE INDEX ... ALGORITHM=INPLACE LOCK=NONE (báo lỗi thay vì khóa
+#     bảng), lock_wait_timeout ngắn để câu DDL chờ khóa metadata không làm nghẽn các truy vấn xếp hàng sau nó
+#     – hết thời gian chờ thì thử lại sau.
+#   - PostgreSQL: CREATE INDEX CONCURRENTLY, lock_timeout ngắn.
+#   - SQLite: mỗi migration là một giao dịch; ADD COLUMN chỉ sửa lược đồ, không ghi lại bảng.
+# Chỉ một tiến trình chạy migration tại một thời điểm (GET_LOCK / pg_try_advisory_lock).
+#
+#   python migrations.py            # áp dụng các migration còn thiếu
+#   python migrations.py status     # liệt kê phiên bản đã/chưa áp dụng
+#   python migrations.py --to 3     # chỉ áp dụng đến phiên bản 3
+#
+# Cấu hình qua app.config:
+#   MIGRATION_LOCK_TIMEOUT  = số giây một câu DDL được chờ khóa trước khi bỏ cuộc và thử lại
+#   MIGRATION_DDL_RETRIES   = số lần thử mỗi câu DDL
+#   MIGRATION_BATCH_SIZE    = số dòng mỗi lô khi sửa dữ liệu
+import argparse
+import logging
+import time
+from collections import defaultdict, namedtuple
+from datetime import datetime
+
+from sqlalchemy import MetaData, Table, Column, Integer, String, DateTime, inspect, select, insert, delete, \
+    update, exists, func, and_
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import CreateIndex
+
+from DatLichKhamOnline import app, db, availability, doctor_search, stats_rollup
+from models import MedicalCenter, DoctorShift, Ticket, DoctorAvailability, DoctorShiftArchive, TicketArchive, User, Shift
+
+app.config.setdefault('MIGRATION_LOCK_TIMEOUT', 5)
+app.config.setdefault('MIGRATION_DDL_RETRIES', 5)
+app.config.setdefault('MIGRATION_BATCH_SIZE', 1000)
+
+logger = logging.getLogger(__name__)
+
+LOCK_NAME = 'mas_schema_migrations'
+
+# Bảng ghi phiên bản không thuộc models (db.metadata) để drop_all/create_all không đụng tới
+version_table = Table(
+    'schema_migrations', MetaData(),
+    Column('version', Integer, primary_key=True, autoincrement=False),
+    Column('name', String(100), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+doctor_shift_table = DoctorShift.__table__
+ticket_table = Ticket.__table__
+
+Migration = namedtuple('Migration', 'version name upgrade after')
+MIGRATIONS = []
+
+
+class MigrationError(Exception):
+    pass
+
+
+def migration(version, name, after=None):
+    """Đăng ký một migration. `upgrade(connection)` trả về kết quả (truthy nếu đã thay đổi gì);
+    `after(kết quả)` chạy sau khi giao dịch của migration đã commit, qua db.session."""
+    def register(upgrade):
+        MIGRATIONS.append(Migration(version, name, upgrade, after))
+        return upgrade
+    return register
+
+
+# ---------------------------------------------------------------- thao tác lược đồ
+
+def has_table(connection, table_name):
+    return inspect(connection).has_table(table_name)
+
+
+def has_column(connection, table_name, column_name):
+    return column_name in {column['name'] for column in inspect(connection).get_columns(table_name)}
+
+
+def has_index(connection, table_name, index_name):
+    inspector = inspect(connection)
+    names = {index['name'] for index in inspector.get_indexes(table_name)}
+    names.update(constraint['name'] for constraint in inspector.get_unique_constraints(table_name))
+    return index_name in names
+
+
+def model_index(table, name):
+    return next(index for index in table.indexes if index.name == name)
+
+
+def _is_lock_timeout(error):
+    original = error.orig
+    code = getattr(original, 'pgcode', None) or (original.args[0] if getattr(original, 'args', None) else None)
+    # MySQL 1205: Lock wait timeout exceeded; PostgreSQL 55P03: lock_not_available
+    return code in (1205, '55P03') or 'database is locked' in str(original)
+
+
+def execute_ddl(connection, sql):
+    """Chạy một câu DDL; nếu hết thời gian chờ khóa (bảng đang bận) thì đợi rồi thử lại."""
+    retries = app.config['MIGRATION_DDL_RETRIES']
+    for attempt in range(1, retries + 1):
+        try:
+            connection.exec_driver_sql(sql)
+            return
+        except OperationalError as error:
+            if attempt == retries or not _is_lock_timeout(error):
+                raise
+            logger.warning('DDL chờ khóa quá lâu, thử lại (%d/%d): %s', attempt, retries, sql)
+            time.sleep(min(2 ** attempt, 30))
+
+
+def create_table(connection, table):
+    """Tạo bảng (cùng các chỉ mục của nó) nếu chưa có. Trả về True nếu vừa tạo."""
+    if has_table(connection, table.name):
+        return False
+    table.create(connection)
+    return True
+
+
+def add_column(connection, table, column):
+    """ALTER TABLE ADD COLUMN nếu cột chưa có. Chỉ cho cột cho phép NULL – không phải ghi lại dữ liệu cũ."""
+    if has_column(connection, table.name, column.name):
+        return False
+    if not column.nullable:
+        raise MigrationError(f'Cột {table.name}.{column.name} phải cho phép NULL để thêm trực tuyến')
+    preparer = connection.dialect.identifier_preparer
+    sql = (f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} '
+           f'{column.type.compile(dialect=connection.dialect)} NULL')
+    if connection.dialect.name == 'mysql':
+        sql += ', LOCK=NONE'  # MySQL tự chọn INSTANT/INPLACE
+    execute_ddl(connection, sql)
+    return True
+
+
+def create_index(connection, index):
+    """Tạo chỉ mục của models nếu chưa có, không chặn ghi trên bảng. Trả về True nếu vừa tạo."""
+    if has_index(connection, index.table.name, index.name):
+        return False
+    dialect = connection.dialect.name
+    sql = str(CreateIndex(index).compile(dialect=connection.dialect))
+    if dialect == 'mysql':
+        sql += ' ALGORITHM=INPLACE LOCK=NONE'
+    elif dialect == 'postgresql':
+        sql = sql.replace(' INDEX ', ' INDEX CONCURRENTLY ', 1)
+    try:
+        execute_ddl(connection, sql)
+    except Exception:
+        if dialect == 'postgresql':
+            # CREATE INDEX CONCURRENTLY lỗi để lại chỉ mục INVALID – xóa để lần chạy sau tạo lại
+            connection.exec_driver_sql(f'DROP INDEX CONCURRENTLY IF EXISTS '
+                                       f'{connection.dialect.identifier_preparer.quote(index.name)}')
+        raise
+    return True
+
+
+# ---------------------------------------------------------------- các migration
+
+DERIVED_TABLES = {
+    'doctor_search_documents': doctor_search.rebuild_search_index,
+    'doctor_search_terms': doctor_search.rebuild_search_index,
+    # backfill dựng lại cả doctor_availability và slot_daily_stats
+    'doctor_availability': stats_rollup.backfill,
+    'stat_counters': stats_rollup.backfill,
+    'ticket_daily_stats': stats_rollup.backfill,
+    'slot_daily_stats': stats_rollup.backfill,
+}
+
+
+def _backfill_created(created):
+    """Dựng dữ liệu cho các bảng dẫn xuất vừa được tạo trên CSDL đã có dữ liệu."""
+    for rebuild in dict.fromkeys(DERIVED_TABLES[name] for name in created if name in DERIVED_TABLES):
+        logger.info('Dựng dữ liệu dẫn xuất: %s', rebuild.__qualname__)
+        rebuild()
+        db.session.commit()
+
+
+@migration(1, 'create_missing_tables', after=_backfill_created)
+def create_missing_tables(connection):
+    """Tạo các bảng có trong models nhưng chưa có trong CSDL (lịch lặp lại, chỉ mục tìm kiếm/ca trống, thống kê,
+    thanh toán... hoặc toàn bộ lược đồ nếu CSDL trống)."""
+    return [table.name for table in db.metadata.sorted_tables if create_table(connection, table)]
+
+
+@migration(2, 'medical_centers_coordinates')
+def medical_centers_coordinates(connection):
+    table = MedicalCenter.__table__
+    return [column.name for column in (table.c.latitude, table.c.longitude) if add_column(connection, table, column)]
+
+
+@migration(3, 'doctor_availability_work_date_index')
+def doctor_availability_work_date_index(connection):
+    return create_index(connection, model_index(DoctorAvailability.__table__, 'ix_doctor_availability_work_date'))
+
+
+@migration(4, 'tickets_hot_path_indexes')
+def tickets_hot_path_indexes(connection):
+    """(client_id) cho lịch sử đặt khám, (status, created_at) cho việc quét vé quá hạn giữ chỗ."""
+    return [name for name in ('ix_tickets_client_id', 'ix_tickets_status_created_at')
+            if create_index(connection, model_index(ticket_table, name))]
+
+
+def remove_duplicate_shifts(connection):
+    """Xóa các ca trùng (doctor_id, work_date, shift_id): giữ ca đã có vé, nếu không có thì ca có id nhỏ nhất.
+    Trả về số ca đã xóa. Báo lỗi nếu một nhóm trùng có nhiều hơn một vé (cần xử lý tay)."""
+    shifts = doctor_shift_table
+    key = (shifts.c.doctor_id, shifts.c.work_date, shifts.c.shift_id)
+    duplicated = select(*key).group_by(*key).having(func.count() > 1).subquery()
+    rows = connection.execute(
+        select(shifts.c.id, *key, ticket_table.c.id.label('ticket_id'))
+        .select_from(shifts.join(duplicated, and_(*(column == duplicated.c[column.name] for column in key)))
+                     .outerjoin(ticket_table, ticket_table.c.doctor_shift_id == shifts.c.id))
+        .order_by(*key, shifts.c.id)
+    ).all()
+    groups = defaultdict(list)
+    for row in rows:
+        groups[(row.doctor_id, row.work_date, row.shift_id)].append(row)
+
+    doomed, conflicts = [], []
+    for slot, group in groups.items():
+        booked = [row for row in group if row.ticket_id is not None]
+        if len(booked) > 1:
+            conflicts.append(slot)
+            continue
+        keep = booked[0] if booked else group[0]
+        doomed.extend(row.id for row in group if row is not keep)
+    if conflicts:
+        raise MigrationError(f'{len(conflicts)} ca trùng đã có nhiều vé, cần xử lý tay trước khi thêm chỉ mục '
+                             f'unique (doctor_id, work_date, shift_id): {conflicts[:10]}')
+
+    batch_size = app.config['MIGRATION_BATCH_SIZE']
+    for start in range(0, len(doomed), batch_size):
+        # NOT EXISTS lặp lại phòng khi có vé mới được đặt vào ca sắp xóa
+        connection.execute(delete(shifts).where(
+            shifts.c.id.in_(doomed[start:start + batch_size]),
+            ~exists().where(ticket_table.c.doctor_shift_id == shifts.c.id)))
+    if doomed:
+        availability.refresh_availability(connection, {(doctor_id, work_date) for doctor_id, work_date, _ in groups})
+    return len(doomed)
+
+
+@migration(5, 'doctor_shifts_unique_slot')
+def doctor_shifts_unique_slot(connection):
+    """Chỉ mục unique (doctor_id, work_date, shift_id): chặn ca trùng ở CSDL và phục vụ truy vấn ca theo bác sĩ/ngày.
+    Ca trùng được thêm giữa lúc dọn và lúc tạo chỉ mục làm câu CREATE lỗi – chạy lại migration là đủ."""
+    index = model_index(doctor_shift_table, 'uq_doctor_shifts_doctor_date_shift')
+    if has_index(connection, doctor_shift_table.name, index.name):
+        return False
+    removed = remove_duplicate_shifts(connection)
+    if removed:
+        logger.info('Đã xóa %d ca trùng', removed)
+    return create_index(connection, index)
+
+
+@migration(6, 'doctor_shifts_work_date_index')
+def doctor_shifts_work_date_index(connection):
+    """(work_date, doctor_id) cho việc chọn các ca cũ cần lưu trữ và báo cáo theo khoảng ngày."""
+    return create_index(connection, model_index(doctor_shift_table, 'ix_doctor_shifts_work_date'))
+
+
+@migration(7, 'archive_tables')
+def archive_tables(connection):
+    """Kho lưu trữ ca/vé cũ (archive.py)."""
+    return [table.name for table in (DoctorShiftArchive.__table__, TicketArchive.__table__)
+            if create_table(connection, table)]
+
+
+@migration(8, 'doctor_shifts_template_id')
+def doctor_shifts_template_id(connection):
+    """DoctorShift.template_id: lịch lặp lại đã sinh ra ca. Ca cũ để NULL (coi như bác sĩ tự thêm) – sửa/xóa lịch
+    sẽ không xóa chúng."""
+    return [table.name for table in (doctor_shift_table, DoctorShiftArchive.__table__)
+            if add_column(connection, table, table.c.template_id)]
+
+
+@migration(9, 'users_avatar_pending')
+def users_avatar_pending(connection):
+    """User.avatar_pending: job ảnh đại diện đang xử lý, dùng chung cho mọi tiến trình web."""
+    table = User.__table__
+    return [table.name] if add_column(connection, table, table.c.avatar_pending) else []
+
+
+@migration(10, 'shifts_bit')
+def shifts_bit(connection):
+    """Shift.bit: vị trí bit cố định của ca trong doctor_availability.free_mask. Ca cũ nhận bit theo giờ bắt đầu –
+    đúng thứ tự bit đang dùng – nên chỉ mục hiện có vẫn đúng; chỉ dựng lại nếu thứ tự đó không giữ được."""
+    table = Shift.__table__
+    add_column(connection, table, table.c.bit)
+    rows = connection.execute(select(table.c.id, table.c.bit).order_by(table.c.start_time, table.c.id)).all()
+    missing = [row.id for row in rows if row.bit is None]
+    for shift_id, bit in zip(missing, availability.free_shift_bits(connection)):
+        connection.execute(update(table).where(table.c.id == shift_id).values(bit=bit))
+    bits = availability.shift_bits(connection)
+    if missing and any(bit != ordinal for ordinal, bit in enumerate(bits.values())):
+        logger.info('Thứ tự bit của ca thay đổi: dựng lại chỉ mục doctor_availability')
+        availability.rebuild_index(connection)
+    create_index(connection, model_index(table, 'ux_shifts_bit'))
+    return missing
+
+
+# ---------------------------------------------------------------- chạy migration
+
+def _prepare(connection):
+    timeout = int(app.config['MIGRATION_LOCK_TIMEOUT'])
+    dialect = connection.dialect.name
+    if dialect == 'mysql':
+        connection.exec_driver_sql(f'SET SESSION lock_wait_timeout = {timeout}')
+        acquired = connection.exec_driver_sql(f"SELECT GET_LOCK('{LOCK_NAME}', 0)").scalar()
+    elif dialect == 'postgresql':
+        connection.exec_driver_sql(f"SET lock_timeout = '{timeout}s'")
+        acquired = connection.exec_driver_sql(f"SELECT pg_try_advisory_lock(hashtext('{LOCK_NAME}'))").scalar()
+    else:
+        if dialect == 'sqlite':
+            connection.exec_driver_sql(f'PRAGMA busy_timeout = {timeout * 1000}')
+        acquired = True  # SQLite: mỗi migration là một giao dịch ghi, chỉ một tiến trình ghi tại một thời điểm
+    if not acquired:
+        raise MigrationError('Một tiến trình khác đang chạy migration')
+
+
+def _release(connection):
+    dialect = connection.dialect.name
+    if dialect == 'mysql':
+        connection.exec_driver_sql(f"SELECT RELEASE_LOCK('{LOCK_NAME}')")
+    elif dialect == 'postgresql':
+        connection.exec_driver_sql(f"SELECT pg_advisory_unlock(hashtext('{LOCK_NAME}'))")
+
+
+def applied_versions(connection):
+    """{phiên bản: (tên, thời điểm áp dụng)} đã ghi trong schema_migrations."""
+    if not has_table(connection, version_table.name):
+        return {}
+    return {row.version: (row.name, row.applied_at) for row in connection.execute(select(version_table))}
+
+
+def upgrade(target=None):
+    """Áp dụng các migration chưa chạy (đến phiên bản `target` nếu có). Trả về danh sách Migration đã áp dụng.
+    Cần app context."""
+    applied_now = []
+    with db.engine.connect() as connection:
+        if connection.dialect.name in ('mysql', 'postgresql'):
+            # DDL trực tuyến (CONCURRENTLY) không chạy được trong giao dịch; MySQL tự commit sau mỗi DDL
+            connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        with connection.begin():
+            _prepare(connection)
+        try:
+            with connection.begin():
+                version_table.create(connection, checkfirst=True)
+                applied = applied_versions(connection)
+            for item in sorted(MIGRATIONS):
+                if item.version in applied or (target is not None and item.version > target):
+                    continue
+                started = time.perf_counter()
+                with connection.begin():
+                    result = item.upgrade(connection)
+                    connection.execute(insert(version_table).values(
+                        version=item.version, name=item.name, applied_at=datetime.now()))
+                if item.after and result:
+                    item.after(result)
+                logger.info('Đã áp dụng migration %d %s (%.2f s)', item.version, item.name,
+                            time.perf_counter() - started)
+                applied_now.append(item)
+        finally:
+            with connection.begin():
+                _release(connection)
+    return applied_now
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migration lược đồ CSDL')
+    parser.add_argument('command', nargs='?', choices=('upgrade', 'status'), default='upgrade')
+    parser.add_argument('--to', type=int, help='Chỉ áp dụng đến phiên bản này')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    with app.app_context():
+        if args.command == 'status':
+            with db.engine.connect() as connection:
+                applied = applied_versions(connection)
+            for item in sorted(MIGRATIONS):
+                name, applied_at = applied.get(item.version, (None, None))
+                state = f'đã áp dụng {applied_at:%Y-%m-%d %H:%M}' if applied_at else 'chưa áp dụng'
+                print(f'{item.version:>4}  {item.name:<40} {state}')
+        else:
+            done = upgrade(args.to)
+            print(f"Đã áp dụng {len(done)} migration." if done else "Lược đồ đã ở phiên bản mới nhất.")
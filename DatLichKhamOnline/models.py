@@ -45,6 +45,8 @@ class User(db.Model, UserMixin):
     phone = db.Column(db.String(20), nullable=True)
     address = db.Column(db.String(200), nullable=True)
     avatar = db.Column(db.String(255), nullable=True)
+    # Tên job ảnh đại diện đang xử lý ở nền (avatar_upload.py); NULL = không có ảnh mới nào đang chờ
+    avatar_pending = db.Column(db.String(40), nullable=True)
     doctor = relationship("Doctor", back_populates="user", uselist=False)
     tickets = relationship("Ticket", back_populates="client")
 
@@ -66,6 +68,9 @@ class MedicalCenter(db.Model):
     phone = db.Column(db.String(20), nullable=True)
     description = db.Column(db.String(255), nullable=True)
     image = db.Column(db.Text, nullable=True)
+    # Tọa độ (độ thập phân, WGS84) do admin/bulk_import nhập – không geocode trực tuyến từ address
+    latitude = db.Column(db.Float, nullable=True)
+    longitude = db.Column(db.Float, nullable=True)
     doctors = relationship("Doctor", back_populates="medical_center")
 
     def __str__(self): return self.name
@@ -95,6 +100,7 @@ class Doctor(db.Model):
     medical_center = relationship("MedicalCenter", back_populates="doctors")
     doctor_departments = relationship("DoctorDepartment", back_populates="doctor")
     doctor_shifts = relationship("DoctorShift", back_populates="doctor")
+    schedule_templates = relationship("ScheduleTemplate", back_populates="doctor")
 
 
 class DoctorDepartment(db.Model):
@@ -115,7 +121,27 @@ class Shift(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
     start_time = db.Column(db.Time, nullable=False)
     end_time = db.Column(db.Time, nullable=False)
+    # Vị trí bit của ca trong doctor_availability.free_mask: gán khi tạo ca (availability.py), không đổi khi sửa giờ.
+    # Cho phép NULL chỉ để migration thêm được cột vào bảng cũ.
+    bit = db.Column(db.SmallInteger, nullable=True)
     doctor_shifts = relationship("DoctorShift", back_populates="shift")
+    __table_args__ = (db.Index('ux_shifts_bit', 'bit', unique=True),)
+
+
+class ScheduleTemplate(db.Model):
+    # Lịch lặp lại hàng tuần, ví dụ Thứ 2/4/6 từ 07:00 đến 11:30 trong một khoảng ngày.
+    # Bit i của weekday_mask ứng với date.weekday() == i (0 = Thứ 2).
+    __tablename__ = 'schedule_templates'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctors.id'), nullable=False)
+    weekday_mask = db.Column(db.Integer, nullable=False)
+    start_time = db.Column(db.Time, nullable=False)
+    end_time = db.Column(db.Time, nullable=False)
+    start_date = db.Column(db.Date, nullable=False)
+    end_date = db.Column(db.Date, nullable=False)
+    doctor = relationship("Doctor", back_populates="schedule_templates")
 
 
 class DoctorShift(db.Model):
@@ -126,9 +152,18 @@ class DoctorShift(db.Model):
     doctor_id = db.Column(db.Integer, db.ForeignKey('doctors.id'), nullable=False)
     shift_id = db.Column(db.Integer, db.ForeignKey('shifts.id'), nullable=False)
     work_date = db.Column(db.Date, nullable=False)
+    # Lịch lặp lại đã sinh ra ca này (NULL: bác sĩ tự thêm). Sửa/xóa lịch chỉ xóa các ca của chính nó (schedules.py).
+    # Không đặt khóa ngoại: ca đã qua có thể nằm trong kho lưu trữ sau khi lịch bị xóa
+    template_id = db.Column(db.Integer, nullable=True)
     doctor = relationship("Doctor", back_populates="doctor_shifts")
     shift = relationship("Shift", back_populates="doctor_shifts")
     ticket = relationship("Ticket", back_populates="doctor_shift", uselist=False)
+    # Mỗi bác sĩ chỉ có một ca cho mỗi (ngày, khung giờ). Thứ tự cột (doctor_id, work_date, shift_id) để chỉ mục
+    # này cũng phục vụ các truy vấn "ca của bác sĩ trong khoảng ngày" (xem migrations.py)
+    # (work_date, doctor_id): quét theo khoảng ngày – lưu trữ ca cũ (archive.py), phân tích (analytics.py)
+    __table_args__ = (db.Index('uq_doctor_shifts_doctor_date_shift', 'doctor_id', 'work_date', 'shift_id',
+                               unique=True),
+                      db.Index('ix_doctor_shifts_work_date', 'work_date', 'doctor_id'))
 
 
 class Ticket(db.Model):
@@ -146,6 +181,137 @@ class Ticket(db.Model):
     gender = db.Column(db.String(50), nullable=False)
     doctor_shift = relationship("DoctorShift", back_populates="ticket")
     client = relationship("User", back_populates="tickets")
+    # ticket_expiry.py quét các vé PENDING quá hạn giữ chỗ theo chỉ mục (status, created_at); lịch sử đặt khám
+    # đọc theo client_id
+    __table_args__ = (db.Index('ix_tickets_status_created_at', 'status', 'created_at'),
+                      db.Index('ix_tickets_client_id', 'client_id'))
+
+
+# Kho lưu trữ (archive.py): ca và vé có ngày khám quá ARCHIVE_AFTER_DAYS được chuyển khỏi doctor_shifts/tickets,
+# giữ nguyên id và các cột. Chỉ đọc – lịch sử đặt khám và analytics đọc thêm từ đây khi hỏi khoảng ngày cũ.
+# Trên MySQL dùng ROW_FORMAT=COMPRESSED (InnoDB nén trang) vì dữ liệu hầu như không bao giờ được đọc lại.
+class DoctorShiftArchive(db.Model):
+    __tablename__ = 'doctor_shifts_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    created_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctors.id'), nullable=False)
+    shift_id = db.Column(db.Integer, db.ForeignKey('shifts.id'), nullable=False)
+    work_date = db.Column(db.Date, nullable=False)
+    template_id = db.Column(db.Integer, nullable=True)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    doctor = relationship("Doctor", viewonly=True)
+    shift = relationship("Shift", viewonly=True)
+    __table_args__ = (db.Index('ix_doctor_shifts_archive_work_date', 'work_date', 'doctor_id'),
+                      {'mysql_row_format': 'COMPRESSED'})
+
+
+class TicketArchive(db.Model):
+    __tablename__ = 'tickets_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    created_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+    uuid = db.Column(db.String(255), unique=True)
+    doctor_shift_id = db.Column(db.Integer, db.ForeignKey('doctor_shifts_archive.id'), unique=True, nullable=False)
+    client_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    status = db.Column(db.Enum(TicketStatus), nullable=False)
+    first_name = db.Column(db.String(255), nullable=False)
+    last_name = db.Column(db.String(255), nullable=False)
+    birth_of_day = db.Column(db.Date, nullable=False)
+    gender = db.Column(db.String(50), nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    doctor_shift = relationship("DoctorShiftArchive", viewonly=True)
+    client = relationship("User", viewonly=True)
+    __table_args__ = (db.Index('ix_tickets_archive_client_id', 'client_id'),
+                      {'mysql_row_format': 'COMPRESSED'})
+
+
+class DoctorSearchDocument(db.Model):
+    # Tài liệu tìm kiếm phi chuẩn hóa cho mỗi bác sĩ (tên, chuyên khoa, nơi công tác, mô tả; đã bỏ dấu),
+    # được duy trì bởi doctor_search.py. Bảng dẫn xuất, không đặt khóa ngoại.
+    __tablename__ = 'doctor_search_documents'
+    doctor_id = db.Column(db.Integer, primary_key=True)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+    content = db.Column(db.Text, nullable=False)
+
+
+class DoctorSearchTerm(db.Model):
+    # Chỉ mục đảo: từ (đã bỏ dấu) -> bác sĩ, kèm trọng số theo trường chứa từ đó
+    __tablename__ = 'doctor_search_terms'
+    term = db.Column(db.String(64), primary_key=True)
+    doctor_id = db.Column(db.Integer, primary_key=True, index=True)
+    weight = db.Column(db.Integer, nullable=False)
+
+
+class DoctorAvailability(db.Model):
+    # Chỉ mục khung giờ còn trống theo (bác sĩ, ngày), được duy trì bởi availability.py.
+    # Bit thứ i của free_mask ứng với ca có Shift.bit == i còn trống.
+    # Là bảng dẫn xuất nên không đặt khóa ngoại, để việc xóa dữ liệu gốc không bị chặn.
+    __tablename__ = 'doctor_availability'
+    doctor_id = db.Column(db.Integer, primary_key=True)
+    work_date = db.Column(db.Date, primary_key=True)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+    free_mask = db.Column(db.BigInteger, nullable=False, default=0)
+    free_count = db.Column(db.Integer, nullable=False, default=0)
+    slot_count = db.Column(db.Integer, nullable=False, default=0)
+    # Tìm khung giờ sớm nhất của nhiều bác sĩ quét theo ngày (booking.earliest_free_keys)
+    __table_args__ = (db.Index('ix_doctor_availability_work_date', 'work_date', 'doctor_id'),)
+
+
+# Các bảng thống kê cộng dồn (stats_rollup.py). Các dòng dùng chung bởi mọi lượt đặt lịch được chia
+# thành nhiều "shard" để các giao dịch đồng thời không phải chờ khóa trên cùng một dòng.
+class StatCounter(db.Model):
+    __tablename__ = 'stat_counters'
+    name = db.Column(db.String(64), primary_key=True)
+    shard = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+class TicketDailyStat(db.Model):
+    # Số vé theo ngày đặt (Ticket.created_at), bác sĩ và trạng thái hiện tại
+    __tablename__ = 'ticket_daily_stats'
+    stat_date = db.Column(db.Date, primary_key=True)
+    doctor_id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.Enum(TicketStatus), primary_key=True)
+    medical_center_id = db.Column(db.Integer, nullable=True)
+    ticket_count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class SlotDailyStat(db.Model):
+    # Tổng số khung giờ và số khung giờ còn trống theo ngày khám
+    __tablename__ = 'slot_daily_stats'
+    work_date = db.Column(db.Date, primary_key=True)
+    shard = db.Column(db.Integer, primary_key=True)
+    slot_count = db.Column(db.Integer, nullable=False, default=0)
+    free_count = db.Column(db.Integer, nullable=False, default=0)
+
+
+# Thanh toán (payments.py). Mỗi lần bắt đầu thanh toán là một PaymentAttempt, khóa theo idempotency key để
+# bấm lại/tải lại trang không tạo đơn mới ở cổng thanh toán. order_id là mã đơn gửi cho cổng thanh toán.
+class PaymentAttempt(db.Model):
+    __tablename__ = 'payment_attempts'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    idempotency_key = db.Column(db.String(64), unique=True, nullable=False)
+    order_id = db.Column(db.String(64), unique=True, nullable=False)
+    ticket_id = db.Column(db.Integer, nullable=False, index=True)
+    method = db.Column(db.String(20), nullable=False)
+
+
+# Hàng đợi IPN: mỗi giao dịch của cổng thanh toán chỉ có một dòng (unique gateway_txn_id), IPN gửi lại bị
+# bỏ qua khi ghi. Worker xử lý các dòng có processed_at rỗng theo lô và ghi kết quả vào outcome.
+class PaymentNotification(db.Model):
+    __tablename__ = 'payment_notifications'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    received_at = db.Column(db.DateTime, default=datetime.now, nullable=False)
+    gateway_txn_id = db.Column(db.String(64), unique=True, nullable=False)
+    order_id = db.Column(db.String(64), nullable=False)
+    result_code = db.Column(db.Integer, nullable=False)
+    gateway_time = db.Column(db.DateTime, nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    processed_at = db.Column(db.DateTime, nullable=True)
+    outcome = db.Column(db.String(20), nullable=True)
+    __table_args__ = (db.Index('ix_payment_notifications_queue', 'processed_at', 'id'),)
 
 
 if __name__ == '__main__':
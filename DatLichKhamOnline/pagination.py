@@ -0,0 +1,85 @@
+# DatLichKhamOnline/pagination.py
+# Phân trang theo khóa (keyset/cursor): thay vì OFFSET, mỗi trang bắt đầu ngay sau khóa sắp xếp
+# của dòng cuối trang trước, nên chi phí mỗi trang không phụ thuộc vào độ dài danh sách.
+import base64
+import json
+from datetime import date, time, datetime
+
+from flask import request, url_for
+from sqlalchemy import and_, or_
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def page_size():
+    """Số dòng mỗi trang lấy từ ?limit=, giới hạn trong [1, MAX_PAGE_SIZE]."""
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def _to_json(value):
+    if isinstance(value, (date, time, datetime)):
+        return value.isoformat()
+    return value
+
+
+def encode_cursor(values):
+    raw = json.dumps([_to_json(value) for value in values], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token, types):
+    """Giải mã cursor thành tuple theo kiểu của từng cột (date, time, int, float); None nếu không hợp lệ."""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(raw)
+        if len(values) != len(types):
+            return None
+        return tuple(value_type.fromisoformat(value) if value_type in (date, time, datetime) else value_type(value)
+                     for value, value_type in zip(values, types))
+    except (ValueError, TypeError):
+        return None
+
+
+def keyset_filter(columns, values):
+    """Điều kiện "đứng sau `values`" theo thứ tự `columns` (list các (cột, giảm_dần)).
+
+    Hỗ trợ trộn chiều tăng/giảm: (a < va) OR (a = va AND b > vb) OR ...
+    """
+    clauses = []
+    for i, (column, descending) in enumerate(columns):
+        equal_prefix = [prefix_column == value for (prefix_column, _), value in zip(columns[:i], values[:i])]
+        comparison = column < values[i] if descending else column > values[i]
+        clauses.append(and_(*equal_prefix, comparison))
+    return or_(*clauses)
+
+
+def keyset_order(columns):
+    return [column.desc() if descending else column.asc() for column, descending in columns]
+
+
+def paginate(query, columns, cursor_values, limit, key_of):
+    """Lấy một trang của `query` theo khóa `columns`.
+
+    key_of(row) trả về giá trị khóa của một dòng để tạo cursor cho trang kế tiếp.
+    Trả về (rows, next_cursor); next_cursor là None ở trang cuối.
+    """
+    if cursor_values:
+        query = query.filter(keyset_filter(columns, cursor_values))
+    rows = query.order_by(*keyset_order(columns)).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(key_of(rows[-1]))
+
+
+def next_page_url(next_cursor):
+    """URL của trang kế tiếp cho route hiện tại, giữ nguyên các tham số khác."""
+    if not next_cursor:
+        return None
+    args = request.args.to_dict()
+    args['cursor'] = next_cursor
+    return url_for(request.endpoint, **(request.view_args or {}), **args)
@@ -0,0 +1,261 @@
+# DatLichKhamOnline/payments.py
+# Thanh toán: idempotency cho việc bắt đầu thanh toán và hàng đợi IPN (thông báo server-to-server của cổng
+# thanh toán).
+#
+# Luồng IPN:
+#   1. /payment/ipn kiểm tra chữ ký, ghi thông báo vào bảng payment_notifications (INSERT bỏ qua trùng
+#      gateway_txn_id) rồi trả lời cổng thanh toán ngay – không đụng tới Ticket trong request.
+#   2. Worker lấy các thông báo chưa xử lý theo lô (theo thời điểm giao dịch ở cổng thanh toán), áp dụng
+#      thay đổi trạng thái Ticket qua ORM (các bảng thống kê/chỉ mục được cập nhật theo) và đánh dấu
+#      processed_at/outcome trong cùng một giao dịch.
+# Thông báo gửi lặp lại hoặc đến sai thứ tự không làm sai trạng thái: thanh toán thành công là trạng thái
+# cuối (PENDING -> CONFIRMED); thông báo thất bại đến sau không hạ trạng thái vé.
+#
+# Cấu hình qua app.config:
+#   PAYMENT_GATEWAY_SECRET = khóa HMAC dùng ký/kiểm tra tham số của cổng thanh toán (mặc định lấy từ biến môi
+#                            trường cùng tên). Bắt buộc ngoài chế độ debug/testing: thiếu khóa thì các route thanh
+#                            toán báo lỗi (MissingGatewaySecret) thay vì dùng khóa thử nghiệm ai cũng biết
+#   PAYMENT_WORKER         = 'thread' (luồng nền trong tiến trình web) | 'off' (chạy riêng: python payments.py)
+#   PAYMENT_BATCH_SIZE     = số thông báo mỗi lô
+#   PAYMENT_POLL_INTERVAL  = số giây worker chờ khi hàng đợi rỗng
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+
+from flask import request, jsonify, flash, redirect, url_for
+from sqlalchemy import insert, select, update, bindparam
+from sqlalchemy.exc import IntegrityError
+
+from DatLichKhamOnline import app, db
+from models import Ticket, TicketStatus, PaymentAttempt, PaymentNotification
+
+app.config.setdefault('PAYMENT_GATEWAY_SECRET', os.environ.get('PAYMENT_GATEWAY_SECRET'))
+app.config.setdefault('PAYMENT_WORKER', 'thread')
+app.config.setdefault('PAYMENT_BATCH_SIZE', 500)
+app.config.setdefault('PAYMENT_POLL_INTERVAL', 1.0)
+
+logger = logging.getLogger(__name__)
+
+notification_table = PaymentNotification.__table__
+RESULT_SUCCESS = 0
+SIGNED_FIELDS = ('order_id', 'txn_id', 'result_code', 'gateway_time')
+# Chỉ dùng khi debug/testing (cổng thanh toán giả lập, harness)
+DEV_GATEWAY_SECRET = 'mas-dev-payment-secret'
+
+# Kết quả xử lý một thông báo (cột outcome)
+APPLIED = 'applied'  # vé chuyển PENDING -> CONFIRMED
+DUPLICATE = 'duplicate'  # vé đã được xác nhận trước đó
+FAILED = 'failed'  # giao dịch thất bại, vé vẫn chờ thanh toán
+STALE = 'stale'  # thông báo thất bại đến sau khi vé đã được xác nhận
+REFUND_REQUIRED = 'refund_required'  # tiền về cho một vé đã hủy/hết hạn – cần hoàn tiền thủ công
+UNKNOWN_ORDER = 'unknown_order'
+
+
+class MissingGatewaySecret(RuntimeError):
+    pass
+
+
+def gateway_secret():
+    """Khóa HMAC của cổng thanh toán; khóa thử nghiệm chỉ được dùng khi debug/testing."""
+    secret = app.config['PAYMENT_GATEWAY_SECRET']
+    if secret:
+        return secret
+    if app.debug or app.testing:
+        return DEV_GATEWAY_SECRET
+    raise MissingGatewaySecret('Chưa cấu hình PAYMENT_GATEWAY_SECRET (biến môi trường hoặc app.config)')
+
+
+@app.errorhandler(MissingGatewaySecret)
+def _missing_gateway_secret(error):
+    """Thiếu khóa chỉ làm hỏng các route thanh toán (ký/kiểm tra chữ ký), phần còn lại của trang vẫn chạy."""
+    logger.error('%s', error)
+    if request.endpoint == 'payment_ipn':
+        return jsonify({'resultCode': 1, 'message': 'Payment gateway is not configured'}), 503
+    flash('Thanh toán trực tuyến tạm thời không khả dụng. Vui lòng thử lại sau.', 'danger')
+    return redirect(url_for('home'))
+
+
+def sign(fields):
+    """Chữ ký HMAC-SHA256 của các trường SIGNED_FIELDS (cổng thanh toán giả lập cũng dùng hàm này)."""
+    message = '&'.join(f'{name}={fields[name]}' for name in SIGNED_FIELDS)
+    return hmac.new(gateway_secret().encode('utf-8'), message.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def parse_notification(data):
+    """Kiểm tra và chuẩn hóa tham số từ cổng thanh toán (IPN hoặc redirect). Ném ValueError nếu không hợp lệ."""
+    if not isinstance(data, dict) or any(name not in data for name in SIGNED_FIELDS + ('signature',)):
+        raise ValueError('Thiếu tham số.')
+    fields = {name: str(data[name]) for name in SIGNED_FIELDS}
+    if not hmac.compare_digest(sign(fields), str(data['signature'])):
+        raise ValueError('Chữ ký không hợp lệ.')
+    try:
+        return {
+            'gateway_txn_id': fields['txn_id'][:64],
+            'order_id': fields['order_id'][:64],
+            'result_code': int(fields['result_code']),
+            'gateway_time': datetime.fromisoformat(fields['gateway_time']),
+            'payload': json.dumps(data, ensure_ascii=False, sort_keys=True),
+            'received_at': datetime.now(),
+        }
+    except ValueError:
+        raise ValueError('Tham số không hợp lệ.')
+
+
+def enqueue(connection, notifications):
+    """Ghi các thông báo vào hàng đợi, bỏ qua các gateway_txn_id đã có. Trả về số dòng thực sự được thêm."""
+    if not notifications:
+        return 0
+    dialect = connection.dialect.name
+    if dialect == 'mysql':
+        statement = insert(notification_table).prefix_with('IGNORE')
+    elif dialect in ('sqlite', 'postgresql'):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        statement = dialect_insert(notification_table).on_conflict_do_nothing(index_elements=['gateway_txn_id'])
+    else:
+        existing = set(connection.execute(select(notification_table.c.gateway_txn_id).where(
+            notification_table.c.gateway_txn_id.in_([n['gateway_txn_id'] for n in notifications]))).scalars())
+        notifications = [n for n in notifications if n['gateway_txn_id'] not in existing]
+        if not notifications:
+            return 0
+        statement = insert(notification_table)
+    return connection.execute(statement, notifications).rowcount
+
+
+def get_or_create_attempt(ticket, method, idempotency_key=None):
+    """PaymentAttempt của idempotency key (mặc định: vé + phương thức); tạo mới nếu chưa có. Đã commit."""
+    key = (idempotency_key or f'{ticket.uuid}:{method}')[:64]
+    attempt = db.session.query(PaymentAttempt).filter_by(idempotency_key=key).first()
+    if attempt is not None:
+        return attempt
+    attempt = PaymentAttempt(idempotency_key=key, order_id=uuid.uuid4().hex, ticket_id=ticket.id, method=method)
+    db.session.add(attempt)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Request song song với cùng key đã tạo trước
+        db.session.rollback()
+        attempt = db.session.query(PaymentAttempt).filter_by(idempotency_key=key).one()
+    return attempt
+
+
+def _decide(order_tickets, notification):
+    if notification.order_id not in order_tickets:
+        return UNKNOWN_ORDER
+    ticket = order_tickets[notification.order_id]
+    if ticket is None:
+        # Vé đã bị xóa (hết hạn giữ chỗ – ticket_expiry.py) trước khi tiền về
+        return REFUND_REQUIRED if notification.result_code == RESULT_SUCCESS else STALE
+    if notification.result_code != RESULT_SUCCESS:
+        return FAILED if ticket.status == TicketStatus.PENDING else STALE
+    if ticket.status == TicketStatus.PENDING:
+        ticket.status = TicketStatus.CONFIRMED
+        return APPLIED
+    if ticket.status == TicketStatus.CANCELLED:
+        return REFUND_REQUIRED
+    return DUPLICATE
+
+
+_batch_lock = threading.Lock()
+
+
+def process_batch(limit=None):
+    """Xử lý một lô thông báo chưa xử lý trong một giao dịch. Trả về Counter theo outcome (rỗng = hết hàng đợi)."""
+    limit = limit or app.config['PAYMENT_BATCH_SIZE']
+    with _batch_lock:
+        # SKIP LOCKED cho phép nhiều worker (MySQL 8/PostgreSQL) cùng chạy mà không lấy trùng lô
+        notifications = db.session.query(PaymentNotification).filter(
+            PaymentNotification.processed_at.is_(None)
+        ).order_by(PaymentNotification.id).limit(limit).with_for_update(skip_locked=True).all()
+        if not notifications:
+            db.session.rollback()
+            return Counter()
+
+        order_ids = {notification.order_id for notification in notifications}
+        order_tickets = dict(db.session.query(PaymentAttempt.order_id, Ticket).outerjoin(
+            Ticket, Ticket.id == PaymentAttempt.ticket_id
+        ).filter(PaymentAttempt.order_id.in_(order_ids)).all())
+
+        outcomes = Counter()
+        processed_at = datetime.now()
+        rows = []
+        # Áp dụng theo thời điểm giao dịch ở cổng thanh toán, không theo thứ tự nhận được
+        for notification in sorted(notifications, key=lambda n: (n.gateway_time, n.id)):
+            outcome = _decide(order_tickets, notification)
+            outcomes[outcome] += 1
+            rows.append({'_id': notification.id, 'processed_at': processed_at, 'outcome': outcome})
+        db.session.flush()
+        db.session.connection().execute(
+            update(notification_table).where(notification_table.c.id == bindparam('_id')).values(
+                processed_at=bindparam('processed_at'), outcome=bindparam('outcome')), rows)
+        db.session.commit()
+        return outcomes
+
+
+def drain():
+    """Xử lý đến khi hàng đợi rỗng. Trả về Counter tổng hợp."""
+    total = Counter()
+    while True:
+        outcomes = process_batch()
+        if not outcomes:
+            return total
+        total.update(outcomes)
+
+
+def queue_depth():
+    return db.session.query(PaymentNotification.id).filter(PaymentNotification.processed_at.is_(None)).count()
+
+
+_worker = None
+_worker_lock = threading.Lock()
+_wake = threading.Event()
+
+
+def _run_worker():
+    while True:
+        _wake.wait(app.config['PAYMENT_POLL_INTERVAL'])
+        _wake.clear()
+        try:
+            with app.app_context():
+                outcomes = drain()
+            if outcomes:
+                logger.info('Đã xử lý IPN: %s', dict(outcomes))
+        except Exception:
+            logger.exception('Xử lý hàng đợi IPN thất bại')
+
+
+def notify_worker():
+    """Đánh thức worker sau khi ghi thông báo mới (khởi động luồng nền ở lần đầu nếu PAYMENT_WORKER='thread')."""
+    global _worker
+    if app.config['PAYMENT_WORKER'] != 'thread':
+        return
+    with _worker_lock:
+        if _worker is None:
+            _worker = threading.Thread(target=_run_worker, name='payment-ipn-worker', daemon=True)
+            _worker.start()
+    _wake.set()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Worker xử lý hàng đợi IPN')
+    parser.add_argument('--once', action='store_true', help='Xử lý hết hàng đợi rồi thoát')
+    args = parser.parse_args()
+    with app.app_context():
+        db.create_all()
+        while True:
+            outcomes = drain()
+            if outcomes:
+                print(f"{datetime.now():%H:%M:%S} đã xử lý {sum(outcomes.values())} IPN: {dict(outcomes)}")
+            if args.once:
+                break
+            time.sleep(app.config['PAYMENT_POLL_INTERVAL'])
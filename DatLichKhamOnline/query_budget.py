@@ -0,0 +1,235 @@
+# DatLichKhamOnline/query_budget.py
+# Kiểm tra "ngân sách truy vấn" của từng route trên SQLite trong bộ nhớ: dựng dữ liệu mẫu ở hai quy mô
+# (nhỏ và lớn gấp SCALE_FACTOR lần), gọi mỗi route qua Flask test client và đọc số câu SQL từ header
+# X-SQL-Queries (sql_profiler). Một route không đạt khi:
+#   - số câu SQL vượt ngân sách, hoặc thời gian xử lý vượt ngân sách (ms),
+#   - số câu SQL ở quy mô lớn nhiều hơn ở quy mô nhỏ (truy vấn tăng theo số dòng kết quả -> N+1).
+# Dữ liệu mẫu gồm bác sĩ thuộc nhiều chuyên khoa và bệnh nhân có lịch sử đặt khám dài (nhiều hơn một trang).
+#
+#   python query_budget.py              # thoát với mã 1 nếu có route không đạt
+#   python query_budget.py --only search_doctor_name,appointment_history -v
+import argparse
+import os
+import statistics
+import sys
+import time as timer
+from datetime import date, time, timedelta
+
+parser = argparse.ArgumentParser(description='Kiểm tra ngân sách truy vấn của các route')
+parser.add_argument('--only', help='Chỉ kiểm tra các route có tên trong danh sách (cách nhau bởi dấu phẩy)')
+parser.add_argument('--repeat', type=int, default=3, help='Số lần gọi mỗi route để lấy thời gian trung vị')
+parser.add_argument('-v', '--verbose', action='store_true', help='In các câu SQL của route không đạt')
+args = parser.parse_args()
+
+os.environ['DATABASE_URL'] = 'sqlite://'
+
+from DatLichKhamOnline import app, db, index, response_cache, sql_profiler
+from models import User, UserRole, Doctor, DoctorShift, Ticket, TicketStatus, MedicalCenter, Department, \
+    DoctorDepartment, Shift
+
+PASSWORD = '123'
+SCALE_FACTOR = 4
+BASE = {
+    'doctors_per_center': 3,
+    'departments_per_doctor': 3,
+    'history_tickets': 30,  # > DEFAULT_PAGE_SIZE để lịch sử đặt khám có nhiều trang
+    'days': 5,
+}
+
+
+class Budget:
+    """Ngân sách của một route.
+
+    `known_issue`: mô tả N+1 đã biết nhưng chưa sửa – route vẫn được đo và báo cáo là KNOWN nhưng không
+    làm harness thất bại. `max_queries` khi đó là mục tiêu sau khi sửa; bỏ `known_issue` để bắt đầu áp dụng.
+    """
+
+    def __init__(self, name, user, url, max_queries, max_ms=200, known_issue=None):
+        self.name = name
+        self.user = user
+        self.url = url
+        self.max_queries = max_queries
+        self.max_ms = max_ms
+        self.known_issue = known_issue
+
+
+def budgets(fixtures):
+    day = fixtures['day'].isoformat()
+    doctor_id = fixtures['doctor_id']
+    # Các route có đăng nhập: current_user đọc từ snapshot trong session (user_identity), không tốn câu SQL
+    return [
+        Budget('home', None, '/', 0),
+        Budget('search_doctor_name', None, '/search_doctor?q=Nguyễn', 3),
+        Budget('search_doctor_department', None, '/search_doctor?q=Tim mạch', 3),
+        Budget('search_doctor_all', None, '/search_doctor', 3),
+        Budget('search_medical_center', None, '/search_medical_center?q=Bệnh viện', 1),
+        Budget('medical_center_details', None, f"/medical_center_details/{fixtures['center_id']}", 3),
+        Budget('doctor_details', None, f'/doctor_details/{doctor_id}', 2),
+        Budget('api_doctors', None, '/api/doctors?q=Nguyễn', 3),
+        Budget('api_featured_doctors', None, '/api/featured-doctors', 2),
+        Budget('api_medical_centers', None, '/api/medical-centers', 1),
+        Budget('api_suggestions', None, '/api/suggestions?q=nguy', 0),
+        Budget('api_availability', None, '/api/availability?days=14&limit=50', 1),
+        Budget('api_availability_department', None, '/api/availability?department_id=1&limit=50', 1),
+        Budget('api_availability_center', None, f"/api/availability?medical_center_id={fixtures['center_id']}", 1),
+        Budget('api_earliest_slots', None, '/api/earliest-slots?department_id=1&from=07:00&to=12:00', 4),
+        Budget('api_centers_nearby', None, '/api/centers/nearby?lat=21.03&lon=105.85', 1),
+        Budget('api_doctors_nearby', None, '/api/doctors/nearby?lat=21.03&lon=105.85&department_id=1', 3),
+        Budget('book_appointment', 'patient', f'/book_appointment/{doctor_id}?appointment_date={day}', 4),
+        Budget('appointment_history', 'patient', '/appointment_history', 2),
+        Budget('api_appointment_history', 'patient', '/api/appointment-history', 2),
+        Budget('doctor_dashboard', 'doctor0', '/doctor/dashboard', 1),
+        Budget('doctor_appointments', 'doctor0', f'/doctor/appointments?filter_date={day}', 1),
+        Budget('api_doctor_appointments', 'doctor0', f'/api/doctor/appointments?filter_date={day}', 1),
+        Budget('doctor_edit_shift', 'doctor0', f'/doctor/edit_shift/{day}', 1),
+        Budget('admin_index', 'qb_admin', '/admin/', 5),
+        Budget('admin_users', 'qb_admin', '/admin/user/', 2),
+        Budget('admin_doctors', 'qb_admin', '/admin/doctor/', 2),
+        Budget('admin_tickets', 'qb_admin', '/admin/ticket/', 2),
+    ]
+
+
+def build_fixtures(scale):
+    """Tạo lại toàn bộ CSDL với dữ liệu mẫu ở quy mô `scale`. Trả về id/ngày dùng trong URL."""
+    db.drop_all()
+    db.create_all()
+    password = User.hash_password(PASSWORD)
+    centers = [MedicalCenter(name='Bệnh viện Bạch Mai', address='Hà Nội', latitude=21.0013, longitude=105.8405),
+               MedicalCenter(name='Bệnh viện Chợ Rẫy', address='TP.HCM', latitude=10.7578, longitude=106.6594)]
+    departments = [Department(name=name) for name in ('Tim mạch', 'Nhi khoa', 'Da liễu', 'Thần kinh', 'Nội tiết')]
+    shifts = [Shift(start_time=time(hour, minute), end_time=time(hour + (minute + 30) // 60, (minute + 30) % 60))
+              for hour in range(7, 17) for minute in (0, 30)]
+    db.session.add_all(centers + departments + shifts)
+    db.session.add_all([
+        User(username='qb_admin', password=password, email='qb_admin@example.com', role=UserRole.ADMIN,
+             first_name='Quản', last_name='Trị'),
+        User(username='patient', password=password, email='patient@example.com', role=UserRole.USER,
+             first_name='Trần Thị', last_name='Lan'),
+    ])
+    db.session.flush()
+
+    today = date.today()
+    doctor_shifts = []
+    for number in range(BASE['doctors_per_center'] * scale * len(centers)):
+        user = User(username=f'doctor{number}', password=password, email=f'doctor{number}@example.com',
+                    role=UserRole.DOCTOR, first_name='Nguyễn Văn', last_name=f'Bình {number}')
+        db.session.add(user)
+        db.session.flush()
+        db.session.add(Doctor(id=user.id, medical_center_id=centers[number % len(centers)].id, start_year=2010,
+                              description='Bác sĩ nhiều năm kinh nghiệm'))
+        for offset in range(BASE['departments_per_doctor']):
+            db.session.add(DoctorDepartment(doctor_id=user.id,
+                                            department_id=departments[(number + offset) % len(departments)].id))
+        for day in range(BASE['days']):
+            for shift in shifts[::2]:
+                doctor_shift = DoctorShift(doctor_id=user.id, shift_id=shift.id,
+                                           work_date=today + timedelta(days=day + 1))
+                db.session.add(doctor_shift)
+                doctor_shifts.append(doctor_shift)
+    db.session.flush()
+
+    patient = db.session.query(User).filter_by(username='patient').one()
+    statuses = list(TicketStatus)
+    # Vé trải đều trên các bác sĩ để lịch sử đặt khám chạm tới nhiều bác sĩ/bệnh viện/chuyên khoa khác nhau
+    for number, doctor_shift in enumerate(doctor_shifts[::max(1, len(doctor_shifts) //
+                                                               (BASE['history_tickets'] * scale))]):
+        db.session.add(Ticket(doctor_shift_id=doctor_shift.id, client_id=patient.id,
+                              status=statuses[number % len(statuses)], first_name='Trần Thị', last_name='Lan',
+                              birth_of_day=date(1990, 1, 1), gender='Nữ'))
+    db.session.commit()
+
+    doctor = db.session.query(User).filter_by(username='doctor0').one()
+    return {'doctor_id': doctor.id, 'center_id': centers[0].id, 'day': today + timedelta(days=1)}
+
+
+def measure(clients, budget, repeat):
+    """(số câu SQL tối đa, thời gian trung vị ms, mã trạng thái)."""
+    client = clients[budget.user]
+    # Lần gọi đầu nạp các chỉ mục/cache lười trong bộ nhớ (autocomplete, thứ tự ca...) – không tính
+    client.get(budget.url)
+    queries, latencies, status = [], [], None
+    for _ in range(repeat):
+        # Bỏ qua cache phản hồi để đo đúng chi phí truy vấn của route
+        response_cache.backend.clear()
+        started = timer.perf_counter()
+        response = client.get(budget.url)
+        latencies.append((timer.perf_counter() - started) * 1000)
+        queries.append(int(response.headers.get('X-SQL-Queries', 0)))
+        status = response.status_code
+    return max(queries), statistics.median(latencies), status
+
+
+def run_scale(scale, selected):
+    with app.app_context():
+        fixtures = build_fixtures(scale)
+        items = [budget for budget in budgets(fixtures) if not selected or budget.name in selected]
+    # Request chạy ngoài app context ở trên để mỗi request có current_user riêng
+    clients = {}
+    for user in {budget.user for budget in items}:
+        clients[user] = app.test_client()
+        if user:
+            clients[user].post('/user_login', data={'username': user, 'password': PASSWORD})
+    return {budget.name: (budget, *measure(clients, budget, args.repeat)) for budget in items}
+
+
+def explain(budget, fixtures_scale):
+    """In các câu SQL (và nơi phát sinh) của một route – dùng khi báo lỗi với -v."""
+    captured = []
+    original = sql_profiler.metrics.observe
+
+    def observe(endpoint, profile, patterns):
+        captured.append(profile)
+        original(endpoint, profile, patterns)
+
+    sql_profiler.metrics.observe = observe
+    try:
+        run_scale(fixtures_scale, {budget.name})
+    finally:
+        sql_profiler.metrics.observe = original
+    for statement in captured[-1].statements if captured else ():
+        print(f"      {statement.caller}: {' '.join(statement.sql.split())[:160]}")
+
+
+if __name__ == '__main__':
+    app.config['TESTING'] = True
+    app.config['SQL_PROFILER_ENABLED'] = True
+    app.config['SQL_PROFILER_HEADERS'] = True
+    app.config['SQL_PROFILER_TOOLBAR'] = False
+    selected = set(args.only.split(',')) if args.only else None
+
+    small = run_scale(1, selected)
+    large = run_scale(SCALE_FACTOR, selected)
+
+    failures = []
+    print(f"{'route':28} {'ngân sách':>9} {'nhỏ':>5} {'lớn':>5} {'ms':>8}  kết quả")
+    for name, (budget, small_queries, small_ms, status) in small.items():
+        _, large_queries, large_ms, large_status = large[name]
+        problems = []
+        if status != 200 or large_status != 200:
+            problems.append(f'mã trạng thái {status}/{large_status}')
+        if not budget.known_issue:
+            if max(small_queries, large_queries) > budget.max_queries:
+                problems.append(f'{max(small_queries, large_queries)} câu SQL > {budget.max_queries}')
+            if large_queries > small_queries:
+                problems.append(f'số câu SQL tăng theo dữ liệu ({small_queries} -> {large_queries})')
+            if max(small_ms, large_ms) > budget.max_ms:
+                problems.append(f'{max(small_ms, large_ms):.1f} ms > {budget.max_ms} ms')
+
+        if problems:
+            verdict = 'FAIL: ' + '; '.join(problems)
+            failures.append(budget)
+        elif budget.known_issue:
+            verdict = f'KNOWN: {budget.known_issue}'
+        else:
+            verdict = 'OK'
+        print(f"{name:28} {budget.max_queries:>9} {small_queries:>5} {large_queries:>5} "
+              f"{max(small_ms, large_ms):>8.1f}  {verdict}")
+
+    if failures and args.verbose:
+        for budget in failures:
+            print(f"\n  Các câu SQL của {budget.name} (quy mô lớn):")
+            explain(budget, SCALE_FACTOR)
+    if failures:
+        print(f"\n{len(failures)} route vượt ngân sách truy vấn.")
+        sys.exit(1)
+    print('\nTất cả route nằm trong ngân sách truy vấn.')
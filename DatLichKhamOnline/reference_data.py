@@ -0,0 +1,151 @@
+# DatLichKhamOnline/reference_data.py
+# Cache dữ liệu tham chiếu: Shift, Department, MedicalCenter. Các bảng này rất nhỏ và hầu như chỉ đổi khi
+# admin sửa trong Flask-Admin, nhưng lại được đọc ở rất nhiều trang (dashboard/sửa ca của bác sĩ, dropdown
+# nơi công tác, tìm kiếm/gợi ý, phân tích). Toàn bộ được nạp một lần vào một snapshot bất biến (tuple +
+# mappingproxy) và phục vụ từ bộ nhớ: tra theo id và danh sách đã sắp xếp.
+#
+# Làm mới: khi một giao dịch có thay đổi Shift/Department/MedicalCenter được commit (Flask-Admin, hoặc
+# các thao tác ORM khác), snapshot của tiến trình hiện tại được nạp lại ở lần đọc kế tiếp. Các tiến trình
+# worker khác được báo qua một file phiên bản dùng chung (REFERENCE_DATA_VERSION_PATH): tiến trình ghi
+# nội dung mới vào file, các tiến trình còn lại so sánh mtime của file (tối đa mỗi
+# REFERENCE_DATA_CHECK_INTERVAL giây, không truy vấn CSDL) và tự nạp lại khi file đổi.
+# Thao tác hàng loạt không qua ORM (bulk_import) phải gọi invalidate().
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import namedtuple
+from types import MappingProxyType
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from DatLichKhamOnline import app, db
+from models import Shift, Department, MedicalCenter
+
+app.config.setdefault('REFERENCE_DATA_VERSION_PATH', os.path.join(tempfile.gettempdir(), 'mas_reference_data.version'))
+app.config.setdefault('REFERENCE_DATA_CHECK_INTERVAL', 1.0)
+
+ShiftRef = namedtuple('ShiftRef', 'id start_time end_time bit')
+DepartmentRef = namedtuple('DepartmentRef', 'id name description')
+MedicalCenterRef = namedtuple('MedicalCenterRef', 'id name address phone description image latitude longitude')
+
+REFERENCE_MODELS = (Shift, Department, MedicalCenter)
+
+
+class ReferenceData:
+    """Snapshot bất biến của dữ liệu tham chiếu."""
+
+    __slots__ = ('shifts', 'shift_by_id', 'shift_ordinals', 'shift_bits', 'departments', 'department_by_id',
+                 'medical_centers', 'medical_center_by_id', 'loaded_at')
+
+    def __init__(self, shifts, departments, medical_centers):
+        # Ca sắp theo giờ bắt đầu (rồi id); shift_ordinals là thứ tự đó, shift_bits (cùng thứ tự duyệt) là vị trí bit
+        # của ca trong doctor_availability.free_mask
+        self.shifts = tuple(sorted(shifts, key=lambda shift: (shift.start_time, shift.id)))
+        self.shift_by_id = MappingProxyType({shift.id: shift for shift in self.shifts})
+        self.shift_ordinals = MappingProxyType({shift.id: ordinal for ordinal, shift in enumerate(self.shifts)})
+        self.shift_bits = MappingProxyType({shift.id: shift.bit for shift in self.shifts if shift.bit is not None})
+        self.departments = tuple(sorted(departments, key=lambda department: (department.name, department.id)))
+        self.department_by_id = MappingProxyType({department.id: department for department in self.departments})
+        self.medical_centers = tuple(sorted(medical_centers, key=lambda center: center.id))
+        self.medical_center_by_id = MappingProxyType({center.id: center for center in self.medical_centers})
+        self.loaded_at = time.time()
+
+    def shift_ids_between(self, start_time, end_time):
+        """Các ca nằm trọn trong khung giờ [start_time, end_time], theo giờ bắt đầu."""
+        return [shift.id for shift in self.shifts if shift.start_time >= start_time and shift.end_time <= end_time]
+
+    def department_names(self):
+        return {department.id: department.name for department in self.departments}
+
+
+_snapshot = None
+_stale = True
+_version_mtime = None
+_checked_at = 0.0
+_lock = threading.Lock()
+
+
+def _version_file_mtime():
+    try:
+        return os.stat(app.config['REFERENCE_DATA_VERSION_PATH']).st_mtime_ns
+    except OSError:
+        return None
+
+
+def load():
+    """Nạp (lại) snapshot từ CSDL. Cần app context."""
+    global _snapshot, _stale, _version_mtime
+    # Đọc mtime trước khi truy vấn: nếu file đổi trong lúc nạp, lần kiểm tra sau sẽ nạp lại
+    version_mtime = _version_file_mtime()
+    shifts = [ShiftRef(*row) for row in db.session.query(Shift.id, Shift.start_time, Shift.end_time, Shift.bit)]
+    departments = [DepartmentRef(*row) for row in
+                   db.session.query(Department.id, Department.name, Department.description)]
+    centers = [MedicalCenterRef(*row) for row in
+               db.session.query(MedicalCenter.id, MedicalCenter.name, MedicalCenter.address, MedicalCenter.phone,
+                                MedicalCenter.description, MedicalCenter.image, MedicalCenter.latitude,
+                                MedicalCenter.longitude)]
+    _snapshot = ReferenceData(shifts, departments, centers)
+    _version_mtime = version_mtime
+    _stale = False
+    return _snapshot
+
+
+def get():
+    """Snapshot hiện tại; tự nạp lại khi đã bị đánh dấu cũ hoặc tiến trình khác báo thay đổi."""
+    global _stale, _checked_at
+    now = time.monotonic()
+    if not _stale and now - _checked_at >= app.config['REFERENCE_DATA_CHECK_INTERVAL']:
+        _checked_at = now
+        if _version_file_mtime() != _version_mtime:
+            _stale = True
+    if _stale or _snapshot is None:
+        with _lock:
+            if _stale or _snapshot is None:
+                load()
+    return _snapshot
+
+
+def invalidate(notify=True):
+    """Đánh dấu snapshot cũ; `notify` ghi file phiên bản để các tiến trình khác cũng nạp lại."""
+    global _stale
+    _stale = True
+    if notify:
+        path = app.config['REFERENCE_DATA_VERSION_PATH']
+        temporary = f'{path}.{uuid.uuid4().hex}'
+        with open(temporary, 'w') as file:
+            file.write(uuid.uuid4().hex)
+        os.replace(temporary, path)
+
+
+# Tiện ích cho các view/template
+def shifts():
+    return get().shifts
+
+
+def departments():
+    return get().departments
+
+
+def medical_centers():
+    return get().medical_centers
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changes(session, flush_context):
+    if any(isinstance(obj, REFERENCE_MODELS) for obj in
+           list(session.new) + list(session.dirty) + list(session.deleted)):
+        session.info['reference_data_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _refresh(session):
+    if session.info.pop('reference_data_changed', False):
+        invalidate()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard(session, previous_transaction):
+    session.info.pop('reference_data_changed', None)
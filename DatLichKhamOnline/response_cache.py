@@ -0,0 +1,317 @@
+# DatLichKhamOnline/response_cache.py
+# Bộ nhớ đệm phản hồi cho các API JSON của trang chủ (/api/featured-doctors, /api/medical-centers).
+# Mỗi mục được gắn "tag" theo loại dữ liệu phụ thuộc; khi các model liên quan được commit,
+# các tag tương ứng bị xóa khỏi cache. Hỗ trợ ETag/If-None-Match (304).
+#
+# cached_page(): cache toàn trang cho khách chưa đăng nhập (doctor_details, medical_center_details,
+# search_doctor, search_medical_center). Khóa là đường dẫn + query string đã chuẩn hóa; view gắn tag theo
+# id thực thể mà trang hiển thị (tag_page('doctor:3', 'medical_center:1'...)) để chỉ những trang liên quan
+# bị xóa khi một bác sĩ/bệnh viện/chuyên khoa được commit. Phản hồi mang Cache-Control public + s-maxage
+# và ETag để reverse proxy có thể phục vụ thay ứng dụng.
+#
+# Backend chọn qua app.config:
+#   RESPONSE_CACHE_BACKEND = 'memory' (LRU trong tiến trình) | 'sqlite' (file dùng chung giữa các worker)
+#   RESPONSE_CACHE_PATH    = đường dẫn file SQLite khi dùng backend 'sqlite'
+#   RESPONSE_CACHE_TTL     = thời gian sống (giây) của mỗi mục
+#   RESPONSE_CACHE_SIZE    = số mục tối đa của backend 'memory'
+#   PAGE_CACHE_ENABLED     = bật cache toàn trang (mặc định tắt)
+#   PAGE_CACHE_TTL         = thời gian sống (giây) của trang trong cache, cũng là s-maxage gửi cho proxy
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict, Counter
+from functools import wraps
+
+from flask import request, Response, g
+from flask_login import current_user
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from DatLichKhamOnline import app
+from models import User, UserRole, Doctor, DoctorDepartment, Department, MedicalCenter
+
+app.config.setdefault('RESPONSE_CACHE_BACKEND', 'memory')
+app.config.setdefault('RESPONSE_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'mas_response_cache.sqlite3'))
+app.config.setdefault('RESPONSE_CACHE_TTL', 300)
+app.config.setdefault('RESPONSE_CACHE_SIZE', 1024)
+app.config.setdefault('PAGE_CACHE_ENABLED', False)
+app.config.setdefault('PAGE_CACHE_TTL', 60)
+
+# Model thay đổi -> các tag cần xóa
+# 'doctor_cards': thẻ bác sĩ đã render (fragment_cache) – chỉ cần xóa khi dữ liệu ngoài User/Doctor thay đổi,
+# vì khóa của thẻ đã chứa updated_at của User/Doctor
+MODEL_TAGS = {
+    MedicalCenter: ('medical_centers', 'doctors', 'doctor_cards'),
+    Doctor: ('doctors',),
+    DoctorDepartment: ('doctors', 'doctor_cards'),
+    Department: ('doctors', 'doctor_cards'),
+    User: ('doctors',),
+}
+
+
+class CacheEntry:
+    __slots__ = ('body', 'etag', 'mimetype', 'tags', 'expires_at')
+
+    def __init__(self, body, etag, mimetype, tags, expires_at):
+        self.body = body
+        self.etag = etag
+        self.mimetype = mimetype
+        self.tags = tuple(tags)
+        self.expires_at = expires_at
+
+
+class MemoryBackend:
+    """LRU có TTL trong bộ nhớ tiến trình. Việc xóa theo tag chỉ có hiệu lực trong tiến trình hiện tại."""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_tags(self, tags):
+        tags = set(tags)
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if tags.intersection(entry.tags)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteBackend:
+    """Cache trong một file SQLite dùng chung: mọi worker cùng đọc/ghi nên việc xóa theo tag có hiệu lực cho tất cả."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS response_cache ('
+                               'key TEXT PRIMARY KEY, body BLOB, etag TEXT, mimetype TEXT, '
+                               'tags TEXT, expires_at REAL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS response_cache_tags ('
+                               'tag TEXT, key TEXT, PRIMARY KEY (tag, key))')
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        row = self._connect().execute(
+            'SELECT body, etag, mimetype, tags, expires_at FROM response_cache WHERE key = ? AND expires_at >= ?',
+            (key, time.time())
+        ).fetchone()
+        if row is None:
+            return None
+        return CacheEntry(row[0], row[1], row[2], row[3].split(',') if row[3] else (), row[4])
+
+    def set(self, key, entry):
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?, ?, ?)',
+                               (key, entry.body, entry.etag, entry.mimetype, ','.join(entry.tags), entry.expires_at))
+            connection.executemany('INSERT OR IGNORE INTO response_cache_tags VALUES (?, ?)',
+                                   [(tag, key) for tag in entry.tags])
+
+    def invalidate_tags(self, tags):
+        tags = list(tags)
+        if not tags:
+            return
+        placeholders = ','.join('?' * len(tags))
+        with self._connect() as connection:
+            connection.execute(f'DELETE FROM response_cache WHERE key IN '
+                               f'(SELECT key FROM response_cache_tags WHERE tag IN ({placeholders}))', tags)
+            connection.execute(f'DELETE FROM response_cache_tags WHERE tag IN ({placeholders})', tags)
+
+    def clear(self):
+        with self._connect() as connection:
+            connection.execute('DELETE FROM response_cache')
+            connection.execute('DELETE FROM response_cache_tags')
+
+
+def create_backend():
+    if app.config['RESPONSE_CACHE_BACKEND'] == 'sqlite':
+        return SQLiteBackend(app.config['RESPONSE_CACHE_PATH'])
+    return MemoryBackend(app.config['RESPONSE_CACHE_SIZE'])
+
+
+backend = create_backend()
+stats = Counter()
+
+
+def cache_stats():
+    """Bộ đếm theo endpoint: '<endpoint>.hit', '<endpoint>.miss', '<endpoint>.not_modified'."""
+    return dict(stats)
+
+
+def cached_response(*tags, ttl=None):
+    """Decorator lưu cache phản hồi của view theo đường dẫn + query string, gắn các tag cho trước."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = f"{request.path}?{request.query_string.decode('utf-8')}"
+            entry = backend.get(key)
+            if entry is not None:
+                stats[f'{request.endpoint}.hit'] += 1
+            else:
+                stats[f'{request.endpoint}.miss'] += 1
+                response = app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                body = response.get_data()
+                entry = CacheEntry(body, hashlib.sha1(body).hexdigest(), response.mimetype, tags,
+                                   time.time() + (ttl or app.config['RESPONSE_CACHE_TTL']))
+                backend.set(key, entry)
+
+            response = Response(entry.body, mimetype=entry.mimetype)
+            response.set_etag(entry.etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            response.make_conditional(request)
+            if response.status_code == 304:
+                stats[f'{request.endpoint}.not_modified'] += 1
+            return response
+        return wrapper
+    return decorator
+
+
+def normalized_query(params):
+    """Query string chuẩn hóa: chỉ giữ các tham số view thực sự đọc, bỏ giá trị rỗng, sắp xếp theo tên.
+
+    Giá trị 'q' được hạ chữ thường và gộp khoảng trắng (các view tìm kiếm không phân biệt hoa thường).
+    """
+    items = []
+    for name in sorted(params):
+        for value in request.args.getlist(name):
+            value = ' '.join(value.split())
+            if name == 'q':
+                value = value.lower()
+            if value:
+                items.append(f'{name}={value}')
+    return '&'.join(items)
+
+
+def tag_page(*tags):
+    """Gắn thêm tag (vd. 'doctor:3') cho trang đang được render bởi một view dùng cached_page()."""
+    page_tags = g.get('_page_cache_tags')
+    if page_tags is not None:
+        page_tags.update(tags)
+
+
+def _page_response(entry):
+    response = Response(entry.body, mimetype=entry.mimetype)
+    response.set_etag(entry.etag)
+    # Trình duyệt luôn xác thực lại bằng ETag; proxy dùng chung được giữ trang trong PAGE_CACHE_TTL giây.
+    # Vary: Cookie để proxy không trả trang của khách cho người đã đăng nhập.
+    response.headers['Cache-Control'] = f"public, max-age=0, s-maxage={app.config['PAGE_CACHE_TTL']}"
+    response.headers['Vary'] = 'Cookie'
+    response.make_conditional(request)
+    return response
+
+
+def cached_page(*tags, params=()):
+    """Decorator cache toàn trang cho khách chưa đăng nhập (bật bằng PAGE_CACHE_ENABLED).
+
+    `tags`: tag cố định của trang (vd. 'doctors' cho trang danh sách); view có thể thêm tag theo id thực thể
+    qua tag_page(). `params`: các tham số query string mà view đọc – chỉ chúng được đưa vào khóa.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not app.config['PAGE_CACHE_ENABLED'] or request.method != 'GET' or current_user.is_authenticated:
+                return view(*args, **kwargs)
+
+            key = f"page:{request.path}?{normalized_query(params)}"
+            entry = backend.get(key)
+            if entry is not None:
+                stats[f'{request.endpoint}.page_hit'] += 1
+            else:
+                stats[f'{request.endpoint}.page_miss'] += 1
+                # 'pages': mọi trang – để các thao tác hàng loạt không qua ORM (bulk_import) xóa được toàn bộ
+                g._page_cache_tags = {'pages', *tags}
+                response = app.make_response(view(*args, **kwargs))
+                page_tags = g.pop('_page_cache_tags')
+                # Không lưu trang lỗi hoặc phản hồi gắn cookie (phiên riêng của một khách)
+                if response.status_code != 200 or 'Set-Cookie' in response.headers:
+                    return response
+                body = response.get_data()
+                entry = CacheEntry(body, hashlib.sha1(body).hexdigest(), response.mimetype, page_tags,
+                                   time.time() + app.config['PAGE_CACHE_TTL'])
+                backend.set(key, entry)
+
+            response = _page_response(entry)
+            if response.status_code == 304:
+                stats[f'{request.endpoint}.not_modified'] += 1
+            return response
+        return wrapper
+    return decorator
+
+
+def _history_values(obj, attribute):
+    """Giá trị hiện tại và giá trị cũ (nếu vừa đổi) của một thuộc tính."""
+    history = inspect(obj).attrs[attribute].history
+    return {value for value in (getattr(obj, attribute), *history.deleted) if value is not None}
+
+
+def entity_tags(obj):
+    """Tag theo id thực thể bị ảnh hưởng khi `obj` thay đổi (dùng cho cache toàn trang)."""
+    if isinstance(obj, User):
+        return {f'doctor:{obj.id}'} if UserRole.DOCTOR in _history_values(obj, 'role') else set()
+    if isinstance(obj, Doctor):
+        return {f'doctor:{obj.id}'} | {f'medical_center:{center_id}'
+                                       for center_id in _history_values(obj, 'medical_center_id')}
+    if isinstance(obj, MedicalCenter):
+        return {f'medical_center:{obj.id}'}
+    if isinstance(obj, Department):
+        return {f'department:{obj.id}'}
+    if isinstance(obj, DoctorDepartment):
+        return {f'doctor:{doctor_id}' for doctor_id in _history_values(obj, 'doctor_id')} | \
+               {f'department:{department_id}' for department_id in _history_values(obj, 'department_id')}
+    return set()
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_tags(session, flush_context):
+    tags = session.info.setdefault('response_cache_tags', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        object_tags = entity_tags(obj)
+        # Thay đổi của bệnh nhân/admin không ảnh hưởng tới dữ liệu bác sĩ được cache
+        if isinstance(obj, User) and not object_tags:
+            continue
+        tags.update(MODEL_TAGS.get(type(obj), ()))
+        tags.update(object_tags)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate(session):
+    tags = session.info.pop('response_cache_tags', None)
+    if tags:
+        backend.invalidate_tags(tags)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_tags(session, previous_transaction):
+    session.info.pop('response_cache_tags', None)
@@ -0,0 +1,191 @@
+# DatLichKhamOnline/schedules.py
+# Tạo DoctorShift hàng loạt theo tập hợp (set-based): một truy vấn lấy các ca đã có,
+# một lệnh INSERT nhiều dòng cho các ca còn thiếu, rồi cập nhật chỉ mục doctor_availability.
+# Số câu lệnh không phụ thuộc vào số ngày của khoảng thời gian. Chỉ mục unique (doctor_id, work_date, shift_id)
+# chặn ca trùng khi hai request cùng thêm một ca; lệnh INSERT bỏ qua các dòng trùng đó thay vì báo lỗi.
+# Ca sinh từ lịch lặp lại ghi template_id của lịch đó; sửa/xóa lịch chỉ xóa các ca mang template_id của nó và không
+# thuộc lịch khác của bác sĩ (ca trùng khung giờ được chuyển cho lịch kia), không đụng tới ca bác sĩ tự thêm.
+from collections import defaultdict
+from datetime import date, timedelta
+
+from sqlalchemy import select, insert, update, delete, exists
+
+from DatLichKhamOnline import db, availability, reference_data
+from models import DoctorShift, Ticket, ScheduleTemplate
+
+doctor_shift_table = DoctorShift.__table__
+ticket_table = Ticket.__table__
+
+# Giới hạn độ dài của một lịch lặp lại
+MAX_TEMPLATE_DAYS = 366
+WEEKDAY_NAMES = ['Thứ 2', 'Thứ 3', 'Thứ 4', 'Thứ 5', 'Thứ 6', 'Thứ 7', 'Chủ nhật']
+
+
+def weekday_mask(weekdays):
+    mask = 0
+    for weekday in weekdays:
+        mask |= 1 << int(weekday)
+    return mask
+
+
+def weekdays_of(mask):
+    return [weekday for weekday in range(7) if mask >> weekday & 1]
+
+
+def shift_ids_between(start_time, end_time):
+    """Các ca nằm trọn trong khung giờ [start_time, end_time]."""
+    return reference_data.get().shift_ids_between(start_time, end_time)
+
+
+def template_slots(template, from_date=None):
+    """Tập (work_date, shift_id) mà lịch lặp lại sinh ra, chỉ tính từ from_date trở đi."""
+    start = max(template.start_date, from_date) if from_date else template.start_date
+    shift_ids = shift_ids_between(template.start_time, template.end_time)
+    slots = set()
+    day = start
+    while day <= template.end_date:
+        if template.weekday_mask >> day.weekday() & 1:
+            slots.update((day, shift_id) for shift_id in shift_ids)
+        day += timedelta(days=1)
+    return slots
+
+
+def materialize_shifts(doctor_id, slots, template_id=None):
+    """Thêm các DoctorShift còn thiếu cho tập (work_date, shift_id); trả về số ca được thêm.
+
+    Ca mới ghi template_id (lịch lặp lại sinh ra nó); ca đã có giữ nguyên nguồn gốc."""
+    slots = set(slots)
+    if not slots:
+        return 0
+    connection = db.session.connection()
+    work_dates = {work_date for work_date, _ in slots}
+    existing = set(connection.execute(
+        select(doctor_shift_table.c.work_date, doctor_shift_table.c.shift_id).where(
+            doctor_shift_table.c.doctor_id == doctor_id,
+            doctor_shift_table.c.work_date.between(min(work_dates), max(work_dates)),
+            doctor_shift_table.c.shift_id.in_({shift_id for _, shift_id in slots})
+        )
+    ).tuples())
+    missing = sorted(slots - existing)
+    if not missing:
+        return 0
+    added = connection.execute(_insert_ignore(connection), [
+        {'doctor_id': doctor_id, 'shift_id': shift_id, 'work_date': work_date, 'template_id': template_id}
+        for work_date, shift_id in missing
+    ]).rowcount
+    availability.refresh_availability(connection, {(doctor_id, work_date) for work_date, _ in missing})
+    return added if added >= 0 else len(missing)
+
+
+def _insert_ignore(connection):
+    """INSERT doctor_shifts bỏ qua dòng vi phạm chỉ mục unique (ca đã được request khác thêm)."""
+    dialect = connection.dialect.name
+    if dialect == 'mysql':
+        return insert(doctor_shift_table).prefix_with('IGNORE')
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        return dialect_insert(doctor_shift_table).on_conflict_do_nothing()
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        return dialect_insert(doctor_shift_table).on_conflict_do_nothing()
+    return insert(doctor_shift_table)
+
+
+def remove_unbooked_shifts(doctor_id, slots, template_id=None):
+    """Xóa các DoctorShift trong tập (work_date, shift_id) chưa có vé đặt; trả về số ca đã xóa.
+
+    Có template_id thì chỉ xóa các ca do lịch lặp lại đó sinh ra."""
+    slots = set(slots)
+    if not slots:
+        return 0
+    connection = db.session.connection()
+    work_dates = {work_date for work_date, _ in slots}
+    query = select(doctor_shift_table.c.id, doctor_shift_table.c.work_date, doctor_shift_table.c.shift_id).where(
+        doctor_shift_table.c.doctor_id == doctor_id,
+        doctor_shift_table.c.work_date.between(min(work_dates), max(work_dates)),
+        doctor_shift_table.c.shift_id.in_({shift_id for _, shift_id in slots}),
+        ~exists().where(ticket_table.c.doctor_shift_id == doctor_shift_table.c.id)
+    )
+    if template_id is not None:
+        query = query.where(doctor_shift_table.c.template_id == template_id)
+    candidates = connection.execute(query).all()
+    ids = [row.id for row in candidates if (row.work_date, row.shift_id) in slots]
+    if ids:
+        # Điều kiện NOT EXISTS được kiểm tra lại khi xóa phòng trường hợp có vé mới được đặt xen vào
+        connection.execute(delete(doctor_shift_table).where(
+            doctor_shift_table.c.id.in_(ids),
+            ~exists().where(ticket_table.c.doctor_shift_id == doctor_shift_table.c.id)
+        ))
+        availability.refresh_availability(connection, {(doctor_id, row.work_date) for row in candidates})
+    return len(ids)
+
+
+def _other_template_slots(template, from_date):
+    """{(work_date, shift_id): id lịch} cho các lịch lặp lại khác của cùng bác sĩ, từ from_date trở đi."""
+    owners = {}
+    others = db.session.query(ScheduleTemplate).filter(
+        ScheduleTemplate.doctor_id == template.doctor_id,
+        ScheduleTemplate.id != template.id,
+        ScheduleTemplate.end_date >= from_date
+    ).order_by(ScheduleTemplate.id)
+    for other in others:
+        for slot in template_slots(other, from_date=from_date):
+            owners.setdefault(slot, other.id)
+    return owners
+
+
+def _release_shifts(template, owners, slots=None):
+    """Chuyển các ca lịch `template` đã sinh (chỉ trong `slots` nếu có) cho lịch khác cùng khung giờ (`owners`),
+    không có thì để template_id NULL (giữ như ca bác sĩ tự thêm)."""
+    query = select(doctor_shift_table.c.id, doctor_shift_table.c.work_date, doctor_shift_table.c.shift_id).where(
+        doctor_shift_table.c.doctor_id == template.doctor_id,
+        doctor_shift_table.c.template_id == template.id
+    )
+    if slots is not None:
+        if not slots:
+            return
+        work_dates = {work_date for work_date, _ in slots}
+        query = query.where(doctor_shift_table.c.work_date.between(min(work_dates), max(work_dates)))
+    connection = db.session.connection()
+    ids_by_owner = defaultdict(list)
+    for row in connection.execute(query):
+        if slots is None or (row.work_date, row.shift_id) in slots:
+            ids_by_owner[owners.get((row.work_date, row.shift_id))].append(row.id)
+    for owner, ids in ids_by_owner.items():
+        connection.execute(update(doctor_shift_table).where(doctor_shift_table.c.id.in_(ids)).values(template_id=owner))
+
+
+def apply_template(template):
+    """Sinh các ca từ hôm nay trở đi cho lịch lặp lại; trả về số ca được thêm."""
+    if template.id is None:
+        db.session.flush()  # cần id để ghi vào DoctorShift.template_id
+    return materialize_shifts(template.doctor_id, template_slots(template, from_date=date.today()), template.id)
+
+
+def update_template(template, weekdays, start_time, end_time, start_date, end_date):
+    """Sửa lịch lặp lại: chỉ các ca tương lai chưa có người đặt của riêng lịch này bị xóa; trả về (số ca thêm, số ca xóa)."""
+    today = date.today()
+    old_slots = template_slots(template, from_date=today)
+    template.weekday_mask = weekday_mask(weekdays)
+    template.start_time, template.end_time = start_time, end_time
+    template.start_date, template.end_date = start_date, end_date
+    new_slots = template_slots(template, from_date=today)
+    owners = _other_template_slots(template, today)
+    dropped = old_slots - new_slots
+    removed = remove_unbooked_shifts(template.doctor_id, dropped - owners.keys(), template.id)
+    _release_shifts(template, owners, dropped)
+    added = materialize_shifts(template.doctor_id, new_slots - old_slots, template.id)
+    return added, removed
+
+
+def delete_template(template):
+    """Xóa lịch lặp lại cùng các ca tương lai chưa có người đặt của riêng nó; trả về số ca đã xóa.
+
+    Ca trùng khung giờ với lịch khác được chuyển cho lịch đó; ca đã qua hoặc đã có vé được giữ như ca tự thêm."""
+    today = date.today()
+    owners = _other_template_slots(template, today)
+    slots = template_slots(template, from_date=today)
+    removed = remove_unbooked_shifts(template.doctor_id, slots - owners.keys(), template.id)
+    _release_shifts(template, owners)
+    db.session.delete(template)
+    return removed
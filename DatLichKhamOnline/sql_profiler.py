@@ -0,0 +1,256 @@
+# DatLichKhamOnline/sql_profiler.py
+# Đo SQL theo từng request: số câu lệnh, tổng thời gian chờ CSDL, các câu chậm nhất, và phát hiện
+# mẫu N+1 (cùng một câu SQL lặp lại nhiều lần với tham số khác nhau – thường do lazy load trong vòng lặp
+# của template). Mỗi câu lệnh được gắn với dòng code/template đã gây ra nó.
+#
+# Kết quả được đưa ra:
+#   - header phản hồi: X-SQL-Queries, X-SQL-Time-Ms, X-SQL-N-Plus-One (SQL_PROFILER_HEADERS)
+#   - thanh debug (SQL_PROFILER_TOOLBAR) chèn vào cuối các trang HTML
+#   - /metrics theo định dạng text của Prometheus (số liệu tính riêng cho từng tiến trình)
+#
+# Cấu hình qua app.config:
+#   SQL_PROFILER_ENABLED      = bật/tắt đo (mặc định theo app.debug: mỗi câu lệnh phải dò ngăn xếp tìm nơi gọi)
+#   SQL_PROFILER_HEADERS      = thêm các header X-SQL-* vào phản hồi (mặc định theo app.debug – header lộ số truy vấn
+#                               và thời gian chờ CSDL của từng trang cho bất kỳ ai)
+#   SQL_PROFILER_TOOLBAR      = hiện thanh debug (mặc định theo app.debug)
+#   SQL_PROFILER_SLOWEST      = số câu chậm nhất hiển thị
+#   SQL_PROFILER_N_PLUS_ONE   = số lần lặp tối thiểu của một câu để bị coi là N+1
+#   SQL_PROFILER_METRICS_TOKEN = token cho Prometheus: header "Authorization: Bearer <token>". Không có token hợp lệ
+#                                thì /metrics chỉ mở cho admin đã đăng nhập
+#   SQL_PROFILER_METRICS_PUBLIC = True để mở /metrics cho mọi người (chỉ khi mạng nội bộ đã chặn truy cập ngoài)
+import hmac
+import logging
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from flask import g, request, has_request_context, render_template, Response, abort
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from DatLichKhamOnline import app
+from models import UserRole
+
+app.config.setdefault('SQL_PROFILER_ENABLED', app.debug)
+app.config.setdefault('SQL_PROFILER_HEADERS', app.debug)
+app.config.setdefault('SQL_PROFILER_TOOLBAR', app.debug)
+app.config.setdefault('SQL_PROFILER_SLOWEST', 5)
+app.config.setdefault('SQL_PROFILER_N_PLUS_ONE', 3)
+app.config.setdefault('SQL_PROFILER_METRICS_TOKEN', None)
+app.config.setdefault('SQL_PROFILER_METRICS_PUBLIC', False)
+
+logger = logging.getLogger(__name__)
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__)) + os.sep
+THIS_FILE = os.path.abspath(__file__)
+# Ngưỡng (số câu SQL mỗi request) của histogram Prometheus
+QUERY_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+
+class Statement:
+    __slots__ = ('sql', 'seconds', 'caller')
+
+    def __init__(self, sql, seconds, caller):
+        self.sql = sql
+        self.seconds = seconds
+        self.caller = caller
+
+
+class RequestProfile:
+    """Các câu SQL của một request."""
+
+    def __init__(self):
+        self.statements = []
+        self.started = time.perf_counter()
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    @property
+    def seconds(self):
+        return sum(statement.seconds for statement in self.statements)
+
+    def slowest(self, limit):
+        return sorted(self.statements, key=lambda statement: statement.seconds, reverse=True)[:limit]
+
+    def n_plus_one(self, threshold):
+        """Các câu SQL giống hệt nhau (chỉ khác tham số) chạy từ `threshold` lần trở lên.
+
+        Trả về danh sách dict {sql, count, seconds, callers}, lặp nhiều nhất trước.
+        """
+        groups = defaultdict(list)
+        for statement in self.statements:
+            groups[statement.sql].append(statement)
+        patterns = []
+        for sql, statements in groups.items():
+            if len(statements) < threshold:
+                continue
+            callers = defaultdict(int)
+            for statement in statements:
+                callers[statement.caller] += 1
+            patterns.append({
+                'sql': sql,
+                'count': len(statements),
+                'seconds': sum(statement.seconds for statement in statements),
+                'callers': sorted(callers.items(), key=lambda item: item[1], reverse=True),
+            })
+        return sorted(patterns, key=lambda pattern: pattern['count'], reverse=True)
+
+
+def _caller():
+    """Dòng code của ứng dụng (hoặc dòng template) gần nhất trên stack đã phát sinh câu SQL."""
+    frame = sys._getframe(2)
+    while frame is not None:
+        code = frame.f_code
+        template = frame.f_globals.get('__jinja_template__')
+        if template is not None:
+            return f'{template.name}:{template.get_corresponding_lineno(frame.f_lineno)}'
+        filename = os.path.abspath(code.co_filename)
+        if filename.startswith(APP_DIR) and filename != THIS_FILE:
+            return f'{os.path.relpath(filename, APP_DIR)}:{frame.f_lineno} ({code.co_name})'
+        frame = frame.f_back
+    return '?'
+
+
+def current_profile():
+    """Profile của request hiện tại, hoặc None (ngoài request / đang tắt)."""
+    if not has_request_context():
+        return None
+    return g.get('_sql_profile')
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_profile() is not None:
+        conn.info.setdefault('_sql_profiler_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = current_profile()
+    started = conn.info.get('_sql_profiler_started')
+    if profile is None or not started:
+        return
+    profile.statements.append(Statement(statement, time.perf_counter() - started.pop(), _caller()))
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(exception_context):
+    started = exception_context.connection.info.get('_sql_profiler_started') \
+        if exception_context.connection is not None else None
+    if started:
+        started.pop()
+
+
+class Metrics:
+    """Bộ đếm theo endpoint cho /metrics (trong bộ nhớ tiến trình)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.queries = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.n_plus_one = defaultdict(int)
+        self.buckets = defaultdict(lambda: [0] * (len(QUERY_BUCKETS) + 1))
+        # Các module khác (ví dụ ticket_expiry) thêm họ số liệu riêng: collector(family) được gọi khi render
+        self.collectors = []
+
+    def register(self, collector):
+        self.collectors.append(collector)
+        return collector
+
+    def observe(self, endpoint, profile, patterns):
+        with self._lock:
+            self.requests[endpoint] += 1
+            self.queries[endpoint] += profile.count
+            self.seconds[endpoint] += profile.seconds
+            self.n_plus_one[endpoint] += len(patterns)
+            buckets = self.buckets[endpoint]
+            for position, bound in enumerate(QUERY_BUCKETS):
+                if profile.count <= bound:
+                    buckets[position] += 1
+            buckets[-1] += 1
+
+    def render(self):
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(samples)
+
+        with self._lock:
+            endpoints = sorted(self.requests)
+            family('mas_http_requests_total', 'counter', 'Số request đã đo.',
+                   [f'mas_http_requests_total{{endpoint="{e}"}} {self.requests[e]}' for e in endpoints])
+            family('mas_sql_queries_total', 'counter', 'Tổng số câu SQL.',
+                   [f'mas_sql_queries_total{{endpoint="{e}"}} {self.queries[e]}' for e in endpoints])
+            family('mas_sql_seconds_total', 'counter', 'Tổng thời gian chờ CSDL (giây).',
+                   [f'mas_sql_seconds_total{{endpoint="{e}"}} {self.seconds[e]:.6f}' for e in endpoints])
+            family('mas_sql_n_plus_one_total', 'counter', 'Số mẫu N+1 phát hiện được.',
+                   [f'mas_sql_n_plus_one_total{{endpoint="{e}"}} {self.n_plus_one[e]}' for e in endpoints])
+            samples = []
+            for e in endpoints:
+                buckets = self.buckets[e]
+                for position, bound in enumerate(QUERY_BUCKETS):
+                    samples.append(f'mas_sql_queries_per_request_bucket{{endpoint="{e}",le="{bound}"}} '
+                                   f'{buckets[position]}')
+                samples.append(f'mas_sql_queries_per_request_bucket{{endpoint="{e}",le="+Inf"}} {buckets[-1]}')
+                samples.append(f'mas_sql_queries_per_request_sum{{endpoint="{e}"}} {self.queries[e]}')
+                samples.append(f'mas_sql_queries_per_request_count{{endpoint="{e}"}} {buckets[-1]}')
+            family('mas_sql_queries_per_request', 'histogram', 'Số câu SQL mỗi request.', samples)
+        for collector in self.collectors:
+            collector(family)
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+@app.before_request
+def _start_profile():
+    if app.config['SQL_PROFILER_ENABLED'] and request.endpoint not in ('static', 'metrics'):
+        g._sql_profile = RequestProfile()
+
+
+@app.after_request
+def _finish_profile(response):
+    profile = g.pop('_sql_profile', None)
+    if profile is None:
+        return response
+    patterns = profile.n_plus_one(app.config['SQL_PROFILER_N_PLUS_ONE'])
+    metrics.observe(request.endpoint or 'unknown', profile, patterns)
+
+    if app.config['SQL_PROFILER_HEADERS']:
+        response.headers['X-SQL-Queries'] = str(profile.count)
+        response.headers['X-SQL-Time-Ms'] = f'{profile.seconds * 1000:.2f}'
+        response.headers['X-SQL-N-Plus-One'] = str(len(patterns))
+    for pattern in patterns:
+        logger.warning('N+1 tại %s: %d lần "%s" (từ %s)', request.path, pattern['count'],
+                       pattern['sql'][:200], ', '.join(caller for caller, _ in pattern['callers'][:3]))
+
+    if app.config['SQL_PROFILER_TOOLBAR'] and response.mimetype == 'text/html' and not response.direct_passthrough:
+        body = response.get_data(as_text=True)
+        position = body.rfind('</body>')
+        if position != -1:
+            panel = render_template('layout/sql_toolbar.html', profile=profile, patterns=patterns,
+                                    slowest=profile.slowest(app.config['SQL_PROFILER_SLOWEST']),
+                                    elapsed=time.perf_counter() - profile.started)
+            response.set_data(body[:position] + panel + body[position:])
+    return response
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Số liệu lộ lưu lượng từng endpoint, thanh toán, vé hết hạn...: mặc định không công khai
+    token = app.config['SQL_PROFILER_METRICS_TOKEN']
+    authorized = (app.config['SQL_PROFILER_METRICS_PUBLIC']
+                  or (token and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'))
+                  or (current_user.is_authenticated and current_user.role == UserRole.ADMIN))
+    if not authorized:
+        abort(403)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,271 @@
+# DatLichKhamOnline/stats_rollup.py
+# Thống kê cộng dồn cho trang quản trị: các bộ đếm tổng (người dùng, bác sĩ, vé theo trạng thái),
+# số vé theo ngày/bác sĩ/trạng thái và mức sử dụng khung giờ theo ngày.
+# Các bảng được cập nhật dần trong sự kiện after_flush (vé, người dùng) và từ availability.py
+# (khung giờ), nên trang quản trị chỉ đọc các bảng nhỏ này thay vì quét bảng tickets.
+#
+#   python stats_rollup.py    # dựng lại toàn bộ từ dữ liệu gốc (backfill)
+import random
+from collections import Counter
+from datetime import date, timedelta
+
+from sqlalchemy import event, select, delete, insert, update, func
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+
+from DatLichKhamOnline import app, db
+from models import User, UserRole, Doctor, DoctorShift, Ticket, TicketStatus, Department, DoctorDepartment, \
+    MedicalCenter, StatCounter, TicketDailyStat, SlotDailyStat, DoctorShiftArchive, TicketArchive
+
+counter_table = StatCounter.__table__
+ticket_stat_table = TicketDailyStat.__table__
+slot_stat_table = SlotDailyStat.__table__
+
+SHARDS = 8
+
+
+def _upsert_add(connection, table, rows, value_columns):
+    """Cộng dồn value_columns vào các dòng theo khóa chính; tạo dòng mới nếu chưa có."""
+    rows = [row for row in rows if any(row[column] for column in value_columns)]
+    if not rows:
+        return
+    dialect = connection.dialect.name
+    if dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert as mysql_insert
+        statement = mysql_insert(table)
+        statement = statement.on_duplicate_key_update(
+            {column: table.c[column] + statement.inserted[column] for column in value_columns})
+        connection.execute(statement, rows)
+    elif dialect in ('sqlite', 'postgresql'):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        statement = dialect_insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[column.name for column in table.primary_key.columns],
+            set_={column: table.c[column] + statement.excluded[column] for column in value_columns})
+        connection.execute(statement, rows)
+    else:
+        for row in rows:
+            key = [column == row[column.name] for column in table.primary_key.columns]
+            result = connection.execute(update(table).where(*key).values(
+                {column: table.c[column] + row[column] for column in value_columns}))
+            if result.rowcount == 0:
+                connection.execute(insert(table), [row])
+
+
+def add_counters(connection, deltas):
+    """deltas: {tên bộ đếm: số cộng thêm}; mỗi lần cộng vào một shard ngẫu nhiên."""
+    _upsert_add(connection, counter_table, [
+        {'name': name, 'shard': random.randrange(SHARDS), 'value': delta} for name, delta in deltas.items()
+    ], ['value'])
+
+
+def add_slot_stats(connection, deltas):
+    """deltas: {work_date: (thay đổi số khung giờ, thay đổi số khung giờ trống)} – gọi từ availability.py."""
+    _upsert_add(connection, slot_stat_table, [
+        {'work_date': work_date, 'shard': random.randrange(SHARDS), 'slot_count': slots, 'free_count': free}
+        for work_date, (slots, free) in deltas.items()
+    ], ['slot_count', 'free_count'])
+
+
+def add_ticket_stats(connection, deltas):
+    """deltas: {(stat_date, doctor_id, status, medical_center_id): số cộng thêm} vào ticket_daily_stats."""
+    _upsert_add(connection, ticket_stat_table, [
+        {'stat_date': stat_date, 'doctor_id': doctor_id, 'status': status,
+         'medical_center_id': medical_center_id, 'ticket_count': delta}
+        for (stat_date, doctor_id, status, medical_center_id), delta in deltas.items()
+    ], ['ticket_count'])
+
+
+def rebuild_slot_stats(connection, day_totals):
+    """Ghi lại toàn bộ slot_daily_stats từ {work_date: (số khung giờ, số khung giờ trống)}."""
+    connection.execute(delete(slot_stat_table))
+    rows = [{'work_date': work_date, 'shard': 0, 'slot_count': slots, 'free_count': free}
+            for work_date, (slots, free) in day_totals.items()]
+    for start in range(0, len(rows), 5000):
+        connection.execute(insert(slot_stat_table), rows[start:start + 5000])
+
+
+def _status(value):
+    return value if isinstance(value, TicketStatus) else TicketStatus(value)
+
+
+def _is_doctor(role):
+    return role in (UserRole.DOCTOR, UserRole.DOCTOR.value)
+
+
+@event.listens_for(Session, 'after_flush')
+def _rollup_changes(session, flush_context):
+    """Chuyển các thay đổi của Ticket/User trong lần flush thành các phép cộng vào bảng thống kê."""
+    counters = Counter()
+    ticket_changes = []  # (doctor_shift_id, ngày đặt, trạng thái, +1/-1)
+
+    for obj in session.new:
+        if isinstance(obj, Ticket):
+            ticket_changes.append((obj.doctor_shift_id, obj.created_at, obj.status, 1))
+        elif isinstance(obj, User):
+            counters['users'] += 1
+            counters['doctors'] += 1 if _is_doctor(obj.role) else 0
+    for obj in session.deleted:
+        if isinstance(obj, Ticket):
+            status = (get_history(obj, 'status').deleted or [obj.status])[0]
+            ticket_changes.append((obj.doctor_shift_id, obj.created_at, status, -1))
+        elif isinstance(obj, User):
+            counters['users'] -= 1
+            counters['doctors'] -= 1 if _is_doctor((get_history(obj, 'role').deleted or [obj.role])[0]) else 0
+    for obj in session.dirty:
+        if isinstance(obj, Ticket):
+            history = get_history(obj, 'status')
+            if history.has_changes() and history.deleted:
+                ticket_changes.append((obj.doctor_shift_id, obj.created_at, history.deleted[0], -1))
+                ticket_changes.append((obj.doctor_shift_id, obj.created_at, obj.status, 1))
+        elif isinstance(obj, User):
+            history = get_history(obj, 'role')
+            if history.has_changes() and history.deleted:
+                counters['doctors'] += int(_is_doctor(obj.role)) - int(_is_doctor(history.deleted[0]))
+
+    if not counters and not ticket_changes:
+        return
+
+    connection = session.connection()
+    if ticket_changes:
+        doctor_shifts = DoctorShift.__table__
+        doctors = Doctor.__table__
+        owners = {row.id: row for row in connection.execute(
+            select(doctor_shifts.c.id, doctor_shifts.c.doctor_id, doctors.c.medical_center_id)
+            .select_from(doctor_shifts.join(doctors, doctors.c.id == doctor_shifts.c.doctor_id))
+            .where(doctor_shifts.c.id.in_({change[0] for change in ticket_changes}))
+        )}
+        daily = Counter()
+        for doctor_shift_id, created_at, status, delta in ticket_changes:
+            status = _status(status)
+            counters['tickets'] += delta
+            counters[f'tickets.{status.value}'] += delta
+            owner = owners.get(doctor_shift_id)
+            if owner:
+                stat_date = created_at.date() if created_at else date.today()
+                daily[(stat_date, owner.doctor_id, status, owner.medical_center_id)] += delta
+        add_ticket_stats(connection, daily)
+
+    add_counters(connection, {name: delta for name, delta in counters.items() if delta})
+
+
+def totals():
+    """Các số liệu tổng cho trang quản trị, đọc từ stat_counters."""
+    values = dict(db.session.query(StatCounter.name, func.sum(StatCounter.value)).group_by(StatCounter.name).all())
+    return {
+        'user_count': int(values.get('users') or 0),
+        'doctor_count': int(values.get('doctors') or 0),
+        'ticket_count': int(values.get('tickets') or 0),
+        'pending_tickets': int(values.get(f'tickets.{TicketStatus.PENDING.value}') or 0),
+    }
+
+
+def daily_series(days=30, end=None):
+    """Số lượt đặt, tỉ lệ hủy (theo ngày đặt) và mức sử dụng khung giờ (theo ngày khám) cho `days` ngày gần nhất."""
+    end = end or date.today()
+    start = end - timedelta(days=days - 1)
+
+    bookings = Counter()
+    cancelled = Counter()
+    for stat_date, status, count in db.session.query(
+            TicketDailyStat.stat_date, TicketDailyStat.status, func.sum(TicketDailyStat.ticket_count)
+    ).filter(TicketDailyStat.stat_date.between(start, end)).group_by(TicketDailyStat.stat_date, TicketDailyStat.status):
+        bookings[stat_date] += int(count)
+        if status == TicketStatus.CANCELLED:
+            cancelled[stat_date] += int(count)
+
+    slots = {work_date: (int(slot_count), int(free_count)) for work_date, slot_count, free_count in db.session.query(
+        SlotDailyStat.work_date, func.sum(SlotDailyStat.slot_count), func.sum(SlotDailyStat.free_count)
+    ).filter(SlotDailyStat.work_date.between(start, end)).group_by(SlotDailyStat.work_date)}
+
+    series = []
+    for offset in range(days):
+        day = start + timedelta(days=offset)
+        slot_count, free_count = slots.get(day, (0, 0))
+        series.append({
+            'date': day.isoformat(),
+            'bookings': bookings[day],
+            'cancellation_rate': round(cancelled[day] / bookings[day], 4) if bookings[day] else 0,
+            'utilization': round((slot_count - free_count) / slot_count, 4) if slot_count else 0,
+        })
+    return series
+
+
+def top_centers(days=30, limit=10):
+    """Các bệnh viện có nhiều lượt đặt nhất trong `days` ngày gần nhất."""
+    start = date.today() - timedelta(days=days - 1)
+    total = func.sum(TicketDailyStat.ticket_count).label('total')
+    return db.session.query(MedicalCenter.name, total).join(
+        TicketDailyStat, TicketDailyStat.medical_center_id == MedicalCenter.id
+    ).filter(TicketDailyStat.stat_date >= start).group_by(MedicalCenter.id, MedicalCenter.name).order_by(
+        total.desc()).limit(limit).all()
+
+
+def top_departments(days=30, limit=10):
+    """Các chuyên khoa có nhiều lượt đặt nhất trong `days` ngày gần nhất."""
+    start = date.today() - timedelta(days=days - 1)
+    total = func.sum(TicketDailyStat.ticket_count).label('total')
+    return db.session.query(Department.name, total).join(
+        DoctorDepartment, DoctorDepartment.department_id == Department.id
+    ).join(
+        TicketDailyStat, TicketDailyStat.doctor_id == DoctorDepartment.doctor_id
+    ).filter(TicketDailyStat.stat_date >= start).group_by(Department.id, Department.name).order_by(
+        total.desc()).limit(limit).all()
+
+
+def backfill():
+    """Dựng lại toàn bộ bảng thống kê từ users/tickets/doctor_shifts (kể cả phần đã lưu trữ)."""
+    from DatLichKhamOnline import availability
+
+    connection = db.session.connection()
+    users = User.__table__
+    doctors = Doctor.__table__
+    # Vé/ca ở bảng nóng và trong kho lưu trữ (archive.py) đều thuộc lịch sử thống kê
+    sources = [(Ticket.__table__, DoctorShift.__table__), (TicketArchive.__table__, DoctorShiftArchive.__table__)]
+
+    counters = Counter({
+        'users': connection.execute(select(func.count()).select_from(users)).scalar(),
+        'doctors': connection.execute(
+            select(func.count()).select_from(users).where(users.c.role == UserRole.DOCTOR)).scalar(),
+        'tickets': 0,
+    })
+    ticket_counts = Counter()
+    for tickets, doctor_shifts in sources:
+        counters['tickets'] += connection.execute(select(func.count()).select_from(tickets)).scalar()
+        for status, count in connection.execute(
+                select(tickets.c.status, func.count()).group_by(tickets.c.status)):
+            counters[f'tickets.{_status(status).value}'] += count
+
+        stat_date = func.date(tickets.c.created_at)
+        for row in connection.execute(
+                select(stat_date.label('stat_date'), doctor_shifts.c.doctor_id, tickets.c.status,
+                       doctors.c.medical_center_id, func.count().label('ticket_count'))
+                .select_from(tickets.join(doctor_shifts, doctor_shifts.c.id == tickets.c.doctor_shift_id)
+                             .join(doctors, doctors.c.id == doctor_shifts.c.doctor_id))
+                .group_by(stat_date, doctor_shifts.c.doctor_id, tickets.c.status, doctors.c.medical_center_id)):
+            stat_day = row.stat_date if isinstance(row.stat_date, date) else date.fromisoformat(row.stat_date)
+            ticket_counts[(stat_day, row.doctor_id, row.status, row.medical_center_id)] += row.ticket_count
+
+    connection.execute(delete(counter_table))
+    connection.execute(insert(counter_table), [{'name': name, 'shard': 0, 'value': value}
+                                               for name, value in counters.items()])
+
+    connection.execute(delete(ticket_stat_table))
+    rows = [{'stat_date': stat_day, 'doctor_id': doctor_id, 'status': status, 'medical_center_id': center_id,
+             'ticket_count': count}
+            for (stat_day, doctor_id, status, center_id), count in ticket_counts.items()]
+    for start in range(0, len(rows), 5000):
+        connection.execute(insert(ticket_stat_table), rows[start:start + 5000])
+
+    # Mức sử dụng khung giờ được dựng lại cùng chỉ mục doctor_availability
+    availability.rebuild_availability()
+    return len(rows)
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        db.create_all()  # Chỉ tạo các bảng còn thiếu
+        print(f"Đã dựng lại thống kê: {backfill()} dòng số vé theo ngày.")
@@ -0,0 +1,204 @@
+# DatLichKhamOnline/ticket_expiry.py
+# Hết hạn giữ chỗ: vé PENDING (đặt lịch nhưng chưa thanh toán) quá TICKET_HOLD_TTL giây bị xóa để ca khám
+# trống trở lại – mỗi ca chỉ có một vé (tickets.doctor_shift_id unique), nên vé còn tồn tại là còn giữ chỗ.
+#
+# Việc quét chạy theo lô, dựa trên tập hợp (không nạp đối tượng ORM): chọn tối đa TICKET_EXPIRY_BATCH_SIZE
+# vé theo chỉ mục (status, created_at), xóa bằng một câu DELETE rồi tự cập nhật các dữ liệu dẫn xuất mà sự
+# kiện ORM không thấy: chỉ mục doctor_availability (kéo theo slot_daily_stats), stat_counters và
+# ticket_daily_stats. Vé đang có thông báo thanh toán thành công chờ trong hàng đợi IPN (payments.py) không
+# bị xóa; tiền về sau khi vé đã hết hạn được worker IPN ghi nhận là 'refund_required'.
+#
+# Số ca được giải phóng mỗi lần quét được ghi log, cộng vào bộ đếm tickets.expired và xuất ra /metrics.
+#
+# Cấu hình qua app.config:
+#   TICKET_HOLD_TTL           = số giây giữ chỗ cho vé chưa thanh toán
+#   TICKET_EXPIRY_WORKER      = 'thread' (luồng nền trong tiến trình web) | 'off' (chạy riêng: python ticket_expiry.py)
+#   TICKET_EXPIRY_INTERVAL    = số giây giữa hai lần quét
+#   TICKET_EXPIRY_BATCH_SIZE  = số vé tối đa mỗi lô (mỗi lô một giao dịch)
+import argparse
+import logging
+import threading
+import time
+from collections import Counter, namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, delete, exists
+
+from DatLichKhamOnline import app, db, availability, stats_rollup, sql_profiler, payments
+from models import Ticket, TicketStatus, DoctorShift, Doctor, PaymentAttempt, PaymentNotification
+
+app.config.setdefault('TICKET_HOLD_TTL', 15 * 60)
+app.config.setdefault('TICKET_EXPIRY_WORKER', 'thread')
+app.config.setdefault('TICKET_EXPIRY_INTERVAL', 60)
+app.config.setdefault('TICKET_EXPIRY_BATCH_SIZE', 1000)
+
+logger = logging.getLogger(__name__)
+
+ticket_table = Ticket.__table__
+doctor_shift_table = DoctorShift.__table__
+doctor_table = Doctor.__table__
+attempt_table = PaymentAttempt.__table__
+notification_table = PaymentNotification.__table__
+
+RECLAIMED_BUCKETS = (0, 1, 10, 100, 1000, 10000)
+
+ExpiryRun = namedtuple('ExpiryRun', 'finished_at cutoff expired batches seconds')
+
+
+def hold_expires_at(ticket):
+    """Thời điểm vé PENDING hết hạn giữ chỗ."""
+    return ticket.created_at + timedelta(seconds=app.config['TICKET_HOLD_TTL'])
+
+
+def _expire_batch(connection, cutoff, limit):
+    """Xóa một lô vé PENDING tạo trước `cutoff`. Trả về các dòng (id, created_at, doctor_id, work_date,
+    medical_center_id) của những vé thực sự đã bị xóa."""
+    payment_in_flight = exists().where(
+        attempt_table.c.ticket_id == ticket_table.c.id,
+        notification_table.c.order_id == attempt_table.c.order_id,
+        notification_table.c.processed_at.is_(None),
+        notification_table.c.result_code == payments.RESULT_SUCCESS,
+    )
+    rows = connection.execute(
+        select(ticket_table.c.id, ticket_table.c.created_at, doctor_shift_table.c.doctor_id,
+               doctor_shift_table.c.work_date, doctor_table.c.medical_center_id)
+        .select_from(ticket_table.join(doctor_shift_table, doctor_shift_table.c.id == ticket_table.c.doctor_shift_id)
+                     .join(doctor_table, doctor_table.c.id == doctor_shift_table.c.doctor_id))
+        .where(ticket_table.c.status == TicketStatus.PENDING, ticket_table.c.created_at < cutoff, ~payment_in_flight)
+        .order_by(ticket_table.c.created_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True, of=ticket_table)
+    ).all()
+    if not rows:
+        return []
+
+    ids = [row.id for row in rows]
+    # Điều kiện status lặp lại phòng khi worker IPN xác nhận vé giữa hai câu lệnh (CSDL không khóa dòng)
+    deleted = connection.execute(
+        delete(ticket_table).where(ticket_table.c.id.in_(ids), ticket_table.c.status == TicketStatus.PENDING)
+    ).rowcount
+    if deleted != len(ids):
+        kept = set(connection.execute(select(ticket_table.c.id).where(ticket_table.c.id.in_(ids))).scalars())
+        rows = [row for row in rows if row.id not in kept]
+    return rows
+
+
+def _apply_derived(connection, rows):
+    """Cập nhật chỉ mục ca trống và các bảng thống kê cho các vé vừa bị xóa ngoài session ORM."""
+    availability.refresh_availability(connection, {(row.doctor_id, row.work_date) for row in rows})
+    daily = Counter()
+    for row in rows:
+        daily[(row.created_at.date(), row.doctor_id, TicketStatus.PENDING, row.medical_center_id)] -= 1
+    stats_rollup.add_ticket_stats(connection, daily)
+    stats_rollup.add_counters(connection, {
+        'tickets': -len(rows),
+        f'tickets.{TicketStatus.PENDING.value}': -len(rows),
+        'tickets.expired': len(rows),
+    })
+
+
+def expire_pending(now=None):
+    """Quét hết các vé PENDING quá hạn, mỗi lô một giao dịch. Trả về ExpiryRun. Cần app context."""
+    started = time.perf_counter()
+    cutoff = (now or datetime.now()) - timedelta(seconds=app.config['TICKET_HOLD_TTL'])
+    limit = app.config['TICKET_EXPIRY_BATCH_SIZE']
+    expired = batches = 0
+    while True:
+        connection = db.session.connection()
+        rows = _expire_batch(connection, cutoff, limit)
+        if rows:
+            _apply_derived(connection, rows)
+        db.session.commit()
+        expired += len(rows)
+        batches += 1
+        if len(rows) < limit:
+            break
+    run = ExpiryRun(datetime.now(), cutoff, expired, batches, time.perf_counter() - started)
+    metrics.observe(run)
+    if expired:
+        logger.info('Đã giải phóng %d ca từ vé chưa thanh toán quá hạn (%d lô, %.2f s)',
+                    expired, batches, run.seconds)
+    return run
+
+
+class ExpiryMetrics:
+    """Số ca được giải phóng theo từng lần quét (trong bộ nhớ tiến trình), xuất ra /metrics."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.reclaimed = 0
+        self.buckets = [0] * (len(RECLAIMED_BUCKETS) + 1)
+        self.last_run = None
+
+    def observe(self, run):
+        with self._lock:
+            self.runs += 1
+            self.reclaimed += run.expired
+            for position, bound in enumerate(RECLAIMED_BUCKETS):
+                if run.expired <= bound:
+                    self.buckets[position] += 1
+            self.buckets[-1] += 1
+            self.last_run = run
+
+    def collect(self, family):
+        with self._lock:
+            samples = [f'mas_ticket_expiry_reclaimed_per_run_bucket{{le="{bound}"}} {self.buckets[position]}'
+                       for position, bound in enumerate(RECLAIMED_BUCKETS)]
+            samples += [f'mas_ticket_expiry_reclaimed_per_run_bucket{{le="+Inf"}} {self.buckets[-1]}',
+                        f'mas_ticket_expiry_reclaimed_per_run_sum {self.reclaimed}',
+                        f'mas_ticket_expiry_reclaimed_per_run_count {self.runs}']
+            family('mas_ticket_expiry_reclaimed_per_run', 'histogram',
+                   'Số ca được giải phóng mỗi lần quét vé quá hạn.', samples)
+            if self.last_run:
+                family('mas_ticket_expiry_last_reclaimed', 'gauge', 'Số ca được giải phóng ở lần quét gần nhất.',
+                       [f'mas_ticket_expiry_last_reclaimed {self.last_run.expired}'])
+                family('mas_ticket_expiry_last_run_seconds', 'gauge', 'Thời gian của lần quét gần nhất (giây).',
+                       [f'mas_ticket_expiry_last_run_seconds {self.last_run.seconds:.6f}'])
+                family('mas_ticket_expiry_last_run_timestamp_seconds', 'gauge', 'Thời điểm kết thúc lần quét gần nhất.',
+                       [f'mas_ticket_expiry_last_run_timestamp_seconds {self.last_run.finished_at.timestamp():.0f}'])
+
+
+metrics = ExpiryMetrics()
+sql_profiler.metrics.register(metrics.collect)
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def _run_worker():
+    while True:
+        time.sleep(app.config['TICKET_EXPIRY_INTERVAL'])
+        try:
+            with app.app_context():
+                expire_pending()
+        except Exception:
+            logger.exception('Quét vé quá hạn thất bại')
+
+
+@app.before_request
+def _start_worker():
+    """Khởi động luồng quét ở request đầu tiên (không chạy khi TESTING – các script kiểm thử tự gọi expire_pending)."""
+    global _worker
+    if _worker is not None or app.config['TICKET_EXPIRY_WORKER'] != 'thread' or app.testing:
+        return
+    with _worker_lock:
+        if _worker is None:
+            _worker = threading.Thread(target=_run_worker, name='ticket-expiry', daemon=True)
+            _worker.start()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Giải phóng ca của các vé chưa thanh toán quá hạn giữ chỗ')
+    parser.add_argument('--once', action='store_true', help='Quét một lần rồi thoát')
+    args = parser.parse_args()
+    with app.app_context():
+        # Bảng/chỉ mục còn thiếu (kể cả tickets(status, created_at) trên bảng đã có) được thêm qua migration
+        from DatLichKhamOnline import migrations
+        migrations.upgrade()
+        while True:
+            run = expire_pending()
+            print(f"{run.finished_at:%H:%M:%S} giải phóng {run.expired} ca ({run.batches} lô, {run.seconds:.2f} s)")
+            if args.once:
+                break
+            time.sleep(app.config['TICKET_EXPIRY_INTERVAL'])
@@ -0,0 +1,143 @@
+# DatLichKhamOnline/user_identity.py
+# Bản chụp (snapshot) danh tính người dùng lưu trong session để load_user không phải truy vấn bảng users
+# ở mỗi request. Snapshot gồm id, vai trò, họ tên, ảnh đại diện và updated_at của dòng User; được ký
+# (itsdangerous, salt riêng) và mang số phiên bản định dạng IDENTITY_VERSION.
+#
+# current_user khi đó là một CachedUser: đọc các trường trong snapshot không chạm CSDL (đủ cho các kiểm tra
+# vai trò như "chỉ bác sĩ"); truy cập trường khác hoặc gán giá trị sẽ nạp User thật qua db.session.get và
+# chuyển mọi thao tác sang đối tượng đó.
+#
+# Snapshot hết hiệu lực khi:
+#   - User được sửa/xóa: trong cùng tiến trình biết ngay nhờ sự kiện after_commit (snapshot chụp trước thời
+#     điểm commit bị bỏ); ở tiến trình khác, snapshot được đối chiếu updated_at với CSDL (chỉ đọc một cột)
+#     sau tối đa IDENTITY_TTL giây,
+#   - người dùng đăng xuất (forget()), hoặc định dạng/phiên bản/chữ ký không hợp lệ.
+import time
+
+from flask import session
+from flask_login import UserMixin
+from itsdangerous import URLSafeSerializer, BadSignature
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from DatLichKhamOnline import app, db
+from models import User, UserRole
+
+app.config.setdefault('IDENTITY_TTL', 60)
+
+IDENTITY_VERSION = 1
+SESSION_KEY = '_identity'
+SNAPSHOT_FIELDS = ('id', 'role', 'first_name', 'last_name', 'avatar')
+
+_serializer = URLSafeSerializer(app.secret_key, salt='user-identity')
+# user_id -> thời điểm (time.time()) commit gần nhất có sửa/xóa User này trong tiến trình hiện tại
+_recent_changes = {}
+
+
+def _stamp(updated_at):
+    return updated_at.isoformat() if updated_at else ''
+
+
+def remember(user):
+    """Ghi snapshot của `user` vào session (sau khi đăng nhập hoặc sau khi nạp lại từ CSDL)."""
+    session[SESSION_KEY] = _serializer.dumps({
+        'v': IDENTITY_VERSION,
+        'id': user.id,
+        'role': user.role.name,
+        'first_name': user.first_name,
+        'last_name': user.last_name,
+        'avatar': user.avatar,
+        'updated_at': _stamp(user.updated_at),
+        'checked_at': time.time(),
+    })
+
+
+def forget():
+    session.pop(SESSION_KEY, None)
+
+
+class CachedUser(UserMixin):
+    """current_user dựng từ snapshot; nạp User thật khi cần trường ngoài snapshot hoặc khi ghi."""
+
+    def __init__(self, snapshot):
+        object.__setattr__(self, '_snapshot', snapshot)
+        object.__setattr__(self, '_user', None)
+
+    def _load(self):
+        if self._user is None:
+            object.__setattr__(self, '_user', db.session.get(User, self._snapshot['id']))
+        return self._user
+
+    def __getattr__(self, name):
+        if self._user is None and name in SNAPSHOT_FIELDS:
+            value = self._snapshot[name]
+            return UserRole[value] if name == 'role' else value
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __str__(self):
+        return f"{self.first_name or ''} {self.last_name or ''}".strip()
+
+
+def _read_snapshot(user_id):
+    token = session.get(SESSION_KEY)
+    if not token:
+        return None
+    try:
+        snapshot = _serializer.loads(token)
+    except BadSignature:
+        return None
+    if snapshot.get('v') != IDENTITY_VERSION or str(snapshot.get('id')) != str(user_id):
+        return None
+    return snapshot
+
+
+def load(user_id):
+    """Dùng trong login.user_loader: CachedUser nếu snapshot còn hợp lệ, nếu không thì User từ CSDL."""
+    snapshot = _read_snapshot(user_id)
+    if snapshot is not None:
+        changed_at = _recent_changes.get(snapshot['id'])
+        if changed_at is None or changed_at < snapshot['checked_at']:
+            if time.time() - snapshot['checked_at'] < app.config['IDENTITY_TTL']:
+                return CachedUser(snapshot)
+            # Hết TTL: chỉ đọc updated_at để biết tiến trình khác có sửa User này không
+            updated_at = db.session.query(User.updated_at).filter(User.id == snapshot['id']).scalar()
+            if updated_at is not None and _stamp(updated_at) == snapshot['updated_at']:
+                snapshot['checked_at'] = time.time()
+                session[SESSION_KEY] = _serializer.dumps(snapshot)
+                return CachedUser(snapshot)
+
+    user = db.session.get(User, int(user_id))
+    if user is None:
+        forget()
+        return None
+    remember(user)
+    return user
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changes(session_, flush_context):
+    changed = session_.info.setdefault('identity_changes', set())
+    changed.update(obj.id for obj in list(session_.dirty) + list(session_.deleted) if isinstance(obj, User))
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_changes(session_):
+    changed = session_.info.pop('identity_changes', None)
+    if not changed:
+        return
+    now = time.time()
+    for user_id in changed:
+        _recent_changes[user_id] = now
+    # Sau IDENTITY_TTL mọi snapshot đều được đối chiếu lại với CSDL nên không cần giữ thay đổi cũ hơn
+    if len(_recent_changes) > 1000:
+        for user_id in [user_id for user_id, changed_at in _recent_changes.items()
+                        if now - changed_at > app.config['IDENTITY_TTL']]:
+            _recent_changes.pop(user_id, None)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_changes(session_, previous_transaction):
+    session_.info.pop('identity_changes', None)
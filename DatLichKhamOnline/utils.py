@@ -0,0 +1,19 @@
+# DatLichKhamOnline/utils.py
+import re
+import unicodedata
+
+_TOKEN_RE = re.compile(r'[0-9a-z]+')
+
+
+def fold_text(text):
+    """Bỏ dấu tiếng Việt và chuyển về chữ thường: 'Bạch Mai' -> 'bach mai'."""
+    if not text:
+        return ''
+    text = text.replace('đ', 'd').replace('Đ', 'D')
+    text = unicodedata.normalize('NFD', text)
+    return ''.join(ch for ch in text if not unicodedata.combining(ch)).lower()
+
+
+def tokenize(text):
+    """Tách chuỗi (đã bỏ dấu) thành các từ chữ/số."""
+    return _TOKEN_RE.findall(fold_text(text))